@@ -0,0 +1,47 @@
+"""
+Compares the number of connections opened to a local site when crawling with
+a default requests.Session against one from crul.scrape.crawl_session.
+
+    $ python -m bench.pool [num_workers] [num_pages]
+"""
+import logging
+import sys
+import time
+
+import requests
+
+from bench.server import SiteServer
+from crul.parse import PageParser
+from crul.scrape import crawl_session, site_crawl
+from crul.traverse import PageTraverser
+
+
+def crawl(session, num_workers, num_pages):
+    server = SiteServer(num_pages=num_pages).start()
+    try:
+        start = time.time()
+        pages = sum(1 for _ in site_crawl(
+            session, server.url, num_workers, 0,
+            parser=PageParser(), traverser=PageTraverser(),
+        ))
+        return pages, server.connections, time.time() - start
+    finally:
+        session.close()
+        server.stop()
+
+
+def main(num_workers=32, num_pages=2000):
+    # Don't report each connection the default session discards.
+    logging.basicConfig(level=logging.ERROR)
+
+    default = requests.Session()
+    pooled = crawl_session('crul-bench', num_workers)
+
+    print '%-10s %8s %12s %8s' % ('session', 'pages', 'connections', 'seconds')
+    for name, session in [('default', default), ('pooled', pooled)]:
+        pages, conns, secs = crawl(session, num_workers, num_pages)
+        print '%-10s %8d %12d %8.2f' % (name, pages, conns, secs)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
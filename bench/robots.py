@@ -0,0 +1,80 @@
+"""
+Compares checking paths against robots.txt rules with fnmatch, as crul used
+to, against crul.robots.DisallowedSet's compiled matcher.
+
+    $ python -m bench.robots [num_rules] [num_paths]
+
+fnmatch compiles a regex for each pattern, and with more patterns than fit in
+its cache, recompiles them for every path checked, so keep num_paths small.
+"""
+import random
+import sys
+import time
+from fnmatch import fnmatch
+
+from crul.robots import DisallowedSet
+
+
+class FnmatchSet(object):
+    """FnmatchSet is the DisallowedSet crul used before rules were compiled."""
+    def __init__(self, patterns=()):
+        self.patterns = ['%s*' % p.lstrip('/') for p in patterns]
+
+    def __contains__(self, path):
+        path = path.lstrip('/')
+        for pattern in self.patterns:
+            if fnmatch(path, pattern):
+                return True
+        return False
+
+
+def rules(num_rules, rand):
+    """rules generates a mixture of plain and wildcard Disallow patterns."""
+    patterns = []
+    for i in xrange(num_rules):
+        section = 'section%d' % rand.randrange(num_rules // 10 + 1)
+        if i % 10 == 0:
+            patterns.append('/%s/*/print' % section)
+        elif i % 10 == 1:
+            patterns.append('/%s/*.pdf$' % section)
+        else:
+            patterns.append('/%s/page%d' % (section, i))
+    return patterns
+
+
+def paths(num_paths, num_rules, rand):
+    return [
+        '/section%d/%s' % (
+            rand.randrange(num_rules // 10 + 1),
+            rand.choice(['page%d' % rand.randrange(num_rules), 'a/print',
+                         'file.pdf', 'article?id=%d' % i]),
+        )
+        for i in xrange(num_paths)
+    ]
+
+
+def timed(fn):
+    start = time.time()
+    result = fn()
+    return result, time.time() - start
+
+
+def main(num_rules=2000, num_paths=100):
+    rand = random.Random(0)
+    patterns = rules(num_rules, rand)
+    sample = paths(num_paths, num_rules, rand)
+
+    print '%d rules, %d paths' % (num_rules, num_paths)
+    print '%-10s %10s %10s %12s %11s' % ('matcher', 'build (s)', 'check (s)',
+                                         'checks/s', 'disallowed')
+    for name, cls in [('fnmatch', FnmatchSet), ('compiled', DisallowedSet)]:
+        matcher, build = timed(lambda: cls(patterns))
+        found, check = timed(lambda: [p in matcher for p in sample])
+        # fnmatch takes $ literally, so it misses the rules anchored by it.
+        print '%-10s %10.3f %10.3f %12.0f %11d' % (
+            name, build, check, num_paths / check, sum(found),
+        )
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,88 @@
+"""
+Measures how quickly many threads can mark URLs seen at once, as the workers
+of a crawl do when following links, with each of crul's seen-sets against a
+set behind a single lock.
+
+    $ python -m bench.seen [num_urls] [max_threads]
+
+Each thread marks every URL, in its own order, so most marks find the URL
+already seen, as most links do in a crawl.
+"""
+import random
+import sys
+import threading
+import time
+
+from crul.seen import FingerprintSet, ScalableBloomFilter, StripedSet
+
+
+class LockedSet(object):
+    """LockedSet is a set with a single lock, serialising every add_new."""
+    def __init__(self):
+        self.urls = set()
+        self.lock = threading.Lock()
+
+    def __contains__(self, url):
+        return url in self.urls
+
+    def __len__(self):
+        return len(self.urls)
+
+    def add_new(self, url):
+        with self.lock:
+            if url in self.urls:
+                return False
+            self.urls.add(url)
+            return True
+
+
+def mark(seen, urls, num_threads):
+    """mark has num_threads threads mark each of urls seen, as
+    PageTraverser.queue_url does, returning the number of URLs found to be
+    new and the time taken.
+    """
+    start, new = threading.Event(), []
+
+    def run(seed):
+        order = list(urls)
+        random.Random(seed).shuffle(order)
+        start.wait()
+        new.append(sum(
+            1 for url in order if url not in seen and seen.add_new(url)
+        ))
+
+    threads = [threading.Thread(target=run, args=(n,))
+               for n in xrange(num_threads)]
+    for t in threads:
+        t.start()
+    began = time.time()
+    start.set()
+    for t in threads:
+        t.join()
+    return sum(new), time.time() - began
+
+
+def main(num_urls=20000, max_threads=64):
+    urls = ['http://site.test/page/%d' % n for n in xrange(num_urls)]
+    stores = [
+        ('locked', LockedSet),
+        ('striped', StripedSet),
+        ('fingerprint', FingerprintSet),
+        ('bloom', ScalableBloomFilter),
+    ]
+
+    print '%d URLs' % num_urls
+    print '%-12s %8s %10s %12s %8s' % ('seen', 'threads', 'seconds',
+                                       'marks/s', 'new')
+    num_threads = 1
+    while num_threads <= max_threads:
+        for name, cls in stores:
+            new, secs = mark(cls(), urls, num_threads)
+            print '%-12s %8d %10.3f %12.0f %8d' % (
+                name, num_threads, secs, num_threads * num_urls / secs, new,
+            )
+        num_threads *= 4
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,184 @@
+"""
+A local HTTP server serving a generated site, for benchmarking crul.
+
+Page n of the site links to pages n * fanout + 1 ... n * fanout + fanout,
+forming a tree of num_pages pages rooted at /. Pages can be padded out to a
+size, responses delayed to mimic a distant site, and a robots.txt served
+disallowing some of the pages.
+"""
+import random
+import socket
+import sys
+import threading
+import time
+from multiprocessing import Process, Queue
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+class SiteServer(ThreadingMixIn, HTTPServer):
+    """SiteServer serves a generated site of linked pages to benchmark crawls
+    against.
+
+    Args:
+        num_pages: The number of pages in the site.
+        fanout: The number of links from each page to the next level.
+        port: The port to listen on. (Default: any free port)
+        page_size: Pad each page with text to about this many bytes.
+        latency: Wait this many seconds before responding to each request.
+        jitter: Wait up to this many seconds more, at random.
+        disallow: Paths to disallow in robots.txt, which is only served if
+            there are any, or a crawl_delay.
+        crawl_delay: The Crawl-delay given in robots.txt.
+        capacity: The most requests to handle at once, beyond which we
+            respond 503 Service Unavailable. (Default: no limit)
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, num_pages=100, fanout=10, port=0, page_size=0,
+                 latency=0, jitter=0, disallow=(), crawl_delay=None,
+                 capacity=None):
+        HTTPServer.__init__(self, ('127.0.0.1', port), SiteHandler)
+        self.num_pages = num_pages
+        self.fanout = fanout
+        self.page_size = page_size
+        self.latency = latency
+        self.jitter = jitter
+        self.disallow = list(disallow)
+        self.crawl_delay = crawl_delay
+        self.capacity = capacity
+        self.in_flight = 0
+        self.overloaded = 0
+        self.connections = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://%s:%d/' % self.server_address
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        return ThreadingMixIn.process_request(self, request, client_address)
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up on their kept-alive connections is expected.
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+    def page(self, n):
+        children = xrange(n * self.fanout + 1,
+                          min(n * self.fanout + self.fanout, self.num_pages - 1) + 1)
+        links = ''.join('<a href="/%d.html">%d</a>' % (c, c) for c in children)
+        padding = max(0, self.page_size - len(links) - 80)
+        text = ('lorem ipsum ' * (padding // 12 + 1))[:padding]
+        return (
+            '<html><head><title>Page %d</title></head><body>%s<p>%s</p>'
+            '</body></html>' % (n, links, text)
+        )
+
+    def robots_txt(self):
+        if not self.disallow and self.crawl_delay is None:
+            return None
+        lines = ['User-agent: *']
+        lines += ['Disallow: %s' % path for path in self.disallow]
+        if self.crawl_delay is not None:
+            lines.append('Crawl-delay: %s' % self.crawl_delay)
+        return '\n'.join(lines) + '\n'
+
+    def wait(self):
+        delay = self.latency + random.random() * self.jitter
+        if delay:
+            time.sleep(delay)
+
+    def start(self):
+        t = threading.Thread(name='SiteServer', target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class SiteProcess(object):
+    """SiteProcess runs a SiteServer in a process of its own, so that the
+    time and memory it uses aren't counted against the crawler measured.
+    """
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.process = None
+        self.url = None
+
+    def start(self):
+        urls = Queue()
+        self.process = Process(target=serve, args=(self.kwargs, urls))
+        self.process.daemon = True
+        self.process.start()
+        self.url = urls.get()
+        return self
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+
+def serve(kwargs, urls):
+    server = SiteServer(**kwargs)
+    urls.put(server.url)
+    server.serve_forever()
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Each header is sent as it's written, so don't let Nagle's algorithm
+    # hold the rest of the response back waiting for an ACK.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            overloaded = server.capacity and server.in_flight >= server.capacity
+            if overloaded:
+                server.overloaded += 1
+            else:
+                server.in_flight += 1
+        if overloaded:
+            self.respond(503, 'text/plain', 'Overloaded')
+            return
+        try:
+            self.handle_page()
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def handle_page(self):
+        self.server.wait()
+        if self.path == '/robots.txt' and self.server.robots_txt():
+            self.respond(200, 'text/plain', self.server.robots_txt())
+            return
+        try:
+            n = 0 if self.path == '/' else int(self.path.strip('/')[:-len('.html')])
+            if not 0 <= n < self.server.num_pages:
+                raise ValueError
+        except ValueError:
+            self.respond(404, 'text/plain', 'Not found')
+            return
+        self.respond(200, 'text/html', self.server.page(n))
+
+    def respond(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,229 @@
+"""
+Measures crul's throughput against a generated site served locally, to catch
+performance regressions and to size worker counts.
+
+The site is crawled with each number of workers, its pages are parsed with
+each HTML parser, and the parsed pages are written and replayed in each
+format. Each is reported with its pages/s, CPU time per page and the peak
+RSS of the process so far; crawls also with their p50 and p99 fetch latency.
+The site is served from a separate process, so it isn't measured.
+
+    $ python -m bench.suite [options]
+
+Usage:
+    suite [options] [--workers=<n>]... [--disallow=<path>]...
+
+Options:
+    --pages=<n>          The number of pages in the site. [default: 2000]
+    --fanout=<n>         The number of links from each page. [default: 10]
+    --page-size=<bytes>  Pad each page to about this size. [default: 20000]
+    --latency=<s>        Delay each response by s seconds. [default: 0]
+    --jitter=<s>         Delay each response by up to s seconds more, at
+                         random. [default: 0]
+    --disallow=<path>    Disallow path in the site's robots.txt.
+    --capacity=<n>       Respond 503 to requests beyond n at once.
+    --adaptive           Crawl with an AdaptiveThrottle, up to the number of
+                         workers in flight.
+    --workers=<n>        Crawl with n workers; repeat to compare many.
+                         (Default: 1, 4 and 16)
+    --json               Print each result as a line of JSON.
+"""
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+from docopt import docopt
+from requests.structures import CaseInsensitiveDict
+
+from bench.server import SiteProcess, SiteServer
+from crul.metrics import Metrics
+from crul.output import render_json, render_sitemap_url
+from crul.parse import FrozenResponse, PageParser
+from crul.replay import RecordWriter, msgpack, read_pages
+from crul.robots import RobotsCache
+from crul.schedule import AdaptiveThrottle
+from crul.scrape import Fetcher, crawl_session, site_crawl
+from crul.traverse import PageTraverser
+
+COLUMNS = [
+    ('bench', '%-24s', '%-24s'),
+    ('pages', '%7s', '%7d'),
+    ('seconds', '%8s', '%8.2f'),
+    ('errors', '%7s', '%7d'),
+    ('pages/s', '%9s', '%9.1f'),
+    ('p50 (ms)', '%9s', '%9.1f'),
+    ('p99 (ms)', '%9s', '%9.1f'),
+    ('cpu/page (ms)', '%14s', '%14.3f'),
+    ('peak rss (MB)', '%14s', '%14.1f'),
+]
+
+
+class Measurement(object):
+    """Measurement is the wall-clock and CPU time taken to process some
+    pages, and the peak RSS of the process once they're done.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.pages = self.errors = 0
+        self.seconds = self.cpu = 0.0
+        self.fetch = None
+
+    def result(self):
+        fetch = self.fetch or {}
+        return {
+            'bench': self.name,
+            'pages': self.pages,
+            'errors': self.errors,
+            'seconds': self.seconds,
+            'pages/s': self.pages / self.seconds if self.seconds else 0.0,
+            'p50 (ms)': 1000 * fetch.get('p50', 0),
+            'p99 (ms)': 1000 * fetch.get('p99', 0),
+            'cpu/page (ms)': 1000 * self.cpu / self.pages if self.pages else 0,
+            # ru_maxrss is in kilobytes on Linux.
+            'peak rss (MB)': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        }
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+@contextmanager
+def measure(name):
+    m = Measurement(name)
+    start, start_cpu = time.time(), cpu_time()
+    yield m
+    m.seconds, m.cpu = time.time() - start, cpu_time() - start_cpu
+
+
+def bench_crawl(url, num_workers, adaptive=False):
+    """bench_crawl crawls the site at url as crul does by default, obeying
+    its robots.txt.
+    """
+    metrics = Metrics()
+    session = crawl_session('crul-bench', num_workers)
+    parser = PageParser()
+    try:
+        disallowed, delay = RobotsCache(session, 'crul-bench').rules(url)
+        fetcher = Fetcher(session, parser.looks_like_html, metrics=metrics)
+        throttle = None
+        if adaptive:
+            throttle = AdaptiveThrottle(delay, max_concurrency=num_workers)
+        with measure('crawl (%d workers)' % num_workers) as m:
+            for page in site_crawl(
+                    fetcher, url, num_workers, delay, parser=parser,
+                    traverser=PageTraverser(disallowed=disallowed,
+                                            metrics=metrics),
+                    metrics=metrics, throttle=throttle):
+                m.pages += 1
+                m.errors += (page.status or 0) >= 400
+        m.fetch = metrics.snapshot()['timers'].get('fetch')
+    finally:
+        session.close()
+    return m
+
+
+def site_responses(site_args):
+    """site_responses generates responses for each page of the site, as if
+    they'd been fetched.
+    """
+    site = SiteServer(**site_args)
+    site.server_close()
+    headers = CaseInsensitiveDict({'Content-Type': 'text/html; charset=utf-8'})
+    for n in xrange(site.num_pages):
+        url = 'http://site.test/%d.html' % n
+        yield FrozenResponse(url=url, request_url=url, status_code=200,
+                             headers=headers, content=site.page(n),
+                             encoding='utf-8')
+
+
+def bench_parse(responses, tag_parser):
+    parser = PageParser(tag_parser=tag_parser)
+    with measure('parse (%s)' % tag_parser) as m:
+        pages = [parser.parse(resp) for resp in responses]
+    m.pages = len(pages)
+    return m, pages
+
+
+def bench_write(pages, path, fmt):
+    with measure('write (%s)' % fmt) as m:
+        if fmt == 'json':
+            with open(path, 'w') as fh:
+                for page in pages:
+                    fh.write(render_json(page))
+        else:
+            writer = RecordWriter(path)
+            for page in pages:
+                writer.write(page)
+            writer.close()
+    m.pages = len(pages)
+    return m
+
+
+def bench_replay(path, fmt):
+    """bench_replay replays the pages in path to a sitemap, which decodes
+    little more than their URLs.
+    """
+    with measure('replay (%s)' % fmt) as m:
+        for page in read_pages(path, lazy=True):
+            render_sitemap_url(page)
+            m.pages += 1
+    return m
+
+
+def run(site_args, worker_counts, adaptive=False):
+    """run yields a Measurement for each of the benchmarks in turn."""
+    site = SiteProcess(**site_args).start()
+    try:
+        for num_workers in worker_counts:
+            yield bench_crawl(site.url, num_workers, adaptive)
+    finally:
+        site.stop()
+
+    responses = list(site_responses(site_args))
+    for tag_parser in ['lxml', 'html.parser', 'stream']:
+        m, pages = bench_parse(responses, tag_parser)
+        yield m
+
+    formats = ['json'] + (['records'] if msgpack is not None else [])
+    tmp = tempfile.mkdtemp()
+    try:
+        for fmt in formats:
+            path = os.path.join(tmp, 'bench.' + fmt)
+            yield bench_write(pages, path, fmt)
+            yield bench_replay(path, fmt)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def main(args=None):
+    args = args or docopt(__doc__)
+    site_args = dict(
+        num_pages=int(args['--pages']),
+        fanout=int(args['--fanout']),
+        page_size=int(args['--page-size']),
+        latency=float(args['--latency']),
+        jitter=float(args['--jitter']),
+        disallow=args['--disallow'],
+        capacity=args['--capacity'] and int(args['--capacity']),
+    )
+    worker_counts = map(int, args['--workers']) or [1, 4, 16]
+
+    if not args['--json']:
+        print ' '.join(fmt % name for name, fmt, _ in COLUMNS)
+    for m in run(site_args, worker_counts, args['--adaptive']):
+        result = m.result()
+        if args['--json']:
+            print json.dumps(result, sort_keys=True)
+        else:
+            print ' '.join(fmt % result[name] for name, _, fmt in COLUMNS)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,22 @@
 import json
 from collections import namedtuple
 
-from requests.structures import CaseInsensitiveDict
-
 
 Task = namedtuple('Task', [
-    'url', 'depth', 'referrer',
+    'url', 'depth', 'referrer', 'lastmod', 'attempt',
 ])
+# lastmod is when a sitemap said the page last changed, if it said at all;
+# attempt is the number of times the page has been requested already.
+Task.__new__.__defaults__ = (None, 0)
 
 Page = namedtuple('Page', [
     'url', 'canonical_url', 'fetched', 'headers', 'no_index', 'links',
-    'assets', 'title', 'depth'
+    'assets', 'title', 'depth', 'status', 'error', 'duplicate_of',
 ])
+# The HTTP status of pages recorded before it was kept is unknown. error is
+# why a page couldn't be requested at all, if it couldn't; duplicate_of is
+# the URL of the page whose content this page's duplicates, if it does.
+Page.__new__.__defaults__ = (None, None, None)
 
 Link = namedtuple('Link', [
     'type', 'href', 'no_follow', 'external', 'depth', 'referrer',
@@ -26,13 +31,16 @@ class JSONSerialiser(object):
         return json.dumps(self.page_to_dict(page))
 
     def dict_to_page(self, p):
+        # requests is imported here rather than above so that crul.__main__
+        # can let gevent patch the standard library before requests loads it.
+        from requests.structures import CaseInsensitiveDict
         links = [self.dict_to_link(l) for l in p.pop('links', ())]
         assets = [self.dict_to_link(l) for l in p.pop('assets', ())]
         headers = CaseInsensitiveDict(p.pop('headers', {}))
         return Page(links=links, assets=assets, headers=headers, **p)
 
     def page_to_dict(self, page):
-        return dict(page.__dict__.items() + [
+        return dict(page._asdict().items() + [
             ('headers', dict(page.headers.items())),
             ('links', [self.link_to_dict(l) for l in page.links]),
             ('assets', [self.link_to_dict(l) for l in page.assets]),
@@ -42,4 +50,4 @@ class JSONSerialiser(object):
         return Link(**link)
 
     def link_to_dict(self, link):
-        return dict(link.__dict__)
+        return dict(link._asdict())
@@ -16,6 +16,32 @@ Examples:
 
         $ crul --replay me.scrape --sitemap > sitemap.xml
 
+    Record the results in the compact binary format instead, which replays
+    much faster, and look up a single page from them:
+
+        $ crul http://www.paul-scott.com/ --records=me.rec
+        $ crul --replay me.rec --replay-url=http://www.paul-scott.com/ --text
+
+    Report the pages with the highest PageRank, any orphaned pages and
+    broken links, and draw the site:
+
+        $ crul --replay me.scrape --graph
+        $ crul --replay me.scrape --dot | dot -Tsvg > me.svg
+
+    Render a sitemap of a very large scrape using 8 processes:
+
+        $ crul --replay huge.scrape --replay-procs=8 --sitemap > sitemap.xml
+
+    Or as gzipped sitemaps of up to 50,000 URLs each (sitemap-1.xml.gz, ...)
+    listed by a sitemap index in sitemap.xml.gz, to be published at the root
+    of the site:
+
+        $ crul --replay huge.scrape --sitemap -o sitemap.xml.gz
+
+    Record a crawl as gzipped JSON in files of 10,000 pages each:
+
+        $ crul <url> --json -o pages.json.gz --shard-pages=10000
+
     Scrape only 3 pages deep with a single worker, leaving 2 seconds between
     each subsequent request to the site, w/o anything under /developer/flash
     or /forum/:
@@ -28,159 +54,219 @@ Examples:
 
         $ crul --yolo -w 5 <url>
 
+    Scrape the site again, downloading only the pages which have changed:
+
+        $ crul http://www.paul-scott.com/ --since=me.scrape --json > new.scrape
+
+    Crawl the pages listed by the site's sitemaps too, skipping those which
+    haven't been modified since we last scraped them:
+
+        $ crul http://www.paul-scott.com/ --from-sitemap --since=me.scrape
+
+    Crawl a shop whose pages are served under many URLs (session IDs, print
+    views, ...) without parsing each copy, or following its links:
+
+        $ crul --dedupe=near <url>
+
+    Crawl a huge site in bounded memory, keeping up to 100,000 pending URLs
+    in memory and the rest on disk, and pausing whilst 500 pages are waiting
+    to be output (and 500 more to be written):
+
+        $ crul <url> --max-pending=100000 --max-complete=500 -o site.json.gz
+
+    Crawl a large site, resuming where we left off if the crawl is stopped:
+
+        $ crul --state-dir=crawl-state <url> --json >> site.scrape
+
+    Crawl many sites at once, taking turns between those whose robots.txt
+    Crawl-Delay allows us to make a request:
+
+        $ crul --seeds-file=sites.txt -w 16 --json > sites.scrape
+
+    Request the 1000 most important pages first, putting off faceted search
+    results:
+
+        $ crul --frontier=priority --max-pages=1000 <url> \
+            --url-weight='[?&]facet=:5'
+
+    Crawl a shop without revisiting its pages for every order of the filters
+    in their query strings, or every tracking parameter:
+
+        $ crul --sort-query --strip-param=utm_source --strip-param=ref <url>
+
+    Crawl as fast as the site can comfortably bear, backing off if it starts
+    to struggle or asks us to slow down:
+
+        $ crul --adaptive -w 16 <url>
+
+    Give up on requests which take over 10 seconds, retrying each failed
+    request up to 5 times, 2, 4, 8, ... seconds apart (give or take):
+
+        $ crul --timeout=10 --retries=5 --retry-delay=2 <url>
+
+    Keep up to 200 requests in flight at once on a single event loop:
+
+        $ crul --engine=async --concurrency=200 <url>
+
 Usage:
-    crul (<url> [options] | --replay=<file>)
-            [--disallow=<path>]...
-            [--dot | --sitemap | --text | --json]
-            [-v|-q] [--log-file=<log-file>]
+    crul (<url>... [options] | --seeds-file=<file> [options]
+          | --replay=<file> [--replay-url=<url>... | --replay-procs=<n>])
+            [--disallow=<path>]... [--url-weight=<w>]...
+            [--strip-param=<p>]...
+            [--dot | --graph | --sitemap | --text | --json | --records=<file>]
+            [--output=<file>] [--shard-bytes=<n>] [--shard-pages=<n>]
+            [--sitemap-url=<url>] [-v|-q] [--log-file=<log-file>]
     crul [--help | --version]
 
 Options:
+       --dot              Output the links between pages in Graphviz's dot
+                          format.
+       --graph            Output a report on the links between pages: their
+                          PageRank, click depth, orphans and broken links.
        --sitemap          Output in XML sitemap format.
        --json             Output in JSON format. [default]
        --text             Output in human-readable text format.
+       --adaptive         Adapt the rate of requests to each site to how it
+                          responds: up to --workers requests at once whilst
+                          it's quick, fewer on 429s, 5xx errors and slowing
+                          responses, pausing for any Retry-After. The
+                          --delay or Crawl-Delay is kept as the minimum.
     -A --user-agent       The user-agent sent from the client.
                           [default: Crul/1.0 (+https://github.com/icio/crul)]
+       --conn-retry=<n>   Retry failed connections n times. [default: 0]
     -d --depth=<n>        Traverse n pages deep from the starting point.
                           [default: 100]
+       --dedupe=<mode>    Skip parsing pages, and following their links, when
+                          their content is the "exact" same as a page already
+                          crawled, or a "near" duplicate of one.
+       --engine=<engine>  Crawl with "threaded" workers or on an "async"
+                          event loop (requires gevent). [default: threaded]
+       --concurrency=<n>  The maximum number of requests in flight on the
+                          async engine. [default: 100]
+       --frontier=<order>
+                          Request pending URLs in the order they're found
+                          ("fifo"), or lowest "priority" score first: the
+                          score is their depth, less one for each doubling
+                          of the links to them, plus any --url-weight.
+                          [default: fifo]
+       --from-sitemap     Also crawl the URLs listed in the sitemaps named by
+                          robots.txt (or else /sitemap.xml), skipping those
+                          which --since shows haven't changed.
     -h --help             Print this help.
+       --head-unknown     Check whether URLs without a familiar page
+                          extension are HTML with a HEAD request first.
+       --html-parser=<p>  Parse HTML with BeautifulSoup using "lxml" or
+                          "html.parser", or in a single "stream"ing pass.
+                          [default: lxml]
     -i --disallow=<path>  Ignore/disallow file paths from being scraped.
     -l --log-file=<file>  Log to the given file.
+    -o --output=<file>    Write the output to file rather than stdout, gzipped
+                          if it ends in .gz, or zstd-compressed if .zst
+                          (requires zstandard). Sitemaps are split into
+                          sitemaps of up to 50,000 URLs and 50MB, listed by a
+                          sitemap index in file.
+       --max-pages=<n>    Request no more than n pages.
+       --metrics-file=<f> Append snapshots of the crawl's metrics to f as
+                          JSON lines, every --progress seconds.
+       --max-body-bytes=<n>
+                          Download no more than n bytes of each page.
+       --max-complete=<n> Hold up to n pages waiting to be output, and n more
+                          waiting to be written, pausing the workers whilst
+                          they're full. [default: 1000]
+       --max-pending=<n>  Hold up to n pending URLs in memory. The rest are
+                          spilled to disk, or with --overflow=drop, not
+                          queued (until they're found again with room).
+       --no-keep-alive    Close each connection after its request.
+       --overflow=<p>     What to do with pending URLs beyond --max-pending:
+                          "spill" them to disk (with the fifo frontier), or
+                          "drop" them. (Default: spill with the fifo
+                          frontier, else drop)
+       --parse-procs=<n>  Parse pages in a pool of n processes, rather than in
+                          the workers which fetched them. [default: 0]
+       --pool-size=<n>    Keep up to n connections open to each host.
+                          (Default: one for each worker.)
+       --pool-hosts=<n>   Keep connections open to up to n hosts.
+                          [default: 10]
+       --progress=<n>     Log the progress of the crawl every n seconds.
+                          [default: 0]
     -q --quiet            Quiet logging.
-    -r --replay=<file>    Load responses from a JSON file, instead of scraping.
+       --records=<file>   Output to file in the binary replay format, with an
+                          index alongside in file.idx.
+    -r --replay=<file>    Load responses from a JSON or binary records file,
+                          instead of scraping.
+       --replay-procs=<n> Replay to JSON or a sitemap in a pool of n
+                          processes, each decoding a part of the file.
+                          [default: 0]
+       --replay-url=<url>
+                          Replay only the page recorded for url, looking it up
+                          in the index of a binary records file.
+       --retries=<n>      Retry requests which time out, fail to connect or
+                          are answered with a 429 or 5xx up to n times, later
+                          on, before recording them as failed. [default: 2]
+       --retry-delay=<s>  Retry failed requests after about s seconds,
+                          doubling each time, or any Retry-After. [default: 1]
+       --seen=<store>     Remember the URLs we've seen in a "set", as 64-bit
+                          "fingerprint"s, or in a "bloom" filter.
+                          [default: set]
+       --seen-error=<p>   The false-positive rate of the bloom filter.
+                          [default: 0.0001]
+       --since=<file>     Only download pages which have changed since the
+                          crawl recorded in file, reusing the others.
+       --seeds-file=<f>   Crawl the sites of the URLs listed in f, one per line.
+    -s --state-dir=<dir>  Keep the crawl state in dir, to resume the crawl
+                          from there if it's stopped.
+       --shard-bytes=<n>  Split the --output into files of up to n bytes
+                          (before compression), numbered from file-1.
+       --shard-pages=<n>  Split the --output into files of up to n pages,
+                          numbered from file-1.
+       --sitemap-url=<url>
+                          The URL at which the --output sitemap (index) will
+                          be published. (Default: at the root of the site of
+                          the first page.)
+       --sort-query       Treat URLs whose query strings differ only in the
+                          order of their parameters as the same page.
+       --stats            Print a summary of where the crawl spent its time
+                          to stderr once it's over.
+       --strip-param=<p>  Treat URLs which differ only in the query string
+                          parameter p (e.g. a session ID) as the same page.
     -t --delay=<n>        Wait n seconds between requests to the site.
+       --timeout=<s>      Give up on requests which take more than s seconds
+                          to connect, or between reads.
+       --url-weight=<w>   Add to the priority score of URLs matching a regex,
+                          given as <regex>:<weight>, so that they're
+                          requested later (or sooner, if negative).
     -v --verbose          Verbose logging.
        --version          Print the version number.
     -w --workers=<n>      Use n worker threads to make requests in parallel.
                           [default: 4]
        --yolo             Don't bother checking robots.txt.
 """
-import logging
-import re
-from urlparse import urljoin
-
-import requests
 from docopt import docopt
-from requests.exceptions import RequestException
-
-from crul import JSONSerialiser
-from crul.output import output_json, output_sitemap, output_text
-from crul.parse import PageParser
-from crul.scrape import site_crawl
-from crul.traverse import DisallowedSet, PageTraverser
 
 
 def main(args=None):
     if not args:
         args = docopt(__doc__, version='Crul 1.0')
 
-    if not args['--replay'] and not args['<url>']:
+    crawling = bool(args['<url>'] or args['--seeds-file'])
+    if not args['--replay'] and not crawling:
         print __doc__.strip('\n')
         return
 
-    # Configure logging.
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    log_fmt = logging.Formatter(
-        '%(asctime)s %(threadName)s %(name)s %(levelname)s %(message)s'
-    )
-    if args['--quiet'] and not args['--log-file']:
-        logger.addHandler(logging.NullHandler())
-    if not args['--quiet']:
-        log_out = logging.StreamHandler()
-        log_out.setLevel(logging.DEBUG if args['--verbose'] else logging.INFO)
-        log_out.setFormatter(log_fmt)
-        logger.addHandler(log_out)
-    if args['--log-file']:
-        log_file = logging.FileHandler(args['--log-file'])
-        log_file.setLevel(logging.DEBUG)
-        log_file.setFormatter(log_fmt)
-        logger.addHandler(log_file)
-
-    # Input.
-    if args['<url>']:
-        crawl = main_crawl(args)
-    else:
-        crawl = main_replay(args['--replay'])
-
-    # Output.
-    #
-    # Originally the plan was to generate a graphic of all of the inter-
-    # connected pages, but after playing about with Graphviz for a while I
-    # wasn't able to make anything pretty, so I've not included it. This was
-    # the motivation for --replay: I was just going to generate equivalent
-    # JSON output in gergle and pipe through this program.
-    if args['--json']:
-        output_json(crawl)
-    elif args['--sitemap']:
-        output_sitemap(crawl)
-    else:
-        output_text(crawl)
-
-
-def main_crawl(args):
-    # TODO: Configure connection pooling.
-    session = requests.Session()
-    session.headers.update({'User-Agent': args['--user-agent']})
-
-    disallowed, delay = (), 0
-    if not args['--yolo']:
+    if crawling and args['--engine'] == 'async':
+        # Make blocking IO cooperative. gevent must patch the standard library
+        # before anything imports it (requests, ssl, threading, Queue, ...),
+        # so this is done before the rest of crul (even crul.green.patch) is
+        # imported.
         try:
-            robots_txt = fetch_robots_txt(args['<url>'], session=session)
-            disallowed = parse_disallowed(args['--user-agent'], robots_txt)
-            delay = parse_crawl_delay(args['--user-agent'], robots_txt)
-        except RequestException:
-            logging.debug('Unable to collect robots.txt')
-
-    disallowed = DisallowedSet(list(disallowed) + args['--disallow'])
-    logging.debug('Disallowed: %s', disallowed)
-
-    if args['--delay'] is not None:
-        delay = float(args['--delay'])
-    logging.debug('Delay: %.2f', delay)
-
-    return site_crawl(
-        session, args['<url>'], int(args['--workers']), delay,
-        parser=PageParser(),
-        traverser=PageTraverser(
-            max_depth=int(args['--depth']),
-            disallowed=disallowed,
-        )
-    )
-
-
-def main_replay(replay_file):
-    serialiser = JSONSerialiser()
-    with open(replay_file, 'r') as fh:
-        for line in iter(fh):
-            yield serialiser.load_page(line)
-
-
-def fetch_robots_txt(url, session=None):
-    """fetch_robots_txt collects robots.txt from the site of the given URL."""
-    robots = (session or requests).get(urljoin(url, '/robots.txt'))
-    robots.raise_for_status()
-    return robots.text
-
-
-def parse_crawl_delay(agent, txt):
-    """parse_crawl_delay reads the Crawl-Delay config from robots.txt.
-    TODO: Take the user-agent into consideration.
-    """
-    try:
-        return float(
-            re.search(r'^\s*Crawl-Delay:\s*([\d\.]+)', txt, re.I | re.M)
-            .group(1)
-        )
-    except AttributeError:
-        return 0
-
-
-def parse_disallowed(agent, txt):
-    try:
-        return re.findall(r'^Disallow:\s*(\S+)', txt, re.I | re.M)
-    except AttributeError:
-        pass
+            from gevent import monkey
+        except ImportError:
+            raise SystemExit('The async engine requires gevent to be '
+                             'installed.')
+        monkey.patch_all()
+
+    from crul.cli import run
+    run(args)
 
 
 if __name__ == '__main__':
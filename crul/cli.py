@@ -0,0 +1,377 @@
+"""
+Running crul, given the options parsed from the usage in crul.__main__.
+"""
+import logging
+import os
+from itertools import chain
+from urlparse import urljoin
+
+from crul import green
+from crul.dedupe import ContentIndex
+from crul.metrics import Metrics, MetricsReporter
+from crul.output import (
+    SitemapSink, output_dot, output_graph_report, output_json,
+    output_parallel_replay, output_records, output_sitemap, output_text,
+)
+from crul.parse import PageParser, ProcessPageParser
+from crul.recrawl import PreviousCrawl
+from crul.replay import RecordReader, is_records, read_pages
+from crul.retry import RetryPolicy
+from crul.robots import RobotsCache
+from crul.schedule import (
+    AdaptiveThrottle, HostScheduler, PriorityFrontier, UrlScorer,
+    parse_url_weight,
+)
+from crul.scrape import Fetcher, crawl_session, site_crawl
+from crul.seen import FingerprintSet, ScalableBloomFilter, seen_stats
+from crul.sink import BackgroundWriter, FileSink
+from crul.sitemap import sitemap_tasks
+from crul.state import CrawlState, SpillQueue
+from crul.traverse import PageTraverser
+from crul.urls import UrlNormalizer
+
+
+def run(args):
+    """run runs crul, given the options parsed from its usage."""
+    crawling = bool(args['<url>'] or args['--seeds-file'])
+
+    if crawling and args['--engine'] not in ('threaded', 'async'):
+        raise SystemExit('Unknown engine: %s' % args['--engine'])
+    if args['--seen'] not in ('set', 'fingerprint', 'bloom'):
+        raise SystemExit('Unknown seen store: %s' % args['--seen'])
+    if args['--engine'] == 'async' and args['--state-dir']:
+        raise SystemExit('--state-dir is not supported by the async engine.')
+    if args['--state-dir'] and (len(args['<url>']) > 1 or args['--seeds-file']):
+        raise SystemExit('--state-dir is not supported across many sites.')
+    if crawling and args['--frontier'] not in ('fifo', 'priority'):
+        raise SystemExit('Unknown frontier: %s' % args['--frontier'])
+    if args['--frontier'] == 'priority' and (
+            args['--state-dir'] or len(args['<url>']) > 1 or
+            args['--seeds-file']):
+        raise SystemExit('--frontier=priority is supported only for a single '
+                         'site, without --state-dir.')
+    if args['--dedupe'] not in (None, 'exact', 'near'):
+        raise SystemExit('Unknown dedupe mode: %s' % args['--dedupe'])
+    if args['--overflow'] not in (None, 'spill', 'drop'):
+        raise SystemExit('Unknown overflow policy: %s' % args['--overflow'])
+    if args['--overflow'] == 'spill' and (
+            args['--frontier'] == 'priority' or len(args['<url>']) > 1 or
+            args['--seeds-file']):
+        raise SystemExit('--overflow=spill requires the fifo frontier of a '
+                         'single site.')
+    if args['--replay-url'] and not is_records(args['--replay']):
+        raise SystemExit('--replay-url requires a binary records file.')
+    if (args['--shard-bytes'] or args['--shard-pages']) and (
+            not args['--output'] or args['--dot'] or args['--graph'] or
+            args['--records']):
+        raise SystemExit('Only --json, --text and --sitemap --output can be '
+                         'sharded.')
+
+    # Configure logging.
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    log_fmt = logging.Formatter(
+        '%(asctime)s %(threadName)s %(name)s %(levelname)s %(message)s'
+    )
+    if args['--quiet'] and not args['--log-file']:
+        logger.addHandler(logging.NullHandler())
+    if not args['--quiet']:
+        log_out = logging.StreamHandler()
+        log_out.setLevel(logging.DEBUG if args['--verbose'] else logging.INFO)
+        log_out.setFormatter(log_fmt)
+        logger.addHandler(log_out)
+    if args['--log-file']:
+        log_file = logging.FileHandler(args['--log-file'])
+        log_file.setLevel(logging.DEBUG)
+        log_file.setFormatter(log_fmt)
+        logger.addHandler(log_file)
+
+    # Replay to JSON or a sitemap in parallel, straight from the file.
+    replay_procs = int(args['--replay-procs'])
+    if args['--replay'] and replay_procs and (args['--json'] or
+                                              args['--sitemap']):
+        first = next(read_pages(args['--replay'], lazy=True), None)
+        out = output_sink(args, first)
+        output_parallel_replay(args['--replay'],
+                               'json' if args['--json'] else 'sitemap',
+                               replay_procs, out)
+        out.close()
+        return
+
+    # Input.
+    if crawling:
+        crawl = main_crawl(args)
+    else:
+        crawl = main_replay(args['--replay'], args['--replay-url'])
+
+    # Output.
+    #
+    # Originally the plan was to generate a graphic of all of the inter-
+    # connected pages, but after playing about with Graphviz for a while I
+    # wasn't able to make anything pretty. This was the motivation for
+    # --replay: I was just going to generate equivalent JSON output in gergle
+    # and pipe through this program. --dot leaves the prettying to you.
+    try:
+        if args['--records']:
+            output_records(crawl, args['--records'],
+                           int(args['--max-complete']))
+            return
+        if args['--dot'] or args['--graph']:
+            # The graph is written once the crawl is over, so it's written
+            # here.
+            with FileSink(args['--output']) as out:
+                if args['--dot']:
+                    output_dot(crawl, out)
+                else:
+                    output_graph_report(crawl, out)
+            return
+
+        first, pages = peek(crawl)
+        out = output_sink(args, first)
+        if args['--json']:
+            output_json(pages, out)
+        elif args['--sitemap']:
+            output_sitemap(pages, out)
+        else:
+            output_text(pages, out)
+        paths = out.close()
+        if paths:
+            logging.info('Wrote %s', ', '.join(paths))
+    finally:
+        # Stop the crawl, and whatever's reporting on it, however the output
+        # ends: e.g. if it fails.
+        crawl.close()
+
+
+def output_sink(args, first=None):
+    """output_sink opens the FileSink (or SitemapSink) to write the --json,
+    --text or --sitemap output to, in the background.
+
+    Args:
+        args: The command line arguments.
+        first: The first page to be written, if there is one, by which the
+            sitemap index URL is found by default.
+    """
+    path = args['--output']
+    max_bytes = args['--shard-bytes'] and int(args['--shard-bytes'])
+    max_pages = args['--shard-pages'] and int(args['--shard-pages'])
+    if args['--sitemap']:
+        url = args['--sitemap-url']
+        if not url and path and first:
+            url = urljoin(first.url or first.canonical_url,
+                          '/' + os.path.basename(path))
+        sink = SitemapSink(path, url=url, max_urls=max_pages,
+                           max_bytes=max_bytes)
+    else:
+        sink = FileSink(path, max_bytes=max_bytes, max_items=max_pages)
+    # The writer's queue is bounded like the crawl's complete queue.
+    return BackgroundWriter(sink, int(args['--max-complete']))
+
+
+def peek(crawl):
+    """peek returns the first page of crawl, or None if there are none, and
+    the crawl with the page put back.
+    """
+    crawl = iter(crawl)
+    for first in crawl:
+        return first, chain([first], crawl)
+    return None, crawl
+
+
+def main_crawl(args):
+    seeds = list(args['<url>'])
+    if args['--seeds-file']:
+        seeds += read_seeds(args['--seeds-file'])
+    if not seeds:
+        raise SystemExit('No URLs to crawl.')
+
+    num_workers = int(args['--concurrency'] if args['--engine'] == 'async'
+                      else args['--workers'])
+    session = crawl_session(
+        args['--user-agent'],
+        num_workers,
+        pool_size=args['--pool-size'] and int(args['--pool-size']),
+        pool_hosts=int(args['--pool-hosts']),
+        keep_alive=not args['--no-keep-alive'],
+        max_retries=int(args['--conn-retry']),
+        timeout=args['--timeout'] and float(args['--timeout']),
+    )
+
+    robots = RobotsCache(
+        session, args['--user-agent'],
+        disallowed=args['--disallow'],
+        delay=float(args['--delay']) if args['--delay'] is not None else None,
+        yolo=args['--yolo'],
+    )
+    if len(seeds) == 1:
+        init_url, site_robots = seeds[0], None
+        disallowed, delay = robots.rules(init_url)
+        logging.debug('Disallowed: %s', disallowed)
+        logging.debug('Delay: %.2f', delay)
+    else:
+        # Each site has its own rules, and the scheduler applies the delays.
+        init_url, site_robots, disallowed, delay = seeds, robots, (), 0
+        robots.prefetch(seeds, num_workers)
+
+    urls = UrlNormalizer(sort_query=args['--sort-query'],
+                         strip_params=args['--strip-param'])
+    parser = PageParser(tag_parser=args['--html-parser'], urls=urls)
+    if int(args['--parse-procs']):
+        # Start the processes before any threads, to fork from a clean state.
+        parser = ProcessPageParser(parser, int(args['--parse-procs']))
+
+    throttle = None
+    if args['--adaptive']:
+        throttle = AdaptiveThrottle(robots.crawl_delay,
+                                    max_concurrency=num_workers)
+
+    frontier = seen = on_seen = scorer = None
+    if site_robots:
+        # Given a throttle, only the tasks of sites ready for them are taken.
+        frontier = HostScheduler(robots.crawl_delay, throttle)
+    if args['--frontier'] == 'priority':
+        try:
+            patterns = map(parse_url_weight, args['--url-weight'])
+        except ValueError as e:
+            raise SystemExit(str(e))
+        scorer = UrlScorer(patterns=patterns)
+        frontier = PriorityFrontier(scorer)
+        on_seen = frontier.note_link
+    if args['--state-dir']:
+        state = CrawlState(args['--state-dir'])
+        frontier, seen = state.frontier(), state.seen
+        logging.info('Resuming from %s: %d pending, %d seen.',
+                     args['--state-dir'], frontier.qsize(), len(seen))
+    elif args['--seen'] == 'fingerprint':
+        seen = FingerprintSet()
+    elif args['--seen'] == 'bloom':
+        seen = ScalableBloomFilter(error_rate=float(args['--seen-error']))
+
+    max_pending = args['--max-pending'] and int(args['--max-pending'])
+    overflow = args['--overflow'] or (
+        'spill' if frontier is None or args['--state-dir'] else 'drop')
+    if overflow == 'spill':
+        if max_pending and frontier is None:
+            frontier = SpillQueue(max_pending)
+        # The tasks beyond max_pending are on disk, rather than dropped.
+        max_pending = None
+
+    metrics = Metrics()
+    if isinstance(frontier, SpillQueue):
+        metrics.gauge('spilled', lambda: frontier.spilled)
+    fetcher = Fetcher(
+        session, parser.looks_like_html,
+        max_body_bytes=args['--max-body-bytes'] and int(args['--max-body-bytes']),
+        head_unknown=args['--head-unknown'],
+        metrics=metrics,
+    )
+
+    since = None
+    if args['--since']:
+        since = PreviousCrawl.load(args['--since'])
+        logging.info('Requesting %d pages conditionally.', len(since))
+
+    traverser = PageTraverser(
+        max_depth=int(args['--depth']),
+        disallowed=disallowed,
+        seen=seen,
+        robots=site_robots,
+        metrics=metrics,
+        on_seen=on_seen,
+        urls=urls,
+        max_pending=max_pending,
+    )
+    max_pages = args['--max-pages'] and int(args['--max-pages'])
+    retry = RetryPolicy(retries=int(args['--retries']),
+                        delay=float(args['--retry-delay']))
+    dedupe = None
+    if args['--dedupe']:
+        dedupe = ContentIndex(near=args['--dedupe'] == 'near')
+    sitemap_seeds = None
+    if args['--from-sitemap']:
+        sitemap_seeds = sitemap_tasks(seeds, session, traverser,
+                                      hint=scorer and scorer.hint)
+
+    if args['--engine'] == 'async':
+        crawl = green.site_crawl(
+            fetcher, init_url, num_workers, delay,
+            parser=parser, traverser=traverser, frontier=frontier,
+            since=since, metrics=metrics, max_pages=max_pages,
+            seeds=sitemap_seeds, throttle=throttle, retry=retry,
+            max_complete=int(args['--max-complete']), dedupe=dedupe,
+        )
+    else:
+        crawl = site_crawl(
+            fetcher, init_url, num_workers, delay,
+            parser=parser, traverser=traverser, frontier=frontier,
+            since=since, metrics=metrics, max_pages=max_pages,
+            seeds=sitemap_seeds, throttle=throttle, retry=retry,
+            max_complete=int(args['--max-complete']), dedupe=dedupe,
+        )
+
+    interval = float(args['--progress'])
+    reporter = MetricsReporter(
+        metrics, interval=interval or 10, progress=bool(interval),
+        metrics_file=args['--metrics-file'] and open(args['--metrics-file'], 'a'),
+    )
+    if interval or args['--metrics-file']:
+        reporter.start()
+    return report_crawl(crawl, traverser.seen, fetcher, reporter,
+                        summary=args['--stats'], parser=parser)
+
+
+def report_crawl(crawl, seen, fetcher, reporter, summary=False, parser=None):
+    """report_crawl logs the size of the seen-set and the amount downloaded
+    once the crawl is over, and stops the metrics reporter (and the parser's
+    processes, if it has any): even if the crawl fails, or isn't consumed to
+    the end.
+    """
+    try:
+        for page in crawl:
+            yield page
+    finally:
+        reporter.stop(summary=summary)
+        if isinstance(parser, ProcessPageParser):
+            # Rather than leave the pool to be torn down at exit.
+            parser.close()
+
+    stats = fetcher.stats()
+    logging.info(
+        'Downloaded %d bytes; skipped %d bodies (%d bytes known) and '
+        'truncated %d; made %d HEAD requests.', stats['bytes_read'],
+        stats['bodies_skipped'], stats['bytes_skipped'],
+        stats['bodies_truncated'], stats['heads'],
+    )
+
+    peaks = reporter.metrics.snapshot()['peaks']
+    logging.info('Most pages pending: %d; waiting to be output: %d.',
+                 peaks.get('pending', 0), peaks.get('complete', 0))
+
+    stats = seen_stats(seen)
+    logging.info(
+        'Seen %d URLs (memory: %s, fill: %s)', stats['count'],
+        '%d bytes' % stats['memory'] if 'memory' in stats else 'n/a',
+        '%.1f%%' % (100 * stats['fill']) if 'fill' in stats else 'n/a',
+    )
+
+
+def main_replay(replay_file, urls=()):
+    # Decode the parts of each page only as the output needs them.
+    if not urls:
+        for page in read_pages(replay_file, lazy=True):
+            yield page
+        return
+
+    with RecordReader(replay_file, lazy=True) as reader:
+        for page in reader.pages(urls):
+            yield page
+
+
+def read_seeds(seeds_file):
+    """read_seeds lists the URLs in seeds_file, ignoring blanks and #comments."""
+    with open(seeds_file, 'r') as fh:
+        return [
+            line.strip() for line in fh
+            if line.strip() and not line.lstrip().startswith('#')
+        ]
+
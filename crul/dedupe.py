@@ -0,0 +1,145 @@
+"""
+Detecting pages whose content duplicates, or nearly duplicates, a page
+already crawled: the same page under a session ID, tracking parameter or
+print view, say.
+
+A page is an exact duplicate when its body hashes the same. It's a near
+duplicate when the SimHash of the words of its text differs in no more than a
+few of its 64 bits. Duplicates are recognised before they're parsed, so
+neither the parsing nor the following of their links is repeated.
+"""
+import hashlib
+import re
+import threading
+from collections import defaultdict
+from itertools import izip
+
+from crul import Page
+
+MASK = (1 << 64) - 1
+
+#: markup_pattern matches scripts, styles and tags, leaving the text.
+markup_pattern = re.compile(
+    br'<script\b.*?</script\s*>|<style\b.*?</style\s*>|<!--.*?-->|<[^>]*>',
+    re.I | re.S,
+)
+word_pattern = re.compile(br'\w+')
+
+
+def page_words(content):
+    """page_words lists the (lowercased) words of the text of an HTML body."""
+    return word_pattern.findall(markup_pattern.sub(b' ', content).lower())
+
+
+def simhash(features):
+    """simhash computes the 64-bit SimHash of a set of hashable features:
+    each bit is set if it's set in the hash of most of the features. Similar
+    sets of features have fingerprints which differ in few bits.
+    """
+    hashes = [hash(f) & MASK for f in features]
+    fingerprint = 0
+    # Count the bits a byte at a time, rather than a bit at a time.
+    for byte in xrange(8):
+        counts = defaultdict(int)
+        for h in hashes:
+            counts[(h >> (8 * byte)) & 0xff] += 1
+        for bit in xrange(8):
+            ones = sum(n for value, n in counts.iteritems()
+                       if value >> bit & 1)
+            if 2 * ones > len(hashes):
+                fingerprint |= 1 << (8 * byte + bit)
+    return fingerprint
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class ContentIndex(object):
+    """ContentIndex remembers the content of the pages crawled, to tell which
+    pages duplicate one already seen.
+
+    Near duplicates are found by splitting each fingerprint into
+    max_distance + 1 bands: any fingerprint within max_distance bits of
+    another shares at least one band with it, so only the fingerprints
+    sharing a band need be compared.
+
+    Args:
+        near: Whether to find near duplicates, besides exact ones.
+        max_distance: The most bits in which near duplicates' fingerprints
+            differ.
+        min_words: The fewest words a page needs to be compared for near
+            duplicates, below which there's too little text to tell.
+        shingle: The number of consecutive words in each feature.
+    """
+    def __init__(self, near=True, max_distance=3, min_words=50, shingle=3):
+        self.near = near
+        self.max_distance = max_distance
+        self.min_words = min_words
+        self.shingle = shingle
+        self.num_bands = max_distance + 1
+        self.band_bits = 64 // self.num_bands
+        self.lock = threading.Lock()
+        self.digests = {}
+        self.bands = [defaultdict(list) for _ in xrange(self.num_bands)]
+
+    def check(self, url, content):
+        """check returns the (url, "exact" or "near") of the page which the
+        content of url duplicates, or else None, remembering the content as
+        url's.
+        """
+        if not content:
+            return None
+        digest = hashlib.md5(content).digest()
+        fingerprint = self.fingerprint(content) if self.near else None
+        with self.lock:
+            original = self.digests.get(digest)
+            if original is not None:
+                return original, 'exact'
+            self.digests[digest] = url
+            if fingerprint is None:
+                return None
+            original = self.find_near(fingerprint)
+            if original is not None:
+                return original, 'near'
+            for band, key in zip(self.bands, self.band_keys(fingerprint)):
+                band[key].append((fingerprint, url))
+        return None
+
+    def fingerprint(self, content):
+        """fingerprint returns the SimHash of the words of content, or None if
+        it has too few words.
+        """
+        words = page_words(content)
+        if len(words) < self.min_words:
+            return None
+        n = self.shingle
+        return simhash(set(izip(*[words[i:] for i in xrange(n)])))
+
+    def band_keys(self, fingerprint):
+        mask = (1 << self.band_bits) - 1
+        return [(fingerprint >> (i * self.band_bits)) & mask
+                for i in xrange(self.num_bands)]
+
+    def find_near(self, fingerprint):
+        for band, key in zip(self.bands, self.band_keys(fingerprint)):
+            for other, url in band.get(key, ()):
+                if hamming(fingerprint, other) <= self.max_distance:
+                    return url
+        return None
+
+    def __len__(self):
+        return len(self.digests)
+
+
+def duplicate_page(resp, depth, original):
+    """duplicate_page is the Page recorded, unparsed, for a response whose
+    content duplicates that of the page at original: as if it were marked
+    noindex, with original as its canonical URL.
+    """
+    return Page(
+        url=resp.request.url, canonical_url=original, fetched=True,
+        headers=resp.headers, no_index=True, links=[], assets=[],
+        title=None, depth=depth, status=resp.status_code,
+        duplicate_of=original,
+    )
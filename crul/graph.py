@@ -0,0 +1,239 @@
+"""
+Analysis of the graph of links between the pages of a crawl.
+
+Each URL is given an integer ID as it's first seen, and links are collected
+as pairs of IDs in flat arrays. Once the crawl is over, these are compressed
+into a sparse row (CSR) adjacency structure of NumPy arrays: the targets of
+the links from node i are indices[indptr[i]:indptr[i + 1]]. The analyses
+(in-degree, PageRank, click depth) are then vectorised over the whole graph.
+"""
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from crul.traverse import trim_fragment
+
+
+class LinkGraph(object):
+    """LinkGraph collects the links between pages as they're crawled or
+    replayed, and analyses the graph they make.
+    """
+    def __init__(self):
+        if np is None:
+            raise RuntimeError('Link graph analysis requires numpy to be '
+                               'installed.')
+        self.ids = {}
+        self.urls = []
+        self.src = array('i')
+        self.dst = array('i')
+        #: crawled and status describe the page at each node, if it was
+        #: crawled; roots are the nodes at which the crawl started.
+        self.crawled = array('b')
+        self.status = array('h')
+        self.roots = []
+        self.csr = None
+
+    def node(self, url):
+        if '#' in url:
+            url = trim_fragment(url)
+        id = self.ids.get(url)
+        if id is None:
+            id = self.ids[url] = len(self.urls)
+            self.urls.append(url)
+            self.crawled.append(0)
+            self.status.append(0)
+        return id
+
+    def add_page(self, page):
+        src = self.node(page.url)
+        self.crawled[src] = 1
+        self.status[src] = page.status or 0
+        if page.depth == 0:
+            self.roots.append(src)
+        ids, node = self.ids, self.node
+        targets = [ids.get(link.href) for link in page.links or ()]
+        for i, link in enumerate(page.links or ()):
+            if targets[i] is None:
+                targets[i] = node(link.href)
+        self.src.extend([src] * len(targets))
+        self.dst.extend(targets)
+        self.csr = None
+
+    def add_pages(self, pages):
+        for page in pages:
+            self.add_page(page)
+        return self
+
+    def __len__(self):
+        return len(self.urls)
+
+    def adjacency(self):
+        """adjacency returns the (indptr, indices) of the graph in CSR form,
+        without duplicate links or links from a page to itself.
+        """
+        if self.csr is None:
+            n = len(self.urls)
+            src = np.frombuffer(self.src, dtype=np.int32).astype(np.int64)
+            dst = np.frombuffer(self.dst, dtype=np.int32).astype(np.int64)
+            keep = src != dst
+            # Sorting the unique edge keys sorts the edges by source.
+            edges = np.unique(src[keep] * n + dst[keep])
+            indptr = np.zeros(n + 1, dtype=np.int64)
+            np.cumsum(np.bincount(edges // n, minlength=n), out=indptr[1:])
+            self.csr = indptr, (edges % n).astype(np.int32)
+        return self.csr
+
+    def num_links(self):
+        return len(self.adjacency()[1])
+
+    def in_degree(self):
+        indptr, indices = self.adjacency()
+        return np.bincount(indices, minlength=len(self.urls))
+
+    def out_degree(self):
+        return np.diff(self.adjacency()[0])
+
+    def pagerank(self, damping=0.85, tolerance=1e-8, max_iterations=100):
+        """pagerank computes the PageRank of each node by power iteration.
+        The rank of nodes without any links (i.e. those not crawled) is shared
+        evenly between all of the nodes.
+        """
+        indptr, indices = self.adjacency()
+        n = len(self.urls)
+        if not n:
+            return np.zeros(0)
+        out_degree = np.diff(indptr)
+        sources = np.repeat(np.arange(n), out_degree)
+        dangling = out_degree == 0
+        weight = np.zeros(n)
+        weight[~dangling] = 1.0 / out_degree[~dangling]
+
+        rank = np.full(n, 1.0 / n)
+        for _ in xrange(max_iterations):
+            spread = np.bincount(indices, weights=(rank * weight)[sources],
+                                 minlength=n)
+            new = ((1 - damping) + damping * rank[dangling].sum()) / n
+            new = new + damping * spread
+            converged = np.abs(new - rank).sum() < tolerance
+            rank = new
+            if converged:
+                break
+        return rank
+
+    def click_depth(self, roots=None):
+        """click_depth returns the fewest links to follow from any of the
+        roots (by default, those pages at depth 0) to reach each node, or -1
+        where it can't be reached.
+        """
+        indptr, indices = self.adjacency()
+        depth = np.full(len(self.urls), -1, dtype=np.int32)
+        frontier = np.unique(np.asarray(
+            self.roots if roots is None else [self.ids[r] for r in roots],
+            dtype=np.int64,
+        ))
+        level = 0
+        while len(frontier):
+            depth[frontier] = level
+            # Gather the links from every node of the frontier at once.
+            starts, lengths = indptr[frontier], np.diff(indptr)[frontier]
+            offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+            targets = indices[np.arange(lengths.sum()) + offsets]
+            frontier = np.unique(targets[depth[targets] < 0])
+            level += 1
+        return depth
+
+    def orphans(self):
+        """orphans lists the crawled pages, other than the roots, which no
+        other crawled page links to.
+        """
+        crawled = np.frombuffer(self.crawled, dtype=np.int8).astype(bool)
+        orphaned = crawled & (self.in_degree() == 0)
+        orphaned[self.roots] = False
+        return [self.urls[i] for i in np.flatnonzero(orphaned)]
+
+    def broken_links(self):
+        """broken_links lists the (status, from, to) of the links to pages
+        which responded with an error.
+        """
+        indptr, indices = self.adjacency()
+        status = np.frombuffer(self.status, dtype=np.int16)
+        sources = np.repeat(np.arange(len(self.urls)), np.diff(indptr))
+        broken = np.flatnonzero(status[indices] >= 400)
+        return [
+            (int(status[indices[e]]), self.urls[sources[e]],
+             self.urls[indices[e]])
+            for e in broken
+        ]
+
+    def crawled_nodes(self):
+        return np.flatnonzero(np.frombuffer(self.crawled, dtype=np.int8))
+
+
+def write_dot(graph, out):
+    """write_dot writes the links between the crawled pages of graph in
+    Graphviz's dot language, marking those pages which errored in red.
+    """
+    indptr, indices = graph.adjacency()
+    crawled = np.frombuffer(graph.crawled, dtype=np.int8).astype(bool)
+    status = np.frombuffer(graph.status, dtype=np.int16)
+    out.write('digraph crawl {\n')
+    for i in graph.crawled_nodes():
+        out.write('  n%d [label="%s"%s];\n' % (
+            i, dot_escape(graph.urls[i]),
+            ', color=red' if status[i] >= 400 else '',
+        ))
+    for i in graph.crawled_nodes():
+        targets = indices[indptr[i]:indptr[i + 1]]
+        for j in targets[crawled[targets]]:
+            out.write('  n%d -> n%d;\n' % (i, j))
+    out.write('}\n')
+
+
+def dot_escape(s):
+    return utf8(s).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def utf8(s):
+    return s.encode('utf-8') if isinstance(s, unicode) else s
+
+
+def write_report(graph, out, top=20):
+    """write_report writes a summary of the link graph: the pages with the
+    highest PageRank, the distribution of click depths, orphaned pages and
+    broken links.
+    """
+    crawled = graph.crawled_nodes()
+    rank, in_degree = graph.pagerank(), graph.in_degree()
+    depth = graph.click_depth()
+    # The URLs may be unicode or UTF-8 encoded, depending on where they were
+    # read from: the report is written in UTF-8 bytes throughout.
+    lines = ['%d pages crawled, %d URLs, %d links.' % (
+        len(crawled), len(graph), graph.num_links(),
+    )]
+
+    lines += ['', 'Top pages by PageRank:',
+              '  %8s %9s %5s  %s' % ('pagerank', 'in-degree', 'depth', 'url')]
+    for i in crawled[np.argsort(-rank[crawled], kind='mergesort')][:top]:
+        lines.append('  %8.6f %9d %5d  %s' % (rank[i], in_degree[i], depth[i],
+                                             utf8(graph.urls[i])))
+
+    lines += ['', 'Click depth:']
+    depths = np.bincount(depth[crawled] + 1)
+    for d, count in enumerate(depths):
+        if count:
+            lines.append('  %-11s %d pages' % (d - 1 if d else 'unreachable',
+                                               count))
+
+    orphans = graph.orphans()
+    lines += ['', 'Orphaned pages (%d):' % len(orphans)]
+    lines += ['  %s' % utf8(url) for url in orphans]
+
+    broken = graph.broken_links()
+    lines += ['', 'Broken links (%d):' % len(broken)]
+    lines += ['  %d %s -> %s' % (status, utf8(source), utf8(target))
+              for status, source, target in broken]
+
+    out.write('\n'.join(lines) + '\n')
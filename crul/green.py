@@ -0,0 +1,216 @@
+"""
+An event-driven alternative to crul.scrape.site_crawl, built on gevent.
+
+Rather than dedicating an OS thread to each in-flight request, requests are
+made from greenlets sharing a single event loop, so hundreds of requests can
+be in flight at once. The number of requests in flight is bounded by a
+gevent.pool.Pool.
+"""
+import logging
+from functools import partial
+
+try:
+    import gevent
+    from gevent import monkey
+    from gevent.pool import Group, Pool
+    from gevent.queue import JoinableQueue, Queue
+except ImportError:
+    gevent = None
+
+from crul.metrics import Metrics
+from crul.retry import RetryQueue
+from crul.scrape import PageBudget, queue_throttles, worker_request
+
+
+def patch():
+    """patch makes the standard library cooperative so that blocking socket
+    operations (i.e. those made by requests) yield to the event loop. It must
+    be called before any connections are made.
+    """
+    if gevent is None:
+        raise RuntimeError('The async engine requires gevent to be installed.')
+    monkey.patch_all()
+
+
+def site_crawl(session, init_url, concurrency, delay, parser, traverser,
+               frontier=None, since=None, metrics=None, max_pages=None,
+               seeds=None, throttle=None, retry=None, max_complete=None,
+               dedupe=None):
+    """
+    Args:
+        session: A requests.Session HTTP client, or a Fetcher.
+        init_url: The first URL to request on the target site, or a list of
+            the first URLs to request on each of the target sites.
+        concurrency: The maximum number of requests in flight at once.
+        delay: The number of seconds between each request to the target site.
+        parser: Parses the http response for content, links, etc. (PageParser)
+        traverser: The utility for queueing newly discovered links. (PageTraverser)
+        frontier: The Queue holding pending tasks. (Default: an empty
+            JoinableQueue)
+        since: The pages of a previous crawl to request conditionally, and
+            reuse if not modified. (PreviousCrawl)
+        metrics: Collects timings of each stage of the crawl. (Metrics)
+        max_pages: The most pages to request, after which the remaining tasks
+            are dropped. (Default: no limit)
+        seeds: Further Tasks to queue after init_url, e.g. from sitemaps. They
+            are queued as they're iterated, whilst the crawl gets going.
+        throttle: Adapts the rate of requests to each site to its responses,
+            in place of the fixed delay. (AdaptiveThrottle)
+        retry: Decides which failed requests to retry, and when; the rest are
+            yielded as Pages with an error. (RetryPolicy, default: none are
+            retried)
+        max_complete: The most pages to hold until they're consumed, beyond
+            which the workers wait before fetching more. (Default: no limit)
+        dedupe: Recognises pages whose content duplicates another's, which
+            are yielded unparsed, without following their links.
+            (ContentIndex)
+
+    Yields:
+        Each Page encountered.
+    """
+    if gevent is None:
+        raise RuntimeError('The async engine requires gevent to be installed.')
+    if concurrency < 1:
+        raise ValueError('concurrency >= 1')
+
+    logging.info('Starting async crawl of %s (delay: %0.2fs, concurrency: %d)',
+                 init_url, delay, concurrency)
+
+    #: complete is the queue to which results are sent.
+    complete = Queue(max_complete or None)
+    complete_sentinel = {}
+    work_sentinel = {}
+
+    #: pending is the pages we have identified that we are interested in.
+    pending = JoinableQueue() if frontier is None else frontier
+
+    if metrics is None:
+        metrics = Metrics()
+    metrics.gauge('pending', pending.qsize)
+    metrics.gauge('complete', complete.qsize)
+    metrics.gauge('workers', lambda: concurrency)
+
+    #: retries holds the failed tasks until they're due to be retried.
+    retries = None
+    if retry is not None:
+        retries = GreenRetryQueue(pending, retry, metrics).start()
+        metrics.gauge('retrying', retries.qsize)
+
+    #: workfn takes a task description and fetches the remote content,
+    #: enqueuing any additional pages we should look at.
+    workfn = partial(worker_request, parser.parse,
+                     partial(traverser.follow, pending), session, since=since,
+                     metrics=metrics, throttle=throttle, retries=retries,
+                     dedupe=dedupe)
+
+    # Queue some work.
+    for url in [init_url] if isinstance(init_url, basestring) else init_url:
+        traverser.queue_url(pending, url)
+
+    # Start handing tasks out to the pool, and wait for them to complete.
+    dispatcher = gevent.spawn(
+        dispatch, workfn, pending, complete, Pool(concurrency), delay,
+        work_sentinel, metrics, PageBudget(max_pages), throttle
+    )
+    seeder = gevent.spawn(traverser.queue_tasks, pending, seeds or ())
+    sentinel = gevent.spawn(
+        dispatch_sentinel, pending, complete, work_sentinel, complete_sentinel,
+        seeder, retries
+    )
+
+    # Return an iterator over the complete items.
+    try:
+        for result in iter(complete.get, complete_sentinel):
+            if isinstance(result, Exception):
+                # Forward exceptions from the greenlets to the caller.
+                raise result
+            else:
+                yield result
+        if throttle:
+            throttle.log_rates()
+    finally:
+        gevent.killall([dispatcher, seeder, sentinel])
+        if retries is not None:
+            retries.group.kill()
+
+
+def dispatch_sentinel(pending, complete, work_sentinel, complete_sentinel,
+                      seeder=None, retries=None):
+    logging.debug('Awaiting all work to complete.')
+    if seeder:
+        # Tasks are still to come whilst seeds are being queued.
+        seeder.join()
+    if retries is not None:
+        # Tasks are still to come whilst failed ones are waiting to be retried.
+        retries.join_all()
+    else:
+        pending.join()
+
+    logging.debug('Sending kill signals.')
+    pending.put(work_sentinel)
+    complete.put(complete_sentinel)
+
+
+def dispatch(workfn, pending, complete, pool, delay, kill_signal, metrics,
+             budget=None, throttle=None):
+    """dispatch starts a greenlet in the pool for each pending task. Spawning
+    blocks whilst the pool is full, bounding the number of requests in flight,
+    and we wait delay seconds between starting each request -- or, given a
+    throttle, until it allows another request to the task's site. A pending
+    queue which acquires the throttle itself (i.e. a HostScheduler) hands out
+    only the tasks whose sites are ready, so that one site's throttle doesn't
+    hold up the others'.
+    """
+    logging.debug('Dispatcher started.')
+    throttled = queue_throttles(pending, throttle)
+    for task in iter(pending.get, kill_signal):
+        if budget and not budget.take(task, metrics):
+            if throttled:
+                throttle.release(task.url)
+            pending.task_done()
+            continue
+        if throttle and not throttled:
+            with metrics.timer('throttle'):
+                throttle.acquire(task.url)
+        pool.spawn(request, workfn, task, pending, complete, metrics,
+                   throttle)
+        if delay and not throttle:
+            gevent.sleep(delay)
+    pool.join()
+    logging.debug('Dispatcher stopped.')
+
+
+def request(workfn, task, pending, complete, metrics, throttle=None):
+    try:
+        with metrics.timer('task'):
+            page = workfn(task)
+        if page is not None:
+            # Waits whilst the consumer is behind, if complete is bounded.
+            with metrics.timer('backpressure'):
+                complete.put(page)
+            metrics.peak('complete', complete.qsize())
+    except Exception as e:
+        logging.exception('Request errored whilst processing %r', task)
+        complete.put(e)
+    finally:
+        if throttle:
+            throttle.release(task.url)
+        pending.task_done()
+
+
+class GreenRetryQueue(RetryQueue):
+    """GreenRetryQueue is a RetryQueue which puts each task back on the
+    pending queue from a greenlet started for it, rather than from a thread.
+    """
+    def start(self):
+        self.group = Group()
+        return self
+
+    def schedule(self, wait, task):
+        self.group.add(gevent.spawn_later(wait, self.pending.put, task))
+
+    def __len__(self):
+        return len(self.group)
+
+    def join(self):
+        self.group.join()
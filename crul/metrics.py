@@ -0,0 +1,201 @@
+"""
+Counters and timers describing where a crawl spends its time.
+"""
+import json
+import logging
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Histogram(object):
+    """Histogram counts observations (i.e. durations in seconds) into buckets
+    with exponentially increasing upper bounds.
+    """
+    bounds = [0.001 * 2 ** i for i in xrange(20)]  # 1ms to ~9m.
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """percentile estimates the pth percentile as the upper bound of the
+        bucket in which it falls.
+        """
+        if not self.count:
+            return 0.0
+        rank, seen = p * self.count, 0
+        for bound, n in zip(self.bounds, self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+class Metrics(object):
+    """Metrics collects the counters and timers of a crawl, gauges which are
+    sampled when a snapshot is taken (e.g. the length of a queue), and peaks:
+    the highest value seen of each (e.g. a queue's high-water mark).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = defaultdict(int)
+        self.timers = defaultdict(Histogram)
+        self.gauges = {}
+        self.peaks = defaultdict(int)
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def add(self, counts):
+        """add increments many counters at once, given a dict of counts."""
+        with self.lock:
+            for name, n in counts.iteritems():
+                self.counters[name] += n
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.timers[name].observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def peak(self, name, value):
+        """peak records value as the peak of name, if it's the highest yet."""
+        if value > self.peaks[name]:
+            with self.lock:
+                self.peaks[name] = max(self.peaks[name], value)
+
+    def gauge(self, name, fn):
+        """gauge registers fn to be called for the value of name."""
+        self.gauges[name] = fn
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {
+                'time': time.time(),
+                'elapsed': time.time() - self.started,
+                'counters': dict(self.counters),
+                'timers': dict((n, h.snapshot()) for n, h in self.timers.items()),
+                'peaks': dict(self.peaks),
+            }
+        snapshot['gauges'] = dict((n, fn()) for n, fn in self.gauges.items())
+        return snapshot
+
+
+def utilisation(snapshot):
+    """utilisation is the fraction of the workers' time spent on tasks."""
+    workers = snapshot['gauges'].get('workers')
+    busy = snapshot['timers'].get('task', {}).get('sum', 0)
+    if not workers or not snapshot['elapsed']:
+        return 0.0
+    return busy / (workers * snapshot['elapsed'])
+
+
+def format_progress(snapshot):
+    fetch = snapshot['timers'].get('fetch', {})
+    pages = snapshot['counters'].get('pages', 0)
+    return (
+        '%d pages (%.1f/s), %d pending, fetch p50 %.3fs p99 %.3fs, '
+        '%.0f%% utilised' % (
+            pages, pages / snapshot['elapsed'] if snapshot['elapsed'] else 0,
+            snapshot['gauges'].get('pending', 0),
+            fetch.get('p50', 0), fetch.get('p99', 0),
+            100 * utilisation(snapshot),
+        )
+    )
+
+
+def format_summary(snapshot):
+    lines = ['Crawl statistics after %.1fs:' % snapshot['elapsed']]
+    lines.append('  Timers:')
+    for name, t in sorted(snapshot['timers'].items()):
+        lines.append(
+            '    %-12s n=%-8d total=%9.3fs mean=%.4fs p50=%.4fs p99=%.4fs '
+            'max=%.4fs' % (name, t['count'], t['sum'], t['mean'], t['p50'],
+                           t['p99'], t['max'])
+        )
+    lines.append('  Counters:')
+    for name, n in sorted(snapshot['counters'].items()):
+        lines.append('    %-28s %d' % (name, n))
+    lines.append('  Gauges:')
+    for name, value in sorted(snapshot['gauges'].items()):
+        lines.append('    %-28s %s' % (name, value))
+    lines.append('  Peaks:')
+    for name, value in sorted(snapshot['peaks'].items()):
+        lines.append('    %-28s %s' % (name, value))
+    lines.append('  Worker utilisation: %.1f%%' % (100 * utilisation(snapshot)))
+    return '\n'.join(lines)
+
+
+class MetricsReporter(object):
+    """MetricsReporter periodically logs a progress line and/or appends a
+    snapshot of the metrics to a JSON-lines file from a background thread.
+    """
+    def __init__(self, metrics, interval=10, progress=True, metrics_file=None):
+        self.metrics = metrics
+        self.interval = interval
+        self.progress = progress
+        self.metrics_file = metrics_file
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(name='Metrics-Reporter', target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        snapshot = self.metrics.snapshot()
+        if self.progress:
+            logging.info('Progress: %s', format_progress(snapshot))
+        if self.metrics_file:
+            self.metrics_file.write(json.dumps(snapshot) + '\n')
+            self.metrics_file.flush()
+        return snapshot
+
+    def stop(self, summary=False):
+        """stop reports once more, prints the summary if asked to, and closes
+        the metrics file.
+        """
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        snapshot = self.report()
+        if self.metrics_file:
+            self.metrics_file.close()
+        if summary:
+            print >>sys.stderr, format_summary(snapshot)
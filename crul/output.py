@@ -1,46 +1,171 @@
+import os
 from cgi import escape as html_escape
 from textwrap import dedent
+from urlparse import urljoin
 
 from crul import JSONSerialiser
+from crul.graph import LinkGraph, write_dot, write_report
+from crul.replay import RecordWriter, parallel_replay
+from crul.sink import BackgroundWriter, FileSink, open_output
 
+# Each of the outputs is written to out, a FileSink (or a BackgroundWriter
+# of one), given a chunk for each page.
 
-def output_text(crawl):
+
+def output_text(crawl, out):
     for n, page in enumerate(crawl):
-        print (
-            u'#{n}: {url}\n'
-            u'  Title: {title}\n'
-            u'  Depth: {depth}\n'
-            u'  Links:\n{links}'
-            u'  Assets:\n{assets}'
-        ).format(
-            n=n,
-            url=page.url or page.canonical_url,
-            title=page.title,
-            depth=page.depth,
-            links=u''.join(
-                u'    - %s\n' % l.href
-                for l in page.links or ()
-            ),
-            assets=u''.join(
-                u'    - %s: %s\n' % (a.type, a.href)
-                for a in page.assets or ()
-            ),
-        ).encode('utf-8')
-
-
-def output_json(crawl):
-    serialiser = JSONSerialiser()
+        out.write(render_text(n, page))
+
+
+def render_text(n, page):
+    return (
+        u'#{n}: {url}\n'
+        u'  Title: {title}\n'
+        u'  Depth: {depth}\n'
+        u'{error}'
+        u'{duplicate}'
+        u'  Links:\n{links}'
+        u'  Assets:\n{assets}'
+    ).format(
+        n=n,
+        url=page.url or page.canonical_url,
+        title=page.title,
+        depth=page.depth,
+        error=u'  Error: %s\n' % page.error if page.error else u'',
+        duplicate=(u'  Duplicate of: %s\n' % page.duplicate_of
+                   if page.duplicate_of else u''),
+        links=u''.join(
+            u'    - %s\n' % l.href
+            for l in page.links or ()
+        ),
+        assets=u''.join(
+            u'    - %s: %s\n' % (a.type, a.href)
+            for a in page.assets or ()
+        ),
+    ).encode('utf-8') + '\n'
+
+
+def output_json(crawl, out):
     for page in crawl:
-        print serialiser.dump_page(page)
+        out.write(render_json(page))
+
+
+def render_json(page):
+    return JSONSerialiser().dump_page(page) + '\n'
+
+
+def output_dot(crawl, out):
+    write_dot(LinkGraph().add_pages(crawl), out)
+
+
+def output_graph_report(crawl, out):
+    write_report(LinkGraph().add_pages(crawl), out)
+
+
+def output_records(crawl, path, max_pending=10000):
+    # The pages are encoded, as well as written, in the background.
+    with BackgroundWriter(RecordWriter(path), max_pending) as writer:
+        for page in crawl:
+            writer.write(page)
 
 
-def output_sitemap(crawl):
-    print dedent('''
-        <?xml version="1.0" encoding="utf-8"?>
-        <urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9"
-           xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
-           xsi:schemaLocation="http://www.sitemaps.org/schemas/sitemap/0.9 http://www.sitemaps.org/schemas/sitemap/0.9/sitemap.xsd">
-    ''').strip()
+SITEMAP_HEADER = dedent('''
+    <?xml version="1.0" encoding="utf-8"?>
+    <urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9"
+       xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+       xsi:schemaLocation="http://www.sitemaps.org/schemas/sitemap/0.9 http://www.sitemaps.org/schemas/sitemap/0.9/sitemap.xsd">
+''').lstrip()
+SITEMAP_FOOTER = '</urlset>\n'
+
+SITEMAP_INDEX_HEADER = dedent('''
+    <?xml version="1.0" encoding="utf-8"?>
+    <sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+''').lstrip()
+SITEMAP_INDEX_FOOTER = '</sitemapindex>\n'
+
+#: SITEMAP_MAX_URLS and SITEMAP_MAX_BYTES are the limits of each sitemap.
+SITEMAP_MAX_URLS = 50000
+SITEMAP_MAX_BYTES = 50 * 1024 * 1024
+
+
+def output_sitemap(crawl, out):
     for page in crawl:
-        print '  <url><loc>%s</loc></url>' % html_escape(page.url or page.canonical_url)
-    print '</urlset>'
+        url = render_sitemap_url(page)
+        if url:
+            out.write(url)
+
+
+def render_sitemap_url(page):
+    if page.duplicate_of:
+        # Only the original of duplicated content is listed.
+        return ''
+    return '  <url><loc>%s</loc></url>\n' % html_escape(page.url or page.canonical_url)
+
+
+class SitemapSink(FileSink):
+    """SitemapSink writes the <url>s of a sitemap to path, within the limits
+    of the sitemap protocol: once there are more than max_urls URLs or
+    max_bytes bytes, they're split into sitemaps numbered by shard_path, and
+    path becomes a sitemap index listing them. Neither limit can be raised
+    above the protocol's.
+
+    Args:
+        path: The file to write the sitemap to, or None for stdout (which
+            can't be split).
+        url: The URL at which path will be published, against which the
+            sitemaps are listed in the index.
+        max_urls: The most URLs in each sitemap. (Default: SITEMAP_MAX_URLS)
+        max_bytes: The most bytes in each sitemap, uncompressed. (Default:
+            SITEMAP_MAX_BYTES)
+    """
+    def __init__(self, path=None, url=None, max_urls=None, max_bytes=None,
+                 **kwargs):
+        if path in (None, '-'):
+            max_urls = max_bytes = None
+        else:
+            max_urls = min(max_urls or SITEMAP_MAX_URLS, SITEMAP_MAX_URLS)
+            max_bytes = min(max_bytes or SITEMAP_MAX_BYTES, SITEMAP_MAX_BYTES)
+        super(SitemapSink, self).__init__(
+            path, max_items=max_urls, max_bytes=max_bytes,
+            header=SITEMAP_HEADER, footer=SITEMAP_FOOTER, **kwargs
+        )
+        self.url = url
+
+    def close(self):
+        paths = super(SitemapSink, self).close()
+        if len(paths) == 1 and paths[0] != self.path:
+            # It all fit in one sitemap.
+            os.rename(paths[0], self.path)
+            return [self.path]
+        if len(paths) > 1:
+            self.write_index(paths)
+            return [self.path] + paths
+        return paths
+
+    def write_index(self, paths):
+        fh = open_output(self.path, self.compression)
+        try:
+            fh.write(SITEMAP_INDEX_HEADER)
+            for path in paths:
+                fh.write('  <sitemap><loc>%s</loc></sitemap>\n' % html_escape(
+                    urljoin(self.url or '', os.path.basename(path))
+                ))
+            fh.write(SITEMAP_INDEX_FOOTER)
+        finally:
+            fh.close()
+
+
+def output_parallel_replay(replay_file, render, processes, out):
+    """output_parallel_replay writes the JSON or sitemap output of replaying
+    replay_file in a pool of processes.
+    """
+    if render == 'json':
+        chunks = parallel_replay(replay_file, render_json, processes)
+    else:
+        # The order of the URLs in a sitemap doesn't matter.
+        chunks = parallel_replay(replay_file, render_sitemap_url, processes,
+                                 ordered=False)
+    for chunk in chunks:
+        # Each page is a line, and the output is sharded by page.
+        for line in chunk.splitlines(True):
+            out.write(line)
@@ -1,15 +1,28 @@
 import re
+from collections import namedtuple
 from itertools import chain
-from urlparse import urljoin, urlparse
+from multiprocessing import Pool
+from urlparse import urljoin
 
 from bs4 import BeautifulSoup
+from lxml import etree
+from requests.compat import chardet
 
 from crul import Page, Link
+from crul.urls import UrlNormalizer
 
 
 class PageParser(object):
-    def __init__(self, tag_parser=None):
+    """
+    Args:
+        tag_parser: The BeautifulSoup tree builder used to parse HTML (e.g.
+            "lxml" or "html.parser"), or "stream" to extract everything in a
+            single pass over the document without building a tree.
+        urls: The UrlNormalizer which resolves links. (Optional)
+    """
+    def __init__(self, tag_parser=None, urls=None):
         self.tag_parser = tag_parser or 'lxml'
+        self.urls = urls or UrlNormalizer()
 
     def parse(self, resp, depth=0):
         if self.looks_like_html(resp):
@@ -19,10 +32,13 @@ class PageParser(object):
                 url=resp.request.url, canonical_url=resp.request.url,
                 headers=resp.headers,
                 fetched=True, title=None, no_index=True, links=[], assets=[],
-                depth=depth,
+                depth=depth, status=resp.status_code,
             )
 
     def parse_html(self, resp, depth=0):
+        if self.tag_parser == 'stream':
+            return self.parse_stream(resp, depth=depth)
+
         soup = BeautifulSoup(resp.text, self.tag_parser)
         base = self.parse_base(resp, soup)
 
@@ -36,6 +52,32 @@ class PageParser(object):
             links=list(set(self.parse_links(resp, soup, base, depth + 1))),
             assets=list(sorted(set(self.parse_assets(resp, soup, base, depth + 1)))),
             depth=depth,
+            status=resp.status_code,
+        )
+
+    def parse_stream(self, resp, depth=0):
+        doc = StreamExtractor.extract(resp.text)
+        base = urljoin(resp.url, doc.base) if doc.base is not None else resp.url
+        local = self.urls.split(resp.url)
+        no_follow = self.has_robots_directive(resp, doc.robots, 'nofollow')
+
+        return Page(
+            url=resp.request.url,
+            fetched=True,
+            headers=resp.headers,
+            canonical_url=self.resolve_canonical_url(resp, base, doc.canonical),
+            title=doc.title,
+            no_index=self.has_robots_directive(resp, doc.robots, 'noindex'),
+            links=list(set(
+                self.anchor_link(resp, base, local, href, rel, no_follow, depth + 1)
+                for href, rel in doc.anchors
+            )),
+            assets=list(sorted(set(
+                self.asset_link(resp, base, local, t, href, depth + 1)
+                for t, href in doc.assets
+            ))),
+            depth=depth,
+            status=resp.status_code,
         )
 
     def looks_like_html(self, resp):
@@ -44,17 +86,28 @@ class PageParser(object):
     def parse_base(self, resp, soup):
         try:
             return urljoin(resp.url, soup.base['href'])
-        except (TypeError, AttributeError):
+        except (TypeError, AttributeError, KeyError):
             return resp.url
 
     def parse_title(self, resp, soup, base):
         try:
-            return soup.title.string
+            title = soup.title.string
+            # Don't hold on to the tree through the NavigableString.
+            return unicode(title) if title is not None else None
         except Exception:
             return None
 
     def parse_canonical_url(self, resp, soup, base):
         canon = None
+        try:
+            if soup:
+                # From the first `<link rel="canonical" href="http://..." />` tag.
+                canon = soup.find('link', rel='canonical')['href']
+        except Exception:
+            pass
+        return self.resolve_canonical_url(resp, base, canon)
+
+    def resolve_canonical_url(self, resp, base, tag_href):
         try:
             # From the first `Link: <http://...>; rel="canonical"` header.
             canon = re.search(r'<([^>]+)>;\s*rel="canonical"', resp.headers['link'], re.IGNORECASE).group(1)
@@ -63,24 +116,29 @@ class PageParser(object):
         except (KeyError, AttributeError):
             pass
 
-        try:
-            if soup:
-                # From the first `<link rel="canonical" href="http://..." />` tag.
-                canon = soup.find('link', rel='canonical').href
-                if canon:
-                    return urljoin(base, canon)
-        except Exception:
-            pass
+        if tag_href:
+            return urljoin(base, tag_href)
 
         # Assume the requested URL is the canonical URL. Potentially problematic
         # where query-strings do not actually change page content.
         return resp.url
 
-    def parse_no_index(self, resp, soup, base):
+    def has_robots_directive(self, resp, robots_content, directive):
+        """has_robots_directive checks the robots meta tag content and the
+        X-Robots-Tag header for the given directive, e.g. noindex.
+        """
+        return bool(
+            (robots_content and directive in robots_content.lower()) or
+            (directive in resp.headers.get('X-Robots-Tag', ''))
+        )
+
+    def parse_robots_meta(self, soup):
         robots_meta = soup and soup.find('meta', attrs={'name': 'robots'})
-        return (
-            (robots_meta and robots_meta['content'] and 'noindex' in robots_meta['content'].lower()) or
-            ('noindex' in resp.headers.get('X-Robots-Tag', ''))
+        return robots_meta.get('content') if robots_meta else None
+
+    def parse_no_index(self, resp, soup, base):
+        return self.has_robots_directive(
+            resp, self.parse_robots_meta(soup), 'noindex'
         )
 
     def parse_links(self, resp, soup, base, depth=1):
@@ -88,38 +146,24 @@ class PageParser(object):
             return
 
         # Check whether all links are nofollow.
-        robots_meta = soup and soup.find('meta', attrs={'name': 'robots'})
-        no_follow = (
-            (robots_meta and robots_meta['content'] and 'nofollow' in robots_meta['content'].lower()) or
-            ('nofollow' in resp.headers.get('X-Robots-Tag', ''))
+        no_follow = self.has_robots_directive(
+            resp, self.parse_robots_meta(soup), 'nofollow'
         )
 
         # Look for anchor and Link elements.
-        local = urlparse(resp.url)
+        local = self.urls.split(resp.url)
         for anch in soup.find_all('a', href=True):
-            href = urlparse(urljoin(base, anch['href']))
-            yield Link(
-                type='anchor',
-                href=href.geturl(),
-                no_follow=no_follow or 'rel' in anch and 'nofollow' in anch['rel'],
-                external=href.netloc != local.netloc or href.scheme != local.scheme,
-                depth=depth,
-                referrer=resp.url,
-            )
+            yield self.anchor_link(resp, base, local, anch['href'],
+                                   anch.get('rel', ()), no_follow, depth)
 
     def parse_assets(self, resp, soup, base, depth=1):
         if not soup:
             return
 
-        local = urlparse(resp.url)
+        local = self.urls.split(resp.url)
 
         def link(t, h):
-            url = urlparse(h)
-            return Link(
-                type=t, href=urljoin(base, url.geturl()), no_follow=False,
-                referrer=resp.url, depth=depth,
-                external=url.netloc != local.netloc or url.scheme != local.scheme,
-            )
+            return self.asset_link(resp, base, local, t, h, depth)
 
         for asset in chain(
                 soup.find_all('script', src=True),
@@ -136,3 +180,165 @@ class PageParser(object):
                 lnk['rel'] if hasattr(lnk['rel'], 'join') else ','.join(lnk['rel']),
                 lnk['href']
             )
+
+    def anchor_link(self, resp, base, local, href, rel, no_follow, depth):
+        href, url = self.urls.resolve(base, href)
+        return Link(
+            type='anchor',
+            href=href,
+            no_follow=no_follow or 'nofollow' in rel,
+            external=url.netloc != local.netloc or url.scheme != local.scheme,
+            depth=depth,
+            referrer=resp.url,
+        )
+
+    def asset_link(self, resp, base, local, type, href, depth):
+        url = self.urls.split(href)
+        return Link(
+            type=type, href=self.urls.resolve(base, href)[0], no_follow=False,
+            referrer=resp.url, depth=depth,
+            external=url.netloc != local.netloc or url.scheme != local.scheme,
+        )
+
+
+class StreamExtractor(object):
+    """StreamExtractor is an lxml parser target which picks out the title,
+    base, canonical, robots meta, links and assets of a document in a single
+    pass over its tags, without building a tree.
+    """
+    #: asset_attrs maps the asset tags to the attribute holding their URL.
+    asset_attrs = {
+        'script': 'src', 'img': 'src', 'embed': 'src', 'audio': 'src',
+        'video': 'src', 'iframe': 'src', 'object': 'data',
+    }
+
+    @classmethod
+    def extract(cls, markup):
+        extractor = cls()
+        parser = etree.HTMLParser(target=extractor)
+        parser.feed(markup)
+        return parser.close()
+
+    def __init__(self):
+        self.base = self.canonical = self.robots = self.title = None
+        self.anchors = []  # [(href, [rel, ...]), ...]
+        self.assets = []  # [(type, href), ...]
+        self._found = set()
+        self._title = None
+
+    def _first(self, what):
+        if what in self._found:
+            return False
+        self._found.add(what)
+        return True
+
+    def start(self, tag, attrib):
+        if tag == 'a':
+            if 'href' in attrib:
+                self.anchors.append(
+                    (attrib['href'], attrib.get('rel', '').split())
+                )
+        elif tag in self.asset_attrs:
+            attr = self.asset_attrs[tag]
+            if attr in attrib:
+                self.assets.append((tag, attrib[attr]))
+        elif tag == 'link':
+            rel = attrib.get('rel')
+            if rel is not None:
+                rel = rel.split()
+                if 'href' in attrib:
+                    self.assets.append((','.join(rel), attrib['href']))
+                if 'canonical' in rel and self._first('canonical'):
+                    self.canonical = attrib.get('href')
+        elif tag == 'meta':
+            if attrib.get('name') == 'robots' and self._first('robots'):
+                self.robots = attrib.get('content')
+        elif tag == 'base':
+            if self._first('base'):
+                self.base = attrib.get('href')
+        elif tag == 'title':
+            if self._first('title'):
+                self._title = []
+
+    def end(self, tag):
+        if tag == 'title' and self._title is not None:
+            self.title = u''.join(self._title) or None
+            self._title = None
+
+    def data(self, data):
+        if self._title is not None:
+            self._title.append(data)
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        if self._title is not None:
+            # An unclosed title.
+            self.end('title')
+        return self
+
+
+FrozenRequest = namedtuple('FrozenRequest', ['url'])
+
+
+class FrozenResponse(object):
+    """FrozenResponse is a picklable snapshot of the parts of a
+    requests.Response that PageParser reads, for sending to another process.
+    """
+    def __init__(self, url, request_url, status_code, headers, content,
+                 encoding=None):
+        self.url = url
+        self.request = FrozenRequest(url=request_url)
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+
+    @classmethod
+    def from_response(cls, resp):
+        return cls(
+            url=resp.url, request_url=resp.request.url,
+            status_code=resp.status_code, headers=resp.headers,
+            content=resp.content, encoding=resp.encoding,
+        )
+
+    @property
+    def text(self):
+        # Like requests, guess the encoding from the content when the headers
+        # don't specify one -- but do it here, away from the fetching thread.
+        encoding = self.encoding or chardet.detect(self.content)['encoding']
+        try:
+            return unicode(self.content, encoding or 'utf-8', errors='replace')
+        except LookupError:
+            return unicode(self.content, 'utf-8', errors='replace')
+
+
+def parse_frozen(parser, resp, depth):
+    return parser.parse(resp, depth=depth)
+
+
+class ProcessPageParser(object):
+    """ProcessPageParser hands HTML responses to a pool of processes running
+    the given parser, so that parsing is not limited by the GIL of the
+    process fetching the pages.
+    """
+    def __init__(self, parser, processes):
+        self.parser = parser
+        self.pool = Pool(processes)
+
+    def looks_like_html(self, resp):
+        return self.parser.looks_like_html(resp)
+
+    def parse(self, resp, depth=0):
+        if not self.parser.looks_like_html(resp):
+            # Not worth the round-trip: there's nothing to parse.
+            return self.parser.parse(resp, depth=depth)
+        return self.pool.apply(
+            parse_frozen,
+            (self.parser, FrozenResponse.from_response(resp), depth)
+        )
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,66 @@
+"""
+Conditional re-crawling of the pages recorded by a previous crawl.
+"""
+import logging
+from email.utils import mktime_tz, parsedate_tz
+
+from crul.replay import read_pages
+
+
+class PreviousCrawl(object):
+    """PreviousCrawl holds the pages of an earlier crawl which carried an ETag
+    or Last-Modified header, so that we can ask the site whether they've
+    changed since, and reuse them if they haven't.
+    """
+    def __init__(self, pages=()):
+        self.pages = {}
+        for page in pages:
+            if page.fetched and self.validators(page):
+                self.pages[page.url] = page
+
+    @classmethod
+    def load(cls, replay_file):
+        return cls(read_pages(replay_file))
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __contains__(self, url):
+        return url in self.pages
+
+    def validators(self, page):
+        headers = {}
+        if page.headers.get('ETag'):
+            headers['If-None-Match'] = page.headers['ETag']
+        if page.headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = page.headers['Last-Modified']
+        return headers
+
+    def request_headers(self, url):
+        """request_headers returns the conditional request headers for url."""
+        page = self.pages.get(url)
+        return self.validators(page) if page else {}
+
+    def unchanged(self, url, lastmod):
+        """unchanged returns whether the previous page at url was fetched
+        after lastmod (e.g. from a sitemap), and so needn't be requested.
+        """
+        page = self.pages.get(url)
+        if page is None or lastmod is None:
+            return False
+        fetched = parsedate_tz(page.headers.get('Date') or '')
+        return fetched is not None and lastmod <= mktime_tz(fetched)
+
+    def not_modified(self, url, depth):
+        """not_modified returns the previous page at url, having been told it
+        has not been modified, at the depth we found it this time.
+        """
+        page = self.pages[url]
+        logging.debug('Reusing %s: not modified.', url)
+        if page.depth == depth:
+            return page
+        return page._replace(
+            depth=depth,
+            links=[l._replace(depth=depth + 1) for l in page.links],
+            assets=[a._replace(depth=depth + 1) for a in page.assets],
+        )
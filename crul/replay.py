@@ -0,0 +1,450 @@
+"""
+Reading back the pages recorded by a crawl.
+
+Besides the JSON lines written by --json, pages can be recorded in a compact
+binary format (--records) which is much quicker to replay. The file begins
+with MAGIC, followed by records each made up of a 4-byte big-endian length
+and a msgpack array:
+
+    [STRINGS, [string, ...]]
+        Appends strings to the file's string table. Written before the first
+        page which refers to them.
+
+    [PAGE, url, canonical_url, fetched, no_index, title, depth, headers,
+     links, assets, status, error, duplicate_of]
+        A page, in which urls, hrefs, link types and header names and values
+        are indexes into the string table, so that the links and referrers
+        repeated across a site are stored once. headers, links and assets are
+        each packed as msgpack within the record, so that reading a page need
+        not decode them until they're used: headers is a flat list of name,
+        value pairs; links and assets are lists of [type, href, no_follow,
+        external, depth, referrer].
+
+Alongside the file, an index (INDEX_SUFFIX) holds the offset of each page by
+URL and of each STRINGS record, so that pages can be looked up by seeking
+straight to them.
+"""
+import json
+import mmap
+import os
+import struct
+from multiprocessing import Pool
+
+from requests.structures import CaseInsensitiveDict
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from crul import JSONSerialiser, Link, Page
+
+MAGIC = 'CRULREC2'
+INDEX_SUFFIX = '.idx'
+STRINGS, PAGE = 0, 1
+
+length_prefix = struct.Struct('>I')
+
+
+def require_msgpack():
+    if msgpack is None:
+        raise RuntimeError('Binary records require msgpack to be installed.')
+
+
+def unpack(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+def is_records(replay_file):
+    """is_records returns whether replay_file is in the binary format."""
+    with open(replay_file, 'rb') as fh:
+        return fh.read(len(MAGIC)) == MAGIC
+
+
+def read_pages(replay_file, lazy=False):
+    """read_pages yields each page recorded in replay_file, whether it was
+    written as JSON lines or binary records. If lazy, the pages are LazyPages.
+    """
+    if is_records(replay_file):
+        with RecordReader(replay_file, lazy=lazy) as reader:
+            for page in reader:
+                yield page
+    else:
+        serialiser = JSONSerialiser()
+        load_page = lazy_json_page if lazy else serialiser.load_page
+        with open(replay_file, 'r') as fh:
+            for line in fh:
+                yield load_page(line)
+
+
+class LazyPage(object):
+    """LazyPage stands in for a Page whose headers, links and assets are
+    decoded when they're first used, so that replaying for output which only
+    needs the URLs (e.g. a sitemap) doesn't pay for building them.
+
+    Args:
+        loaders: A function returning the value of each field not given.
+        **fields: The fields of the Page which are known already.
+    """
+    _fields = Page._fields
+
+    def __init__(self, loaders, **fields):
+        self._loaders = loaders
+        self.__dict__.update(fields)
+
+    def __getattr__(self, name):
+        loader = self.__dict__.get('_loaders', {}).get(name)
+        if loader is None:
+            raise AttributeError(name)
+        value = loader()
+        setattr(self, name, value)
+        return value
+
+    def _asdict(self):
+        return self.page()._asdict()
+
+    def _replace(self, **fields):
+        return self.page()._replace(**fields)
+
+    def page(self):
+        """page returns the Page, with every field decoded."""
+        return Page(**dict((f, getattr(self, f)) for f in self._fields))
+
+    def __eq__(self, other):
+        return self.page() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'LazyPage(url=%r)' % self.url
+
+
+def lazy_json_page(source):
+    """lazy_json_page loads a JSON page, leaving its headers, links and assets
+    as dicts until they're used.
+    """
+    serialiser = JSONSerialiser()
+    p = json.loads(source)
+    p.setdefault('status', None)
+    p.setdefault('error', None)
+    p.setdefault('duplicate_of', None)
+    headers, links, assets = (p.pop('headers', {}), p.pop('links', ()),
+                              p.pop('assets', ()))
+    return LazyPage({
+        'headers': lambda: CaseInsensitiveDict(headers),
+        'links': lambda: [serialiser.dict_to_link(l) for l in links],
+        'assets': lambda: [serialiser.dict_to_link(l) for l in assets],
+    }, **p)
+
+
+class RecordWriter(object):
+    """RecordWriter writes pages to path in the binary record format, and
+    their index to path + INDEX_SUFFIX when closed.
+    """
+    def __init__(self, path):
+        require_msgpack()
+        self.path = path
+        self.fh = open(path, 'wb')
+        self.fh.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.packer = msgpack.Packer(use_bin_type=True)
+        self.strings = {}
+        self.new_strings = []
+        self.page_offsets = []
+        self.string_offsets = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def intern(self, s):
+        if s is None:
+            return None
+        ref = self.strings.get(s)
+        if ref is None:
+            ref = self.strings[s] = len(self.strings)
+            self.new_strings.append(s)
+        return ref
+
+    def encode_link(self, link):
+        return [
+            self.intern(link.type), self.intern(link.href), link.no_follow,
+            link.external, link.depth, self.intern(link.referrer),
+        ]
+
+    def write(self, page):
+        url = page.url or page.canonical_url
+        pack = self.packer.pack
+        record = [
+            PAGE, self.intern(page.url), self.intern(page.canonical_url),
+            page.fetched, page.no_index, page.title, page.depth,
+            pack([self.intern(s)
+                  for kv in (page.headers or {}).items() for s in kv]),
+            pack([self.encode_link(l) for l in page.links or ()]),
+            pack([self.encode_link(a) for a in page.assets or ()]),
+            page.status, page.error, self.intern(page.duplicate_of),
+        ]
+        if self.new_strings:
+            self.string_offsets.append(self.offset)
+            self.write_record([STRINGS, self.new_strings])
+            self.new_strings = []
+        self.page_offsets.append((url, self.offset))
+        self.write_record(record)
+
+    def write_record(self, record):
+        data = self.packer.pack(record)
+        self.fh.write(length_prefix.pack(len(data)))
+        self.fh.write(data)
+        self.offset += length_prefix.size + len(data)
+
+    def close(self):
+        if self.fh.closed:
+            return
+        self.fh.close()
+        with open(self.path + INDEX_SUFFIX, 'wb') as fh:
+            fh.write(msgpack.packb({
+                'pages': self.page_offsets,
+                'strings': self.string_offsets,
+            }, use_bin_type=True))
+
+
+class RecordReader(object):
+    """RecordReader reads the pages of a binary record file through mmap,
+    either all of them in order or, using the index, only those asked for.
+    If lazy, the pages are LazyPages.
+    """
+    def __init__(self, path, lazy=False):
+        require_msgpack()
+        self.path = path
+        self.fh = open(path, 'rb')
+        self.buf = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buf[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError('%s is not a crul record file.' % path)
+        self.lazy = lazy
+        self.strings = []
+        self.index = None
+        self.offsets = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.buf.close()
+        self.fh.close()
+
+    def read_record(self, offset):
+        """read_record returns the record at offset and the offset after it."""
+        start = offset + length_prefix.size
+        length, = length_prefix.unpack_from(self.buf, offset)
+        return unpack(self.buf[start:start + length]), start + length
+
+    def __iter__(self):
+        # Start a new table, rather than clear the one lazy pages refer to.
+        self.strings = []
+        offset, end = len(MAGIC), len(self.buf)
+        while offset < end:
+            record, offset = self.read_record(offset)
+            if record[0] == STRINGS:
+                self.strings.extend(record[1])
+            else:
+                yield self.decode_page(record)
+
+    def load_index(self):
+        if self.index is None:
+            with open(self.path + INDEX_SUFFIX, 'rb') as fh:
+                index = msgpack.unpackb(fh.read(), raw=False)
+            self.strings = []
+            for offset in index['strings']:
+                self.strings.extend(self.read_record(offset)[0][1])
+            self.index = dict(
+                (url, offset) for url, offset in index['pages']
+            )
+            self.offsets = sorted(self.index.itervalues())
+        return self.index
+
+    def __len__(self):
+        return len(self.load_index())
+
+    def __contains__(self, url):
+        return url in self.load_index()
+
+    def get(self, url):
+        """get returns the page recorded for url, or None."""
+        offset = self.load_index().get(url)
+        if offset is None:
+            return None
+        return self.decode_page(self.read_record(offset)[0])
+
+    def pages(self, urls):
+        """pages yields the recorded pages of urls, skipping any missing."""
+        for url in urls:
+            page = self.get(url)
+            if page is not None:
+                yield page
+
+    def chunks(self, chunk_bytes):
+        """chunks splits the file into byte ranges of about chunk_bytes, each
+        starting at a page, which can be read by read_range.
+        """
+        self.load_index()
+        start, end = len(MAGIC), len(self.buf)
+        for offset in self.offsets:
+            if offset - start >= chunk_bytes:
+                yield start, offset
+                start = offset
+        if start < end:
+            yield start, end
+
+    def read_range(self, start, end):
+        """read_range yields the pages recorded between offsets start and end,
+        using the string table of the whole file from the index.
+        """
+        self.load_index()
+        offset = start
+        while offset < end:
+            record, offset = self.read_record(offset)
+            if record[0] == PAGE:
+                yield self.decode_page(record)
+
+    def decode_page(self, record):
+        decoder = RecordDecoder(self.strings)
+        if self.lazy:
+            return LazyPage({
+                'headers': lambda: decoder.headers(record[7]),
+                'links': lambda: decoder.links(record[8]),
+                'assets': lambda: decoder.links(record[9]),
+            }, **decoder.fields(record))
+        return Page(
+            headers=decoder.headers(record[7]),
+            links=decoder.links(record[8]),
+            assets=decoder.links(record[9]),
+            **decoder.fields(record)
+        )
+
+
+class RecordDecoder(object):
+    """RecordDecoder decodes the parts of PAGE records against the string
+    table of the file they were read from.
+    """
+    def __init__(self, strings):
+        self.strings = strings
+
+    def string(self, ref):
+        return None if ref is None else self.strings[ref]
+
+    def fields(self, record):
+        """fields decodes the fields of a page which aren't packed."""
+        return dict(
+            url=self.string(record[1]), canonical_url=self.string(record[2]),
+            fetched=record[3], no_index=record[4], title=record[5],
+            depth=record[6], status=record[10] if len(record) > 10 else None,
+            error=record[11] if len(record) > 11 else None,
+            duplicate_of=self.string(record[12]) if len(record) > 12 else None,
+        )
+
+    def headers(self, packed):
+        s, headers = self.string, unpack(packed)
+        return CaseInsensitiveDict(
+            (s(headers[i]), s(headers[i + 1]))
+            for i in xrange(0, len(headers), 2)
+        )
+
+    def links(self, packed):
+        s = self.string
+        return [
+            Link(type=s(l[0]), href=s(l[1]), no_follow=l[2], external=l[3],
+                 depth=l[4], referrer=s(l[5]))
+            for l in unpack(packed)
+        ]
+
+
+#: CHUNK_BYTES is the size of the parts in which files are replayed in
+#: parallel.
+CHUNK_BYTES = 16 * 1024 * 1024
+
+
+def line_chunks(replay_file, chunk_bytes):
+    """line_chunks splits a file of lines into byte ranges of about
+    chunk_bytes, ending on newlines.
+    """
+    size = os.path.getsize(replay_file)
+    with open(replay_file, 'rb') as fh:
+        start = 0
+        while start < size:
+            fh.seek(start + chunk_bytes)
+            fh.readline()
+            end = min(fh.tell(), size)
+            yield start, end
+            start = end
+
+
+def read_lines_range(replay_file, start, end):
+    with open(replay_file, 'rb') as fh:
+        fh.seek(start)
+        while fh.tell() < end:
+            yield lazy_json_page(fh.readline())
+
+
+#: chunk_readers keeps the RecordReader of each file open in each replaying
+#: process, so that the string table is loaded once rather than per chunk.
+chunk_readers = {}
+
+
+def render_chunk(args):
+    """render_chunk renders the pages recorded between start and end of
+    replay_file, returning the concatenated output.
+    """
+    replay_file, records, start, end, render = args
+    if records:
+        reader = chunk_readers.get(replay_file)
+        if reader is None:
+            reader = chunk_readers[replay_file] = RecordReader(replay_file,
+                                                               lazy=True)
+        pages = reader.read_range(start, end)
+    else:
+        pages = read_lines_range(replay_file, start, end)
+    return ''.join(render(page) for page in pages)
+
+
+def parallel_replay(replay_file, render, processes, ordered=True,
+                    chunk_bytes=CHUNK_BYTES):
+    """parallel_replay splits replay_file into chunks which are read and
+    rendered in a pool of processes.
+
+    Args:
+        replay_file: A file of JSON lines or binary records.
+        render: Returns the output for a (lazy) page, as a string. It must be
+            a module-level function, so that it can be sent to the pool.
+        processes: The number of processes in the pool.
+        ordered: Whether the output must be in the order of the file, or can
+            be yielded as each chunk is finished.
+        chunk_bytes: The approximate size of the chunks.
+
+    Yields:
+        The rendered output of each chunk.
+    """
+    records = is_records(replay_file)
+    if records:
+        with RecordReader(replay_file) as reader:
+            chunks = list(reader.chunks(chunk_bytes))
+    else:
+        chunks = list(line_chunks(replay_file, chunk_bytes))
+
+    pool = Pool(processes)
+    try:
+        jobs = [(replay_file, records, start, end, render)
+                for start, end in chunks]
+        imap = pool.imap if ordered else pool.imap_unordered
+        for output in imap(render_chunk, jobs):
+            yield output
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
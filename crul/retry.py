@@ -0,0 +1,182 @@
+"""
+Retrying the requests which fail, after a while, without holding up the
+workers.
+
+A task whose request fails is handed to a RetryQueue, which puts it back on
+the pending queue once its backoff has passed, from a thread of its own.
+Meanwhile the worker moves on to the next task. The backoff grows
+exponentially with each attempt, with random jitter so that the tasks which
+failed together aren't all retried together, and each class of error has its
+own number of attempts and base delay.
+"""
+import heapq
+import logging
+import random
+import threading
+import time
+from itertools import count
+
+import requests
+
+from crul import Page
+from crul.schedule import parse_retry_after
+
+#: ERROR_CLASSES are the kinds of failure which may be retried.
+ERROR_CLASSES = ('timeout', 'connection', 'server', 'throttled')
+
+
+def classify(error=None, status=None):
+    """classify names the class of a failed request, given the exception it
+    raised or the status of its response, or returns None if it didn't fail
+    in a way worth retrying.
+    """
+    if error is not None:
+        if isinstance(error, requests.exceptions.Timeout):
+            return 'timeout'
+        if isinstance(error, requests.exceptions.ConnectionError):
+            return 'connection'
+        return None
+    if status == 429:
+        return 'throttled'
+    if status is not None and status >= 500:
+        return 'server'
+    return None
+
+
+class RetryPolicy(object):
+    """RetryPolicy decides how many times, and after how long, to retry each
+    class of failed request.
+
+    Args:
+        retries: The number of times to retry a request, for every class of
+            error not given in classes.
+        delay: The seconds to wait before the first retry, doubling for each
+            retry after.
+        classes: A dict of error class to (retries, delay), overriding the
+            defaults for that class (e.g. {'server': (0, 0)}).
+        max_delay: The longest to wait before a retry.
+        jitter: The fraction of each delay to take off at random.
+    """
+    def __init__(self, retries=2, delay=1.0, classes=None, max_delay=300.0,
+                 jitter=0.5):
+        self.classes = dict((c, (retries, delay)) for c in ERROR_CLASSES)
+        self.classes.update(classes or {})
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def backoff(self, kind, attempt, retry_after=None):
+        """backoff returns the seconds to wait before retrying a request of
+        the given class after its attempt'th failure (counting from zero), or
+        None if it shouldn't be retried.
+        """
+        retries, delay = self.classes.get(kind, (0, 0))
+        if attempt >= retries:
+            return None
+        delay = min(self.max_delay, delay * 2 ** attempt)
+        delay *= 1 - self.jitter * random.random()
+        wait = parse_retry_after(retry_after) if retry_after else None
+        return max(delay, min(wait or 0, self.max_delay))
+
+
+class RetryQueue(object):
+    """RetryQueue holds the tasks waiting to be retried, putting each back on
+    the pending queue once its backoff has passed.
+
+    The crawl isn't over until both the pending queue and the RetryQueue are
+    done: see join_all.
+
+    If the frontier (pending, or the queue pending wraps) can defer tasks, as
+    a DiskQueue can, each task is deferred there whilst it waits, so that it's
+    still pending should the crawl be stopped before it's retried.
+    """
+    def __init__(self, pending, policy=None, metrics=None, frontier=None):
+        self.pending = pending
+        self.frontier = pending if frontier is None else frontier
+        self.policy = policy or RetryPolicy()
+        self.metrics = metrics
+        self.heap = []
+        self.seq = count()
+        self.unfinished = 0
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(name='Retry-Queue', target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def retry(self, task, kind, retry_after=None):
+        """retry schedules task to be retried after a failure of the given
+        class, returning False if it's had all of its attempts.
+        """
+        wait = self.policy.backoff(kind, task.attempt, retry_after)
+        if wait is None:
+            return False
+        logging.info('Retrying %s in %.1fs after a %s error (attempt %d).',
+                     task.url, wait, kind, task.attempt + 1)
+        if self.metrics:
+            self.metrics.incr('retries.%s' % kind)
+        task = task._replace(attempt=task.attempt + 1)
+        if hasattr(self.frontier, 'defer'):
+            self.frontier.defer(task)
+        self.schedule(wait, task)
+        return True
+
+    def schedule(self, wait, task):
+        with self.lock:
+            heapq.heappush(self.heap,
+                           (time.time() + wait, next(self.seq), task))
+            self.unfinished += 1
+            self.changed.notify_all()
+
+    def __len__(self):
+        return self.unfinished
+
+    def qsize(self):
+        return len(self)
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.changed.wait(
+                        self.heap[0][0] - time.time() if self.heap else None
+                    )
+                _, _, task = heapq.heappop(self.heap)
+            # Put it back before it's done, so that the crawl stays unfinished.
+            self.pending.put(task)
+            with self.lock:
+                self.unfinished -= 1
+                self.changed.notify_all()
+
+    def join(self):
+        """join waits until every task scheduled has been put back."""
+        with self.lock:
+            while self.unfinished:
+                self.changed.wait()
+
+    def join_all(self):
+        """join_all waits until the pending queue is done and no tasks are
+        waiting to be retried. A task is scheduled for retry before it's
+        marked done on the pending queue, and put back on the pending queue
+        before it's marked done here, so once both are done, neither has
+        anything more to come.
+        """
+        while True:
+            self.pending.join()
+            if not len(self):
+                return
+            self.join()
+
+
+def failed_page(task, error):
+    """failed_page is the Page recorded for a task whose request couldn't be
+    made, however many times it was tried.
+    """
+    return Page(
+        url=task.url, canonical_url=None, fetched=False, headers={},
+        no_index=True, links=[], assets=[], title=None, depth=task.depth,
+        status=None, error='%s: %s' % (type(error).__name__, error),
+    )
@@ -0,0 +1,269 @@
+"""
+Collecting and interpreting the robots.txt of the sites we crawl.
+
+The rules of the group of records for our User-agent are compiled so that
+checking a path is a single walk of a prefix trie, plus a handful of regular
+expression matches for any rules with wildcards. As in Google's reading of
+robots.txt, the longest (most specific) matching rule wins, with Allow winning
+ties, and `*` matches any characters whilst a trailing `$` anchors the end.
+"""
+import logging
+import re
+import threading
+from multiprocessing.pool import ThreadPool
+from urlparse import urljoin, urlparse
+
+import requests
+from requests.exceptions import RequestException
+
+
+def fetch_robots_txt(url, session=None):
+    """fetch_robots_txt collects robots.txt from the site of the given URL."""
+    robots = (session or requests).get(urljoin(url, '/robots.txt'))
+    robots.raise_for_status()
+    return robots.text
+
+
+def parse_groups(txt):
+    """parse_groups splits robots.txt into its groups of records, returning a
+    list of (user-agents, [(field, value), ...]). Records before the first
+    User-agent line are taken to apply to all agents.
+    """
+    groups, agents, records = [], ['*'], []
+    in_agents = True
+    for line in txt.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if ':' not in line:
+            continue
+        field, value = line.split(':', 1)
+        field, value = field.strip().lower(), value.strip()
+        if field == 'user-agent':
+            if not in_agents:
+                # A User-agent line after rules starts a new group.
+                groups.append((agents, records))
+                agents, records = [], []
+            elif agents == ['*'] and not records and not groups:
+                agents = []
+            agents.append(value.lower())
+            in_agents = True
+        else:
+            records.append((field, value))
+            in_agents = False
+    groups.append((agents, records))
+    return [(a, r) for a, r in groups if a and r]
+
+
+def agent_records(agent, txt):
+    """agent_records returns the records of the groups which apply to agent:
+    those naming its product token (case-insensitively), else those for *.
+    """
+    token = (agent or '').split('/', 1)[0].strip().lower()
+    named, default = [], []
+    for agents, group in parse_groups(txt):
+        if token and token in agents:
+            named.extend(group)
+        elif '*' in agents:
+            default.extend(group)
+    return named or default
+
+
+def parse_crawl_delay(agent, txt):
+    """parse_crawl_delay reads the Crawl-Delay config for agent from
+    robots.txt.
+    """
+    for field, value in agent_records(agent, txt):
+        if field == 'crawl-delay':
+            match = re.match(r'[\d\.]+', value)
+            try:
+                return float(match.group(0)) if match else 0
+            except ValueError:
+                return 0
+    return 0
+
+
+def parse_rules(agent, txt):
+    """parse_rules reads the Allow and Disallow rules for agent from
+    robots.txt, as a list of (allow, pattern).
+    """
+    return [
+        (field == 'allow', value)
+        for field, value in agent_records(agent, txt)
+        if field in ('allow', 'disallow') and value
+    ]
+
+
+class RuleMatcher(object):
+    """RuleMatcher finds the longest of its (allow, pattern) rules which
+    matches a path. Patterns without wildcards are stored in a prefix trie;
+    the rest are compiled into alternations of regular expressions, ordered
+    longest first, so that the first alternative to match is the best.
+    """
+    #: PREFIX and EXACT key the outcomes of rules ending at a node of the trie.
+    PREFIX, EXACT = 0, 1
+
+    #: max_groups is the most groups Python's re allows in a pattern, less one.
+    max_groups = 99
+
+    def __init__(self, rules=()):
+        self.trie = {}
+        self.regexes = []
+        wildcards = []
+        for allow, pattern in rules:
+            if not pattern.startswith(('/', '*')):
+                pattern = '/' + pattern
+            outcome = (len(pattern), bool(allow))
+            exact = pattern.endswith('$')
+            path = pattern[:-1] if exact else pattern
+            if '*' in path:
+                wildcards.append((outcome, path, exact))
+            else:
+                self.insert(path, self.EXACT if exact else self.PREFIX, outcome)
+
+        # Longest first, and Allow before Disallow.
+        wildcards.sort(reverse=True)
+        for i in xrange(0, len(wildcards), self.max_groups):
+            chunk = wildcards[i:i + self.max_groups]
+            self.regexes.append((
+                re.compile('|'.join(
+                    '(%s%s)' % (re.escape(path).replace('\\*', '.*'),
+                                '$' if exact else '')
+                    for _, path, exact in chunk
+                ), re.S),
+                [outcome for outcome, _, _ in chunk],
+            ))
+
+    def __len__(self):
+        return self.count(self.trie) + sum(len(o) for _, o in self.regexes)
+
+    def count(self, node):
+        return sum(
+            1 if key in (self.PREFIX, self.EXACT) else self.count(child)
+            for key, child in node.iteritems()
+        )
+
+    def insert(self, path, kind, outcome):
+        node = self.trie
+        for ch in path:
+            node = node.setdefault(ch, {})
+        node[kind] = max(node.get(kind), outcome)
+
+    def match(self, path):
+        """match returns the (length, allow) of the best rule matching path,
+        or None if none of the rules match.
+        """
+        best, node = None, self.trie
+        for ch in path:
+            node = node.get(ch)
+            if node is None:
+                break
+            if self.PREFIX in node:
+                best = max(best, node[self.PREFIX])
+        else:
+            best = max(best, node.get(self.EXACT))
+
+        for regex, outcomes in self.regexes:
+            m = regex.match(path)
+            if m:
+                # Later regexes hold only shorter rules.
+                return max(best, outcomes[m.lastindex - 1])
+        return best
+
+    def allowed(self, path):
+        best = self.match(path)
+        return best is None or best[1]
+
+
+class DisallowedSet(object):
+    """DisallowedSet contains the paths (with any query string) which are
+    disallowed by its patterns, except those allowed by a longer pattern.
+    """
+    def __init__(self, patterns=(), allowed=()):
+        self.patterns = list(patterns)
+        self.allowed = list(allowed)
+        self.matcher = RuleMatcher(
+            [(False, p) for p in self.patterns] +
+            [(True, p) for p in self.allowed]
+        )
+
+    def __contains__(self, path):
+        if not path.startswith('/'):
+            path = '/' + path
+        return not self.matcher.allowed(path)
+
+    def __repr__(self):
+        return 'DisallowedSet(%r, allowed=%r)' % (self.patterns, self.allowed)
+
+
+def site_key(url):
+    """site_key identifies the site of url, to which a robots.txt applies."""
+    url = urlparse(url)
+    return '%s://%s' % (url.scheme.lower(), url.netloc.lower())
+
+
+class RobotsCache(object):
+    """RobotsCache fetches the robots.txt of each site once, when first asked
+    about it, and remembers its rules.
+
+    Args:
+        session: A requests.Session HTTP client.
+        agent: The User-Agent the rules are read for.
+        disallowed: Paths to disallow on every site, in addition to robots.txt.
+        delay: The number of seconds between requests to each site, in place
+            of the Crawl-Delay from robots.txt. (Default: from robots.txt)
+        yolo: Whether to skip collecting robots.txt entirely.
+    """
+    def __init__(self, session, agent, disallowed=(), delay=None, yolo=False):
+        self.session = session
+        self.agent = agent
+        self.extra_disallowed = list(disallowed)
+        self.delay = delay
+        self.yolo = yolo
+        self.sites = {}
+        self.lock = threading.Lock()
+
+    def rules(self, url):
+        """rules returns the DisallowedSet and crawl delay of url's site."""
+        key = site_key(url)
+        with self.lock:
+            site = self.sites.get(key)
+            if site is None:
+                site = self.sites[key] = {'lock': threading.Lock()}
+        with site['lock']:
+            if 'rules' not in site:
+                site['rules'] = self.load(key)
+        return site['rules']
+
+    def load(self, key):
+        rules, delay = [], 0
+        if not self.yolo:
+            try:
+                robots_txt = fetch_robots_txt(key, session=self.session)
+                rules = parse_rules(self.agent, robots_txt)
+                delay = parse_crawl_delay(self.agent, robots_txt)
+            except RequestException:
+                logging.debug('Unable to collect robots.txt for %s', key)
+
+        disallowed = DisallowedSet(
+            [p for allow, p in rules if not allow] + self.extra_disallowed,
+            allowed=[p for allow, p in rules if allow],
+        )
+        if self.delay is not None:
+            delay = self.delay
+        logging.debug('Rules for %s: disallowed %s, delay %.2f',
+                      key, disallowed, delay)
+        return disallowed, delay
+
+    def disallowed(self, url):
+        return self.rules(url)[0]
+
+    def crawl_delay(self, url):
+        return self.rules(url)[1]
+
+    def prefetch(self, urls, num_workers):
+        """prefetch collects the rules for the sites of urls concurrently."""
+        pool = ThreadPool(num_workers)
+        try:
+            pool.map(self.rules, set(site_key(url) for url in urls))
+        finally:
+            pool.close()
+            pool.join()
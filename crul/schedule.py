@@ -0,0 +1,484 @@
+"""
+Scheduling requests: across many sites, politely, at a rate each site can
+bear, and within a site, in order of importance.
+"""
+import heapq
+import logging
+import math
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from email.utils import mktime_tz, parsedate_tz
+from itertools import count
+from Queue import Empty, Queue
+
+from crul import Task
+from crul.robots import site_key
+from crul.urls import LRUMemo
+
+
+class HostScheduler(object):
+    """HostScheduler is a Queue of Tasks which keeps a separate queue for each
+    site, and releases a site's tasks no more often than its crawl delay. get
+    takes turns between the sites which are ready, so that a site with a long
+    delay doesn't hold up workers which could be fetching from the others.
+
+    Given an AdaptiveThrottle, a site is ready only once the throttle allows
+    another request to it, and get acquires the throttle for the task it
+    returns: the caller needn't (and mustn't) acquire it again, but must
+    release it once the task's request is over.
+
+    Values which are not Tasks (i.e. kill signals) are passed straight through.
+
+    Args:
+        crawl_delay: Returns the seconds to leave between requests to the
+            site of the given URL. It's called once for each site, outside of
+            the scheduler's lock. (e.g. RobotsCache.crawl_delay)
+        throttle: Limits the requests in flight to each site. (AdaptiveThrottle)
+    """
+    def __init__(self, crawl_delay=lambda url: 0, throttle=None):
+        self.crawl_delay = crawl_delay
+        self.throttle = throttle
+        self.delays = {}
+        #: sites holds the queue of each site with pending tasks, in the order
+        #: in which they'll next be considered.
+        self.sites = OrderedDict()
+        #: ready_at is the time at which each site may next be requested.
+        self.ready_at = {}
+        self.signals = deque()
+        self.size = 0
+        self.unfinished_tasks = 0
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.all_tasks_done = threading.Condition(self.mutex)
+        if throttle is not None:
+            throttle.listeners.append(self.wake)
+
+    def wake(self):
+        """wake has get look again for a site which is ready."""
+        with self.mutex:
+            self.not_empty.notify_all()
+
+    def qsize(self):
+        with self.mutex:
+            return self.size
+
+    def empty(self):
+        return not self.qsize()
+
+    def put(self, item, block=True, timeout=None):
+        if not isinstance(item, Task):
+            with self.mutex:
+                self.signals.append(item)
+                self.unfinished_tasks += 1
+                self.not_empty.notify()
+            return
+
+        key = site_key(item.url)
+        if key not in self.delays:
+            # Look up the delay without holding up other workers.
+            self.delays.setdefault(key, self.crawl_delay(item.url))
+            if self.throttle is not None:
+                self.throttle.host(item.url)
+
+        with self.mutex:
+            if key not in self.sites:
+                self.sites[key] = deque()
+            self.sites[key].append(item)
+            self.size += 1
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def put_nowait(self, item):
+        return self.put(item, block=False)
+
+    def get(self, block=True, timeout=None):
+        with self.mutex:
+            while True:
+                if self.signals:
+                    return self.signals.popleft()
+
+                now, wait = time.time(), None
+                for key, tasks in self.sites.iteritems():
+                    site_wait = self.ready_at.get(key, 0) - now
+                    if site_wait <= 0:
+                        if self.throttle is None:
+                            return self.take(key, now)
+                        acquired, site_wait = self.throttle.try_acquire(
+                            tasks[0].url)
+                        if acquired:
+                            return self.take(key, now)
+                        if site_wait is None:
+                            # Until a request to the site finishes (and wakes
+                            # us).
+                            continue
+                    if wait is None or site_wait < wait:
+                        wait = site_wait
+
+                if not block:
+                    raise Empty
+                self.not_empty.wait(wait)
+
+    def take(self, key, now):
+        tasks = self.sites.pop(key)
+        task = tasks.popleft()
+        if tasks:
+            # Go to the back of the line.
+            self.sites[key] = tasks
+        self.ready_at[key] = now + self.delays[key]
+        self.size -= 1
+        return task
+
+    def task_done(self):
+        with self.all_tasks_done:
+            if self.unfinished_tasks <= 0:
+                raise ValueError('task_done() called too many times')
+            self.unfinished_tasks -= 1
+            if not self.unfinished_tasks:
+                self.all_tasks_done.notify_all()
+
+    def join(self):
+        with self.all_tasks_done:
+            while self.unfinished_tasks:
+                self.all_tasks_done.wait()
+
+
+def parse_retry_after(value, now=None):
+    """parse_retry_after reads a Retry-After header, given either as seconds
+    or as an HTTP date, as the number of seconds to wait, or None.
+    """
+    value = (value or '').strip()
+    if value.isdigit():
+        return float(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, mktime_tz(date) - (now or time.time()))
+
+
+class HostRate(object):
+    """HostRate is the state of AdaptiveThrottle for a single site."""
+    def __init__(self, delay, limit):
+        self.min_delay = self.delay = delay
+        self.limit = limit
+        self.in_flight = 0
+        self.ready_at = 0
+        #: backed_off is when we last backed off, so that the responses to
+        #: requests made before then don't make us back off again.
+        self.backed_off = 0
+        self.latency = None
+        self.min_latency = None
+        self.responses = 0
+        self.first = self.last = None
+
+
+class AdaptiveThrottle(object):
+    """AdaptiveThrottle limits the requests made to each site, adapting to
+    how the site responds in the manner of TCP's congestion control (AIMD).
+
+    Each site may have up to limit requests in flight, at least delay seconds
+    apart. Each healthy response raises the limit, by one for each limit's
+    worth of responses. A 429 or 5xx response, or a response time rising to
+    latency_factor times the quickest seen, halves it. Once the limit is down
+    to one, backing off doubles the delay instead, and healthy responses
+    shrink it back by backoff_step. A Retry-After header holds off all
+    requests to the site for as long as it asks.
+
+    Args:
+        min_delay: The least delay between requests to each site, e.g. the
+            --delay. (Or a function giving it for a URL, e.g.
+            RobotsCache.crawl_delay, called once for each site.)
+        max_concurrency: The most requests in flight to each site.
+        initial_concurrency: The number of requests in flight to each site
+            to start with.
+        latency_factor: How much slower than its quickest responses a site
+            may get before we back off.
+        latency_slack: Seconds by which responses may slow regardless.
+        backoff_step: The least delay, in seconds, between requests to a site
+            with one request in flight which we've had to back off from.
+        max_delay: The longest delay we'll back off to, in seconds.
+    """
+    def __init__(self, min_delay=0, max_concurrency=4, initial_concurrency=1,
+                 latency_factor=2.0, latency_slack=0.05, backoff_step=0.25,
+                 max_delay=60.0):
+        self.min_delay = min_delay if callable(min_delay) else (
+            lambda url: min_delay)
+        self.max_concurrency = max_concurrency
+        self.initial_concurrency = min(initial_concurrency, max_concurrency)
+        self.latency_factor = latency_factor
+        self.latency_slack = latency_slack
+        self.backoff_step = backoff_step
+        self.max_delay = max_delay
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        #: listeners are called whenever a site may be ready for another
+        #: request, outside of the lock (e.g. HostScheduler.wake).
+        self.listeners = []
+
+    def host(self, url):
+        key = site_key(url)
+        host = self.hosts.get(key)
+        if host is None:
+            # Look up the delay without holding up other workers.
+            delay = self.min_delay(url)
+            with self.lock:
+                host = self.hosts.setdefault(
+                    key, HostRate(delay, self.initial_concurrency)
+                )
+        return host
+
+    def acquire(self, url):
+        """acquire waits until another request may be made to url's site."""
+        host = self.host(url)
+        with self.lock:
+            while True:
+                acquired, wait = self.take(host)
+                if acquired:
+                    return
+                self.ready.wait(wait)
+
+    def try_acquire(self, url):
+        """try_acquire acquires the throttle for another request to url's site
+        if it may be made now, returning (True, 0). Otherwise it returns
+        (False, the seconds until it may be made), or (False, None) if it must
+        wait for a request in flight to finish.
+        """
+        host = self.host(url)
+        with self.lock:
+            return self.take(host)
+
+    def take(self, host):
+        now = time.time()
+        if host.in_flight >= int(host.limit):
+            return False, None
+        if host.ready_at > now:
+            return False, host.ready_at - now
+        host.in_flight += 1
+        host.ready_at = now + host.delay
+        return True, 0
+
+    def release(self, url):
+        """release marks a request to url's site as finished."""
+        host = self.host(url)
+        with self.lock:
+            host.in_flight -= 1
+            self.ready.notify_all()
+        self.notify()
+
+    def notify(self):
+        for listener in self.listeners:
+            listener()
+
+    def observe(self, url, status=None, latency=None, retry_after=None):
+        """observe adapts the rate of requests to url's site to a response:
+        its status (None if the request failed), the seconds it took and its
+        Retry-After header.
+        """
+        host = self.host(url)
+        now = time.time()
+        with self.lock:
+            host.responses += 1
+            host.first = host.first or now
+            host.last = now
+            overloaded = status is None or status == 429 or status >= 500
+            if latency is not None:
+                overloaded = self.slowing(host, latency) or overloaded
+            wait = parse_retry_after(retry_after, now) if retry_after else None
+            if wait:
+                host.ready_at = max(host.ready_at, now + wait)
+                logging.info('Waiting %.1fs before requesting %s again, as '
+                             'asked by Retry-After.', wait, site_key(url))
+
+            if not overloaded:
+                self.speed_up(host)
+            elif now - (latency or 0) >= host.backed_off:
+                # Only the first of the responses to requests in flight
+                # together backs us off.
+                self.back_off(host, url, status)
+                host.backed_off = now
+            self.ready.notify_all()
+        self.notify()
+
+    def slowing(self, host, latency):
+        """slowing tracks the moving average of host's response times, and
+        returns whether it's grown too far above the quickest it's been.
+        """
+        if host.latency is None:
+            host.latency = latency
+        else:
+            host.latency += 0.2 * (latency - host.latency)
+        host.min_latency = min(host.min_latency, host.latency) \
+            if host.min_latency is not None else host.latency
+        return host.latency > max(host.min_latency * self.latency_factor,
+                                  host.min_latency + self.latency_slack)
+
+    def speed_up(self, host):
+        if host.delay > host.min_delay:
+            host.delay = max(host.min_delay, host.delay - self.backoff_step)
+        elif host.limit < self.max_concurrency:
+            host.limit = min(self.max_concurrency,
+                             host.limit + 1.0 / int(host.limit))
+
+    def back_off(self, host, url, status):
+        if host.limit >= 2:
+            host.limit = max(1.0, host.limit / 2)
+        else:
+            host.delay = min(self.max_delay,
+                             max(host.delay * 2, self.backoff_step))
+        logging.debug('Backing off %s after %s: %d in flight, %.2fs apart.',
+                      site_key(url), status or 'a slow response',
+                      int(host.limit), host.delay)
+
+    def rates(self):
+        """rates describes the rate settled on for each site."""
+        with self.lock:
+            return dict((key, {
+                'concurrency': int(host.limit),
+                'delay': host.delay,
+                'rate': (host.responses / (host.last - host.first)
+                         if host.last > host.first else 0.0),
+                'latency': host.latency,
+            }) for key, host in self.hosts.iteritems())
+
+    def log_rates(self):
+        for key, rate in sorted(self.rates().items()):
+            logging.info(
+                'Settled on %d requests in flight, %.2fs apart, to %s: '
+                '%.1f requests/s at %.3fs each.', rate['concurrency'],
+                rate['delay'], key, rate['rate'], rate['latency'] or 0,
+            )
+
+
+class UrlScorer(object):
+    """UrlScorer scores the tasks of a PriorityFrontier: the lower the score,
+    the sooner the task is crawled.
+
+    A task scores depth_weight for each link between it and the start of the
+    crawl, plus the weight of each of the patterns found in its URL, less
+    inlink_weight for each doubling of the number of links to it seen so far,
+    and less hint_weight times the priority given to it by the site's
+    sitemap.xml (0.0 to 1.0).
+
+    Args:
+        depth_weight: The score of each level of depth.
+        inlink_weight: The score taken off for each doubling of in-links.
+        patterns: A list of (regex, weight) added to the score of the URLs
+            matching regex (e.g. a positive weight for faceted URLs).
+        hint_weight: The score taken off for a sitemap priority of 1.0.
+        max_hints: About the most sitemap priorities to hold at once, beyond
+            which the oldest are forgotten: those of URLs which are never
+            scored (e.g. already seen) would otherwise pile up.
+    """
+    def __init__(self, depth_weight=1.0, inlink_weight=1.0, patterns=(),
+                 hint_weight=1.0, max_hints=100000):
+        self.depth_weight = depth_weight
+        self.inlink_weight = inlink_weight
+        self.patterns = [(re.compile(p), w) for p, w in patterns]
+        self.hint_weight = hint_weight
+        self.hints = LRUMemo(lambda url: 0, max_hints)
+
+    def hint(self, url, priority):
+        """hint records the priority of url given by a sitemap, until url is
+        scored.
+        """
+        self.hints.put(url, priority)
+
+    def base(self, task):
+        """base scores the task before counting any links to it. Each URL is
+        queued (and so scored) once, so its hint is then forgotten, lest the
+        hints of a huge sitemap pile up.
+        """
+        score = self.depth_weight * task.depth
+        for pattern, weight in self.patterns:
+            if pattern.search(task.url):
+                score += weight
+        return score - self.hint_weight * self.hints.pop(task.url, 0)
+
+    def inlinks(self, n):
+        """inlinks scores n links to a task, in whole doublings, so that the
+        score changes only O(log n) times as they're counted.
+        """
+        return -self.inlink_weight * int(math.log(n + 1, 2))
+
+
+def parse_url_weight(arg):
+    """parse_url_weight reads a "<regex>:<weight>" option."""
+    pattern, _, weight = arg.rpartition(':')
+    try:
+        return pattern, float(weight)
+    except ValueError:
+        raise ValueError('Expected <regex>:<weight>, got %r' % arg)
+
+
+class PriorityFrontier(Queue):
+    """PriorityFrontier is a Queue of Tasks which are taken lowest score
+    first, as scored by a UrlScorer.
+
+    Tasks are scored by put, outside of the queue's lock. note_link counts the
+    links to each pending task; when that raises its priority, the task is
+    pushed into the heap again and the stale entry is skipped when it
+    surfaces, so that every operation stays O(log n) under the lock.
+
+    Values which are not Tasks (i.e. kill signals) are passed straight through.
+    """
+    def __init__(self, scorer=None, maxsize=0):
+        self.scorer = scorer or UrlScorer()
+        Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        self.heap = []
+        self.signals = deque()
+        self.sequence = count()
+        #: entries holds [base score, in-links, version, task] for each
+        #: pending url. Only heap items of the current version are live.
+        self.entries = {}
+
+    def _qsize(self, len=len):
+        return len(self.entries) + len(self.signals)
+
+    def put(self, item, block=True, timeout=None):
+        if isinstance(item, Task):
+            item = (self.scorer.base(item), item)
+        Queue.put(self, item, block, timeout)
+
+    def _put(self, item):
+        if not (isinstance(item, tuple) and isinstance(item[-1], Task)):
+            self.signals.append(item)
+            return
+        base, task = item
+        if task.url in self.entries:
+            # Already pending, so keep the one queued first. put counts every
+            # item as unfinished, so uncount this one.
+            self.unfinished_tasks -= 1
+            return
+        self.entries[task.url] = entry = [base, 0, 0, task]
+        self.push(entry)
+
+    def push(self, entry):
+        base, inlinks, version, task = entry
+        score = base + self.scorer.inlinks(inlinks)
+        heapq.heappush(self.heap, (score, next(self.sequence), version, task))
+
+    def _get(self):
+        if self.signals:
+            return self.signals.popleft()
+        while True:
+            _, _, version, task = heapq.heappop(self.heap)
+            entry = self.entries.get(task.url)
+            if entry is not None and entry[2] == version:
+                del self.entries[task.url]
+                return task
+
+    def note_link(self, url):
+        """note_link counts another link to url, if it is pending."""
+        with self.mutex:
+            entry = self.entries.get(url)
+            if entry is None:
+                return
+            before = self.scorer.inlinks(entry[1])
+            entry[1] += 1
+            if self.scorer.inlinks(entry[1]) != before:
+                entry[2] += 1
+                self.push(entry)
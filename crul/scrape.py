@@ -1,22 +1,202 @@
 # -*- coding: utf-8 -*-
 import logging
+import os
 import threading
+import time
 from functools import partial
 from Queue import Queue
+from urlparse import urlparse
 
 import requests
 import sloq
+from requests.adapters import HTTPAdapter
 
+from crul.dedupe import duplicate_page
+from crul.metrics import Metrics
+from crul.retry import RetryQueue, classify, failed_page
 
-def site_crawl(session, init_url, num_workers, delay, parser, traverser):
+
+def crawl_session(user_agent, num_workers, pool_size=None, pool_hosts=10,
+                  keep_alive=True, max_retries=0, timeout=None):
+    """
+    Args:
+        user_agent: The User-Agent header sent with each request.
+        num_workers: The number of requests made concurrently.
+        pool_size: The number of connections kept open to each host.
+            (Default: num_workers, so that no worker's connection is discarded.)
+        pool_hosts: The number of hosts for which connections are kept.
+        keep_alive: Whether to reuse connections between requests.
+        max_retries: The number of times to retry failed connections.
+        timeout: The seconds to wait to connect, and then for each read,
+            before giving up on a request. (Default: forever)
+
+    Returns:
+        A requests.Session HTTP client.
+    """
+    session = requests.Session()
+    session.headers.update({'User-Agent': user_agent})
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+
+    adapter = TimeoutAdapter(
+        timeout=timeout,
+        pool_connections=pool_hosts,
+        pool_maxsize=pool_size or num_workers,
+        max_retries=max_retries,
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class TimeoutAdapter(HTTPAdapter):
+    """TimeoutAdapter gives requests made without a timeout of their own a
+    default one.
     """
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super(TimeoutAdapter, self).__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super(TimeoutAdapter, self).send(
+            request, timeout=timeout or self.timeout, **kwargs)
+
+
+class Fetcher(object):
+    """Fetcher makes requests through the session, streaming each response so
+    that we can decide from its headers whether to download the body at all.
+    Bodies we won't parse are skipped, and those we will are capped at
+    max_body_bytes. It can be used in place of the session in site_crawl.
+
     Args:
         session: A requests.Session HTTP client.
-        init_url: The first URL to request on the target site.
+        wants_body: Decides from the response headers whether the body will be
+            parsed. (e.g. PageParser.looks_like_html)
+        max_body_bytes: The most of each body to download. (Default: no limit)
+        head_unknown: Whether to check the headers of URLs with unfamiliar
+            extensions with a HEAD request before making a GET request.
+        metrics: Counts the bytes read and skipped. (Metrics)
+    """
+    #: page_extensions are those of URLs we expect to be HTML pages.
+    page_extensions = (
+        '', '.html', '.htm', '.xhtml', '.shtml', '.php', '.asp', '.aspx',
+        '.jsp', '.cfm', '.cgi', '.pl',
+    )
+
+    #: drain_bytes is the largest skipped body we'll read anyway, to let the
+    #: connection be reused.
+    drain_bytes = 16 * 1024
+
+    chunk_size = 64 * 1024
+
+    #: counters are the names of the counters kept in metrics.
+    counters = (
+        'bytes_read', 'bytes_skipped', 'bodies_skipped', 'bodies_truncated',
+        'heads',
+    )
+
+    def __init__(self, session, wants_body, max_body_bytes=None,
+                 head_unknown=False, metrics=None):
+        self.session = session
+        self.wants_body = wants_body
+        self.max_body_bytes = max_body_bytes
+        self.head_unknown = head_unknown
+        self.metrics = metrics or Metrics()
+
+    def get(self, url, **kwargs):
+        if self.head_unknown and self.unknown_extension(url):
+            head = self.session.head(url, allow_redirects=True, **kwargs)
+            self.count(heads=1)
+            if head.ok and not self.wants_body(head):
+                # The headers are all we need.
+                return head
+
+        resp = self.session.get(url, stream=True, **kwargs)
+        if self.wants_body(resp):
+            self.read(resp)
+        else:
+            self.skip(resp)
+        return resp
+
+    def unknown_extension(self, url):
+        ext = os.path.splitext(urlparse(url).path)[1].lower()
+        return ext not in self.page_extensions
+
+    def read(self, resp):
+        chunks, size = [], 0
+        for chunk in resp.iter_content(self.chunk_size):
+            chunks.append(chunk)
+            size += len(chunk)
+            if self.max_body_bytes and size > self.max_body_bytes:
+                logging.info('Truncating %s to %d bytes.',
+                             resp.url, self.max_body_bytes)
+                resp.close()
+                self.count(bodies_truncated=1)
+                break
+
+        content = b''.join(chunks)
+        if self.max_body_bytes:
+            content = content[:self.max_body_bytes]
+        resp._content, resp._content_consumed = content, True
+        self.count(bytes_read=len(content))
+
+    def skip(self, resp):
+        try:
+            length = int(resp.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            length = None
+
+        if resp.status_code in (204, 304) or (
+                length is not None and length <= self.drain_bytes):
+            # Cheaper to read than to open a new connection.
+            self.count(bytes_read=len(resp.content))
+            return
+
+        logging.debug('Skipping the body of %s (%s bytes).',
+                      resp.url, 'unknown' if length is None else length)
+        resp.close()
+        resp._content, resp._content_consumed = b'', True
+        self.count(bytes_skipped=length or 0, bodies_skipped=1)
+
+    def count(self, **counts):
+        self.metrics.add(counts)
+
+    def stats(self):
+        counters = self.metrics.snapshot()['counters']
+        return dict((name, counters.get(name, 0)) for name in self.counters)
+
+
+def site_crawl(session, init_url, num_workers, delay, parser, traverser,
+               frontier=None, since=None, metrics=None, max_pages=None,
+               seeds=None, throttle=None, retry=None, max_complete=None,
+               dedupe=None):
+    """
+    Args:
+        session: A requests.Session HTTP client, or a Fetcher.
+        init_url: The first URL to request on the target site, or a list of
+            the first URLs to request on each of the target sites.
         num_workers: The number of HTTP-client workers to spin up.
         delay: The number of seconds between each request to the target site.
         parser: Parses the http response for content, links, etc. (PageParser)
         traverser: The utility for queueing newly discovered links. (PageTraverser)
+        frontier: The Queue holding pending tasks. (Default: an empty Queue)
+        since: The pages of a previous crawl to request conditionally, and
+            reuse if not modified. (PreviousCrawl)
+        metrics: Collects timings of each stage of the crawl. (Metrics)
+        max_pages: The most pages to request, after which the remaining tasks
+            are dropped. (Default: no limit)
+        seeds: Further Tasks to queue after init_url, e.g. from sitemaps. They
+            are queued as they're iterated, whilst the crawl gets going.
+        throttle: Adapts the rate of requests to each site to its responses,
+            in place of the fixed delay. (AdaptiveThrottle)
+        retry: Decides which failed requests to retry, and when; the rest are
+            yielded as Pages with an error. (RetryPolicy, default: none are
+            retried)
+        max_complete: The most pages to hold until they're consumed, beyond
+            which the workers wait before fetching more. (Default: no limit)
+        dedupe: Recognises pages whose content duplicates another's, which
+            are yielded unparsed, without following their links.
+            (ContentIndex)
 
     Yields:
         Each Page encountered.
@@ -57,41 +237,72 @@ def site_crawl(session, init_url, num_workers, delay, parser, traverser):
     logging.info('Starting crawl of %s (delay: %0.2fs)', init_url, delay)
 
     #: complete is the queue to which results are sent.
-    complete = Queue()
+    complete = Queue(max_complete or 0)
     complete_sentinel = {}
     work_sentinel = {}
 
     #: pending is the pages we have identified that we are interested in.
-    if delay:
-        pending = SlowQueue(release_tick=delay, max_slam=1,
+    if frontier is None:
+        frontier = Queue()
+    if delay and throttle is None:
+        pending = SlowQueue(queue=frontier, release_tick=delay, max_slam=1,
                             passthru=work_sentinel)
     else:
-        pending = Queue()
+        pending = frontier
+
+    if metrics is None:
+        metrics = Metrics()
+    metrics.gauge('pending', pending.qsize)
+    metrics.gauge('complete', complete.qsize)
+    metrics.gauge('workers', lambda: num_workers)
+
+    #: retries holds the failed tasks until they're due to be retried.
+    retries = None
+    if retry is not None:
+        retries = RetryQueue(pending, retry, metrics, frontier).start()
+        metrics.gauge('retrying', retries.qsize)
 
     #: workfn takes a task description and fetches the remote content,
     #: enqueuing any additional pages we should look at.
     workfn = partial(worker_request, parser.parse,
-                     partial(traverser.follow, pending), session)
+                     partial(traverser.follow, pending), session, since=since,
+                     metrics=metrics, throttle=throttle, retries=retries,
+                     dedupe=dedupe)
+
+    budget = PageBudget(max_pages)
 
     # Start the worker threads.
     for w in xrange(num_workers):
         t = threading.Thread(
             name='Worker-%d' % w,
             target=worker,
-            args=(workfn, pending, complete, work_sentinel)
+            args=(workfn, pending, complete, work_sentinel, metrics, budget,
+                  throttle, queue_throttles(pending, throttle))
         )
         t.daemon = True
         t.start()
 
     # Queue some work.
-    traverser.queue_url(pending, init_url)
+    for url in [init_url] if isinstance(init_url, basestring) else init_url:
+        traverser.queue_url(pending, url)
+
+    # Queue the seeds in the background, so that we can start returning
+    # pages straight away.
+    seeder = threading.Thread(
+        name='Seeder',
+        target=traverser.queue_tasks,
+        args=(pending, seeds or ())
+    )
+    seeder.daemon = True
+    seeder.start()
 
     # Start a background thread to add completion markers to the
     # pending/complete queues when all pending tasks are complete.
     t = threading.Thread(
         name='Worker-Sentinel',
         target=worker_sentinel,
-        args=(pending, complete, work_sentinel, num_workers, complete_sentinel)
+        args=(pending, complete, work_sentinel, num_workers, complete_sentinel,
+              seeder, retries)
     )
     t.daemon = True
     t.start()
@@ -103,12 +314,21 @@ def site_crawl(session, init_url, num_workers, delay, parser, traverser):
             raise result
         else:
             yield result
+    if throttle:
+        throttle.log_rates()
 
 
 def worker_sentinel(pending, complete, worker_sentinel, num_workers,
-                    complete_sentinel=None):
+                    complete_sentinel=None, seeder=None, retries=None):
     logging.debug('Awaiting all work to complete.')
-    pending.join()
+    if seeder:
+        # Tasks are still to come whilst seeds are being queued.
+        seeder.join()
+    if retries is not None:
+        # Tasks are still to come whilst failed ones are waiting to be retried.
+        retries.join_all()
+    else:
+        pending.join()
 
     logging.debug('Sending kill signals.')
     for _ in xrange(num_workers):
@@ -118,42 +338,145 @@ def worker_sentinel(pending, complete, worker_sentinel, num_workers,
     logging.debug('Kill signals sent.')
 
 
-def worker(workfn, in_queue, out_deque, kill_signal):
+def queue_throttles(queue, throttle):
+    """queue_throttles returns whether queue acquires throttle for each task
+    it hands out, as a HostScheduler given it does, so that it only hands out
+    the tasks whose sites are ready for them. Otherwise it's up to the worker
+    to acquire it.
+    """
+    return throttle is not None and getattr(queue, 'throttle', None) is throttle
+
+
+def worker(workfn, in_queue, out_deque, kill_signal, metrics=None,
+           budget=None, throttle=None, throttled=False):
+    metrics = metrics or Metrics()
     logging.debug('Worker started.')
     while True:
-        task = in_queue.get()
+        # Time spent waiting includes any throttling by the queue.
+        with metrics.timer('wait'):
+            task = in_queue.get()
         if task is kill_signal:
             in_queue.task_done()
             break
+        if budget and not budget.take(task, metrics):
+            if throttled:
+                throttle.release(task.url)
+            in_queue.task_done()
+            continue
+        if throttle and not throttled:
+            with metrics.timer('throttle'):
+                throttle.acquire(task.url)
         try:
-            out_deque.put(workfn(task))
+            with metrics.timer('task'):
+                page = workfn(task)
+            if page is not None:
+                # Waits whilst the consumer is behind, if complete is bounded.
+                with metrics.timer('backpressure'):
+                    out_deque.put(page)
+                metrics.peak('complete', out_deque.qsize())
         except Exception as e:
             logging.exception('Worker errored whilst processing %r', task)
             out_deque.put(e)
             break
         finally:
+            if throttle:
+                throttle.release(task.url)
             in_queue.task_done()
     logging.debug('Worker stopped.')
 
 
-def worker_request(parser, follow_links, session, task):
+def worker_request(parser, follow_links, session, task, since=None,
+                   metrics=None, throttle=None, retries=None, dedupe=None):
+    """worker_request requests and parses the page of task, and follows its
+    links. If the request fails in a way worth retrying, and retries will
+    retry it, it returns None: the page will be requested again later.
+    Otherwise a failed request is returned as a Page with an error. Given a
+    ContentIndex (dedupe), pages whose content duplicates another's are
+    returned unparsed, with no links to follow.
+    """
+    metrics = metrics or Metrics()
     headers = {}
     if task.referrer:
         headers['Referrer'] = task.referrer
-    for _ in xrange(2):
+    if since:
+        headers.update(since.request_headers(task.url))
+    if since and since.unchanged(task.url, task.lastmod):
+        # The sitemap says it hasn't changed since we last fetched it.
+        page = since.not_modified(task.url, task.depth)
+        metrics.incr('not_modified.lastmod')
+    else:
+        start = time.time()
         try:
-            page = parser(session.get(task.url, headers=headers), depth=task.depth)
-            break
-        except requests.exceptions.ConnectionError:
-            # FIXME: There's a peculiar, intermittent ConnectionError being
-            # thrown. It only seems to occur when the delay between requests
-            # is between 0 and 0.5 seconds -- but doesn't happen and not when
-            # there is no delay at all. (╯°□°）╯︵ ┻━┻
-            logging.exception('ConnectionError encountered. Retrying...')
-    follow_links(page)
+            with metrics.timer('fetch'):
+                resp = session.get(task.url, headers=headers)
+        except requests.exceptions.RequestException as e:
+            if throttle:
+                throttle.observe(task.url, latency=time.time() - start)
+            kind = classify(error=e)
+            metrics.incr('errors.%s' % (kind or 'request'))
+            if kind and retries is not None and retries.retry(task, kind):
+                return None
+            logging.warning('Unable to request %s: %s', task.url, e)
+            page = failed_page(task, e)
+        else:
+            if throttle:
+                throttle.observe(task.url, resp.status_code,
+                                 time.time() - start,
+                                 resp.headers.get('Retry-After'))
+            metrics.incr('status.%d' % resp.status_code)
+            kind = classify(status=resp.status_code)
+            if kind and retries is not None and retries.retry(
+                    task, kind, resp.headers.get('Retry-After')):
+                resp.close()
+                return None
+            duplicate = None
+            if dedupe is not None and resp.status_code == 200:
+                with metrics.timer('dedupe'):
+                    duplicate = dedupe.check(resp.request.url, resp.content)
+            # A 304 we didn't ask for has no page to reuse, so it's recorded
+            # like any other response.
+            if since and resp.status_code == 304 and task.url in since:
+                page = since.not_modified(task.url, task.depth)
+                metrics.incr('not_modified')
+            elif duplicate:
+                original, kind = duplicate
+                logging.debug('Not parsing %s: a duplicate of %s.',
+                              task.url, original)
+                page = duplicate_page(resp, task.depth, original)
+                metrics.incr('duplicates.%s' % kind)
+            else:
+                with metrics.timer('parse'):
+                    page = parser(resp, depth=task.depth)
+    with metrics.timer('follow'):
+        follow_links(page)
+    metrics.incr('pages')
     return page
 
 
+class PageBudget(object):
+    """PageBudget limits the number of pages requested in a crawl. Once it's
+    spent, the tasks still pending are dropped rather than requested, so the
+    crawl drains and ends. With a PriorityFrontier, those are the tasks which
+    scored worst.
+    """
+    def __init__(self, max_pages=None):
+        self.remaining = max_pages
+        self.lock = threading.Lock()
+
+    def __nonzero__(self):
+        return self.remaining is not None
+
+    def take(self, task, metrics):
+        """take returns whether the budget allows task to be requested."""
+        with self.lock:
+            if self.remaining > 0:
+                self.remaining -= 1
+                return True
+        logging.debug('Dropping %s: page budget spent.', task.url)
+        metrics.incr('tasks.dropped')
+        return False
+
+
 class SlowQueue(sloq.SlowQueue):
     """SlowQueue overrides the default behaviour of sloq.SlowQueue when taking
     an item off of the queue: if the item to be returned is a pass-through
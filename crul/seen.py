@@ -0,0 +1,241 @@
+"""
+Sets of the URLs seen by a crawl, for PageTraverser.seen.
+
+Many workers queue links at once, so each set offers add_new: an atomic
+test-and-set which adds a URL and reports whether it wasn't already there.
+StripedSet, the default, is an ordinary set with a lock for each of many
+stripes of URL hashes, so that workers rarely wait on each other.
+
+FingerprintSet stores a 64-bit hash of each URL, rather than the URL itself,
+which is exact up to hash collisions. ScalableBloomFilter uses less memory
+again, at the cost of a configurable rate of false positives: URLs which are
+reported seen, and so never crawled, without having been seen.
+"""
+import hashlib
+import math
+import struct
+import sys
+import threading
+from array import array
+
+#: FINGERPRINT_TYPECODE is the array type used to hold fingerprints: one with
+#: 64-bit items on most platforms.
+FINGERPRINT_TYPECODE = 'L'
+FINGERPRINT_MASK = (1 << (8 * array(FINGERPRINT_TYPECODE).itemsize)) - 1
+
+
+def url_hashes(url):
+    """url_hashes returns two independent 64-bit hashes of the url."""
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return struct.unpack('<QQ', hashlib.md5(url).digest())
+
+
+class StripedSet(object):
+    """StripedSet is a set of URL strings whose add_new takes one of many
+    locks, picked by the URL's hash, so that marking different URLs seldom
+    waits. Checking membership and adding to a set are each atomic in
+    CPython, so reads take no lock at all.
+    """
+    def __init__(self, num_locks=64):
+        # A power of two, so that the lock is picked with a mask.
+        size = 1
+        while size < num_locks:
+            size <<= 1
+        self.mask = size - 1
+        self.locks = [threading.Lock() for _ in xrange(size)]
+        self.urls = set()
+
+    def __contains__(self, url):
+        return url in self.urls
+
+    def __len__(self):
+        return len(self.urls)
+
+    def __iter__(self):
+        return iter(list(self.urls))
+
+    def add(self, url):
+        self.urls.add(url)
+
+    def add_new(self, url):
+        """add_new adds url, returning whether it wasn't already present."""
+        with self.locks[hash(url) & self.mask]:
+            if url in self.urls:
+                return False
+            self.urls.add(url)
+            return True
+
+    def stats(self):
+        return seen_stats(self.urls)
+
+
+class FingerprintSet(object):
+    """FingerprintSet is an open-addressing hash table of URL fingerprints,
+    packed into an array.
+    """
+    def __init__(self, capacity=1024, max_load=0.5):
+        size = 1
+        while size * max_load < capacity:
+            size <<= 1
+        self.table = array(FINGERPRINT_TYPECODE, [0]) * size
+        self.max_load = max_load
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def fingerprint(self, url):
+        # Zero marks an empty slot in the table.
+        return (url_hashes(url)[0] & FINGERPRINT_MASK) or 1
+
+    def __contains__(self, url):
+        table = self.table
+        return self.probe(table, self.fingerprint(url))[1] != 0
+
+    def __len__(self):
+        return self.count
+
+    def probe(self, table, fp):
+        """probe returns the index and value of the slot in which fp belongs:
+        either the slot holding fp, or the empty slot where it would go.
+        """
+        mask = len(table) - 1
+        i = fp & mask
+        while True:
+            value = table[i]
+            if value == fp or value == 0:
+                return i, value
+            i = (i + 1) & mask
+
+    def add(self, url):
+        self.add_new(url)
+
+    def add_new(self, url):
+        fp = self.fingerprint(url)
+        with self.lock:
+            i, value = self.probe(self.table, fp)
+            if value:
+                return False
+            self.table[i] = fp
+            self.count += 1
+            if self.count > len(self.table) * self.max_load:
+                self.grow()
+            return True
+
+    def grow(self):
+        table = array(FINGERPRINT_TYPECODE, [0]) * (len(self.table) * 2)
+        for fp in self.table:
+            if fp:
+                table[self.probe(table, fp)[0]] = fp
+        self.table = table
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'memory': self.table.itemsize * len(self.table),
+            'fill': float(self.count) / len(self.table),
+        }
+
+
+class BloomFilter(object):
+    """BloomFilter is a fixed-size Bloom filter, sized to hold capacity URLs
+    with the given false-positive rate.
+    """
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        ))
+        self.num_hashes = max(1, int(round(
+            float(self.num_bits) / capacity * math.log(2)
+        )))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, hashes):
+        # Kirsch-Mitzenmacher: derive k hashes from two. The step mustn't be
+        # zero, lest all k fall on one bit, and is odd (for an even m) so that
+        # it shares no factor of two with m.
+        m = self.num_bits
+        h1, h2 = int(hashes[0] % m), int(hashes[1] % (m - 1)) + 1
+        if not m % 2:
+            h2 |= 1
+        return [(h1 + i * h2) % m for i in xrange(self.num_hashes)]
+
+    def contains_hashes(self, hashes):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self.positions(hashes))
+
+    def add_hashes(self, hashes):
+        for pos in self.positions(hashes):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, url):
+        return self.contains_hashes(url_hashes(url))
+
+    def add(self, url):
+        hashes = url_hashes(url)
+        if not self.contains_hashes(hashes):
+            self.add_hashes(hashes)
+
+
+class ScalableBloomFilter(object):
+    """ScalableBloomFilter is a series of BloomFilters, each larger and with a
+    lower false-positive rate than the last, so that the filter can grow to
+    hold any number of URLs whilst keeping to the error_rate overall.
+    """
+    def __init__(self, capacity=100000, error_rate=0.0001, growth=2,
+                 tightening=0.5):
+        self.initial_capacity = capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self.filters = []
+        self.lock = threading.Lock()
+
+    def __contains__(self, url):
+        hashes = url_hashes(url)
+        return any(f.contains_hashes(hashes) for f in self.filters)
+
+    def __len__(self):
+        return sum(f.count for f in self.filters)
+
+    def add(self, url):
+        self.add_new(url)
+
+    def add_new(self, url):
+        hashes = url_hashes(url)
+        with self.lock:
+            if any(f.contains_hashes(hashes) for f in self.filters):
+                return False
+            if not self.filters or self.filters[-1].count >= self.filters[-1].capacity:
+                n = len(self.filters)
+                # The error rates form a geometric series summing to error_rate.
+                self.filters.append(BloomFilter(
+                    self.initial_capacity * self.growth ** n,
+                    self.error_rate * (1 - self.tightening) * self.tightening ** n,
+                ))
+            self.filters[-1].add_hashes(hashes)
+            return True
+
+    def stats(self):
+        capacity = sum(f.capacity for f in self.filters)
+        return {
+            'count': len(self),
+            'memory': sum(len(f.bits) for f in self.filters),
+            'fill': float(len(self)) / capacity if capacity else 0.0,
+        }
+
+
+def seen_stats(seen):
+    """seen_stats describes the size of the given seen-set, estimating the
+    memory used by ordinary sets of strings.
+    """
+    if hasattr(seen, 'stats'):
+        return seen.stats()
+    stats = {'count': len(seen)}
+    if isinstance(seen, (set, frozenset)):
+        stats['memory'] = sys.getsizeof(seen) + sum(sys.getsizeof(u) for u in seen)
+    return stats
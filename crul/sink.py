@@ -0,0 +1,232 @@
+"""
+Writing output to stdout or files, away from the crawl.
+
+Output is written in batches to a FileSink, which compresses it on the fly
+(by the extension of its path) and rotates it into numbered shards by size or
+count. A BackgroundWriter does the writing from a thread of its own, so that
+a slow disk or pipe doesn't hold up the consumption of the crawl's complete
+queue, and with it the workers.
+"""
+import gzip
+import logging
+import os
+import sys
+import threading
+from Queue import Queue
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#: COMPRESSIONS are the extensions by which output files are compressed.
+COMPRESSIONS = {'.gz': 'gzip', '.zst': 'zstd'}
+
+
+def compression_of(path):
+    """compression_of names the compression implied by the extension of path,
+    or returns None if it isn't compressed.
+    """
+    return COMPRESSIONS.get(os.path.splitext(path or '')[1].lower())
+
+
+def shard_path(path, n):
+    """shard_path numbers path, before its extensions: the 3rd shard of
+    pages.json.gz is pages-3.json.gz.
+    """
+    base, comp = os.path.splitext(path)
+    if comp.lower() not in COMPRESSIONS:
+        base, comp = path, ''
+    base, ext = os.path.splitext(base)
+    return '%s-%d%s%s' % (base, n, ext, comp)
+
+
+def open_output(path, compression=None):
+    """open_output opens path to write to, compressed with compression ("gzip"
+    or "zstd"), or as implied by its extension.
+    """
+    compression = compression or compression_of(path)
+    if compression == 'gzip':
+        return gzip.open(path, 'wb', compresslevel=6)
+    if compression == 'zstd':
+        return ZstdFile(path)
+    if compression:
+        raise ValueError('Unknown compression: %s' % compression)
+    return open(path, 'wb')
+
+
+class ZstdFile(object):
+    """ZstdFile is a file to which whatever's written is zstd-compressed."""
+    def __init__(self, path, level=3):
+        if zstandard is None:
+            raise RuntimeError(
+                'zstd output requires zstandard to be installed.')
+        self.fh = open(path, 'wb')
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def write(self, data):
+        self.fh.write(self.compressor.compress(data))
+
+    def close(self):
+        self.fh.write(self.compressor.flush())
+        self.fh.close()
+
+
+class FileSink(object):
+    """FileSink writes chunks of output to path, holding them until it has
+    buffer_size bytes to write at once.
+
+    Given max_bytes or max_items, the output is rotated into shards numbered
+    by shard_path, each beginning with header and ending with footer, and
+    none (unless a single chunk is) longer than max_bytes before compression
+    or with more than max_items chunks.
+
+    Args:
+        path: The file to write to, or None (or "-") for stdout.
+        compression: "gzip" or "zstd". (Default: by the extension of path)
+        max_bytes: The most bytes in each shard.
+        max_items: The most chunks in each shard.
+        header: Written at the start of each shard.
+        footer: Written at the end of each shard.
+        buffer_size: The bytes to buffer before each write.
+    """
+    def __init__(self, path=None, compression=None, max_bytes=None,
+                 max_items=None, header='', footer='',
+                 buffer_size=1024 * 1024):
+        self.path = None if path == '-' else path
+        self.compression = compression or compression_of(self.path)
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.header = header
+        self.footer = footer
+        self.buffer_size = buffer_size
+        if self.path is None and (self.sharded or self.compression):
+            raise ValueError('stdout cannot be sharded or compressed.')
+        if self.path is None and sys.stdout.isatty():
+            # Show each page as it comes.
+            self.buffer_size = 0
+
+        self.paths = []
+        self.fh = None
+        self.buffer, self.buffered = [], 0
+        self.bytes = self.items = 0
+
+    @property
+    def sharded(self):
+        return bool(self.max_bytes or self.max_items)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, chunk):
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        if self.fh is None:
+            self.open_shard()
+        elif self.items and self.full(len(chunk)):
+            self.close_shard()
+            self.open_shard()
+        self.buffer.append(chunk)
+        self.buffered += len(chunk)
+        self.bytes += len(chunk)
+        self.items += 1
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def full(self, size):
+        """full returns whether a chunk of size bytes must go in a new shard."""
+        if self.max_items and self.items >= self.max_items:
+            return True
+        return bool(self.max_bytes and
+                    self.bytes + size + len(self.footer) > self.max_bytes)
+
+    def open_shard(self):
+        if self.path is None:
+            self.fh = sys.stdout
+        else:
+            path = (shard_path(self.path, len(self.paths) + 1)
+                    if self.sharded else self.path)
+            logging.debug('Writing output to %s', path)
+            self.fh = open_output(path, self.compression)
+            self.paths.append(path)
+        self.bytes = self.items = 0
+        if self.header:
+            self.buffer.append(self.header)
+            self.buffered += len(self.header)
+            self.bytes += len(self.header)
+
+    def close_shard(self):
+        if self.footer:
+            self.buffer.append(self.footer)
+        self.flush()
+        if self.fh is not sys.stdout:
+            self.fh.close()
+        self.fh = None
+
+    def flush(self):
+        if self.buffer:
+            self.fh.write(b''.join(self.buffer))
+            self.buffer, self.buffered = [], 0
+        if self.fh is sys.stdout:
+            self.fh.flush()
+
+    def close(self):
+        """close finishes the output, returning the paths written to."""
+        if self.fh is None and self.header:
+            # There's no output, but there should still be a (valid) file.
+            self.open_shard()
+        if self.fh is not None:
+            self.close_shard()
+        return self.paths
+
+
+class BackgroundWriter(object):
+    """BackgroundWriter passes whatever's written to it on to writer (e.g. a
+    FileSink or RecordWriter) from a thread of its own. Up to max_pending
+    writes are queued for the thread, beyond which writing blocks.
+
+    Errors raised by writer are raised again from close, or from the next
+    write.
+    """
+    def __init__(self, writer, max_pending=10000):
+        self.writer = writer
+        self.pending = Queue(max_pending)
+        self.error = None
+        self.closed = object()
+        self.thread = threading.Thread(name='Output-Writer', target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, item):
+        if self.error is not None:
+            raise self.error
+        self.pending.put(item)
+
+    def run(self):
+        for item in iter(self.pending.get, self.closed):
+            if self.error is None:
+                try:
+                    self.writer.write(item)
+                except Exception as e:
+                    logging.exception('Unable to write output.')
+                    # Keep draining the queue, so that writes don't block.
+                    self.error = e
+
+    def close(self):
+        """close waits for the pending writes to be written, and closes
+        writer, returning whatever its close returns.
+        """
+        self.pending.put(self.closed)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.writer.close()
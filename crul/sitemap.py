@@ -0,0 +1,187 @@
+"""
+Reading the sitemaps which sites publish, to seed a crawl with their URLs.
+
+Sitemaps and sitemap indexes can list millions of URLs, so they're streamed:
+each response is decompressed (if gzipped) and parsed incrementally, and the
+elements of each <url> are discarded once it has been read.
+"""
+import calendar
+import logging
+import re
+import zlib
+from collections import namedtuple
+from urlparse import urljoin
+
+from lxml import etree
+from requests.exceptions import RequestException
+
+from crul import Task
+from crul.robots import fetch_robots_txt, site_key
+
+SitemapUrl = namedtuple('SitemapUrl', [
+    'loc', 'lastmod', 'priority', 'sitemap',
+])
+
+lastmod_pattern = re.compile(r'''
+    (\d{4})(?:-(\d\d)(?:-(\d\d)
+    (?:T(\d\d):(\d\d)(?::(\d\d)(?:\.\d+)?)?
+    (Z|([+-])(\d\d):(\d\d))?)?)?)?$
+''', re.X)
+
+
+def parse_lastmod(value):
+    """parse_lastmod reads a W3C datetime (as used by <lastmod>) as seconds
+    since the epoch, or None if it can't be read.
+    """
+    match = lastmod_pattern.match((value or '').strip())
+    if not match:
+        return None
+    year, month, day, hour, minute, second = (
+        int(g or d) for g, d in zip(match.groups()[:6], (0, 1, 1, 0, 0, 0))
+    )
+    try:
+        seconds = calendar.timegm((year, month, day, hour, minute, second))
+    except ValueError:
+        return None
+    if match.group(8):
+        offset = 60 * (60 * int(match.group(9)) + int(match.group(10)))
+        seconds -= offset if match.group(8) == '+' else -offset
+    return seconds
+
+
+def parse_sitemap_directives(robots_txt):
+    """parse_sitemap_directives lists the Sitemap URLs in robots.txt."""
+    return re.findall(r'^\s*Sitemap:\s*(\S+)', robots_txt, re.I | re.M)
+
+
+def find_sitemaps(url, session):
+    """find_sitemaps lists the sitemaps of url's site: those in its robots.txt,
+    or else /sitemap.xml.
+    """
+    try:
+        sitemaps = parse_sitemap_directives(fetch_robots_txt(url, session))
+    except RequestException:
+        sitemaps = []
+    return sitemaps or [urljoin(url, '/sitemap.xml')]
+
+
+def decompressed(chunks):
+    """decompressed yields the chunks of a body, gunzipping them if it's
+    gzipped (e.g. sitemap.xml.gz, which is not decoded by requests).
+    """
+    gunzip = None
+    for chunk in chunks:
+        if gunzip is None:
+            gunzip = (zlib.decompressobj(16 + zlib.MAX_WBITS)
+                      if chunk.startswith('\x1f\x8b') else False)
+        yield gunzip.decompress(chunk) if gunzip else chunk
+    if gunzip:
+        yield gunzip.flush()
+
+
+def localname(tag):
+    return tag.rsplit('}', 1)[-1] if isinstance(tag, basestring) else None
+
+
+def parse_sitemap(chunks):
+    """parse_sitemap yields the ('url' or 'sitemap', loc, lastmod, priority) of
+    each entry in a sitemap or sitemap index, given the chunks of its XML.
+    """
+    parser = etree.XMLPullParser(events=('end',), resolve_entities=False,
+                                 no_network=True, huge_tree=True)
+    for chunk in chunks:
+        parser.feed(chunk)
+        for entry in read_entries(parser):
+            yield entry
+    parser.close()
+    for entry in read_entries(parser):
+        yield entry
+
+
+def read_entries(parser):
+    for _, el in parser.read_events():
+        kind = localname(el.tag)
+        if kind not in ('url', 'sitemap'):
+            continue
+        fields = dict(
+            (localname(child.tag), (child.text or '').strip()) for child in el
+        )
+        # Discard what we've read, keeping the tree from growing.
+        el.clear()
+        while el.getprevious() is not None:
+            del el.getparent()[0]
+        if fields.get('loc'):
+            try:
+                priority = float(fields['priority'])
+            except (KeyError, ValueError):
+                priority = None
+            yield (kind, fields['loc'], parse_lastmod(fields.get('lastmod')),
+                   priority)
+
+
+def sitemap_urls(sitemaps, session, max_nesting=3, chunk_size=64 * 1024):
+    """sitemap_urls streams the URLs listed by sitemaps, following sitemap
+    indexes up to max_nesting deep. Sitemaps which can't be fetched or parsed
+    are logged and skipped.
+
+    Yields:
+        A SitemapUrl for each URL listed.
+    """
+    pending, fetched = [(url, 0) for url in reversed(sitemaps)], set()
+    while pending:
+        sitemap, nesting = pending.pop()
+        if sitemap in fetched:
+            continue
+        fetched.add(sitemap)
+        logging.info('Reading sitemap %s', sitemap)
+
+        count, children = 0, []
+        try:
+            resp = session.get(sitemap, stream=True)
+            resp.raise_for_status()
+            chunks = decompressed(resp.iter_content(chunk_size))
+            for kind, loc, lastmod, priority in parse_sitemap(chunks):
+                if kind == 'sitemap':
+                    children.append(loc)
+                else:
+                    count += 1
+                    yield SitemapUrl(loc=loc, lastmod=lastmod,
+                                     priority=priority, sitemap=sitemap)
+        except (RequestException, etree.XMLSyntaxError, zlib.error) as e:
+            logging.warning('Unable to read sitemap %s: %s', sitemap, e)
+        logging.debug('Read %d URLs and %d sitemaps from %s',
+                      count, len(children), sitemap)
+
+        if children and nesting >= max_nesting:
+            logging.warning('Ignoring %d sitemaps nested in %s: too deep.',
+                            len(children), sitemap)
+        elif children:
+            pending.extend((url, nesting + 1) for url in reversed(children))
+
+
+def sitemap_tasks(sites, session, traverser, hint=None):
+    """sitemap_tasks streams a Task for each URL listed by the sitemaps of
+    sites, skipping those on other sites or disallowed by robots.txt.
+
+    Args:
+        sites: The URLs of the sites whose sitemaps to read.
+        session: A requests.Session HTTP client.
+        traverser: The PageTraverser whose rules the URLs must pass.
+        hint: Called with the (url, priority) of each URL which has a
+            <priority>, e.g. UrlScorer.hint. (Optional)
+    """
+    for site in sites:
+        key = site_key(site)
+        for entry in sitemap_urls(find_sitemaps(site, session), session):
+            if site_key(entry.loc) != key:
+                logging.debug('Skipping %s from %s: not on %s.',
+                              entry.loc, entry.sitemap, key)
+                continue
+            if traverser.is_disallowed(entry.loc):
+                logging.debug('Skipping %s from %s: disallowed.',
+                              entry.loc, entry.sitemap)
+                continue
+            if hint and entry.priority is not None:
+                hint(entry.loc, entry.priority)
+            yield Task(url=entry.loc, depth=1, referrer=entry.sitemap,
+                       lastmod=entry.lastmod)
@@ -0,0 +1,248 @@
+"""
+Crawl state persisted to disk, so that a crawl can be stopped and resumed, or
+so that it needn't all fit in memory.
+"""
+import os
+import sqlite3
+import threading
+from collections import deque
+from Queue import Queue
+
+from crul import Task
+
+
+class CrawlState(object):
+    """CrawlState keeps the frontier of pending tasks and the set of seen URLs
+    in an SQLite database within state_dir. Tasks remain in the database until
+    they are completed, so those in flight when the crawl is stopped are
+    pending again when it's resumed.
+    """
+    def __init__(self, state_dir):
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            os.path.join(state_dir, 'crawl.db'),
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS seen (url TEXT PRIMARY KEY)'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS frontier ('
+            '  id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            '  url TEXT, depth INTEGER, referrer TEXT, lastmod REAL,'
+            '  attempt INTEGER NOT NULL DEFAULT 0'
+            ')'
+        )
+        # Databases from earlier versions lack the later columns.
+        self.add_columns('frontier', [
+            ('lastmod', 'REAL'), ('attempt', 'INTEGER NOT NULL DEFAULT 0'),
+        ])
+        self.seen = SeenStore(self)
+
+    def add_columns(self, table, columns):
+        """add_columns adds those of columns, a list of (name, type), which
+        table lacks.
+        """
+        existing = set(row[1] for row in self.db.execute(
+            'PRAGMA table_info(%s)' % table
+        ))
+        for name, kind in columns:
+            if name not in existing:
+                self.db.execute(
+                    'ALTER TABLE %s ADD COLUMN %s %s' % (table, name, kind)
+                )
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def frontier(self, maxsize=0):
+        return DiskQueue(self, maxsize)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class SeenStore(object):
+    """SeenStore is the set-like collection of URLs in CrawlState used as
+    PageTraverser.seen.
+    """
+    def __init__(self, state):
+        self.state = state
+
+    def __contains__(self, url):
+        return bool(self.state.execute(
+            'SELECT 1 FROM seen WHERE url = ?', (url,)
+        ))
+
+    def __len__(self):
+        return self.state.execute('SELECT COUNT(*) FROM seen')[0][0]
+
+    def add(self, url):
+        self.add_new(url)
+
+    def add_new(self, url):
+        with self.state.lock:
+            return self.state.db.execute(
+                'INSERT OR IGNORE INTO seen (url) VALUES (?)', (url,)
+            ).rowcount == 1
+
+
+class DiskQueue(Queue):
+    """DiskQueue is a Queue of Tasks stored in CrawlState. Values which are
+    not Tasks (i.e. kill signals) are held in memory, after the Tasks.
+
+    Following the use of the queue by crul.scrape.worker, task_done marks the
+    task most recently taken by the calling thread as completed, unless it was
+    deferred.
+    """
+    def __init__(self, state, maxsize=0):
+        self.state = state
+        Queue.__init__(self, maxsize)
+        # Resume the tasks which were not completed last time.
+        self.unfinished_tasks = self.pending
+
+    def _init(self, maxsize):
+        self.signals = []
+        self.cursor = 0
+        self.leases = threading.local()
+        #: deferred maps the url of each deferred task to its row.
+        self.deferred = {}
+        self.pending = self.state.execute('SELECT COUNT(*) FROM frontier')[0][0]
+
+    def _qsize(self, len=len):
+        return self.pending + len(self.signals)
+
+    def _put(self, item):
+        if not isinstance(item, Task):
+            self.signals.append(item)
+            return
+        self.state.execute(
+            'INSERT INTO frontier (url, depth, referrer, lastmod, attempt) '
+            'VALUES (?, ?, ?, ?, ?)', tuple(item)
+        )
+        self.pending += 1
+        # Only once it's back is the deferred row of the task deleted: were
+        # the crawl stopped in between, it would be requested twice, not lost.
+        row = self.deferred.pop(item.url, None)
+        if row is not None:
+            self.state.execute('DELETE FROM frontier WHERE id = ?', (row,))
+
+    def _get(self):
+        if not self.pending:
+            return self.signals.pop(0)
+        row = self.state.execute(
+            'SELECT id, url, depth, referrer, lastmod, attempt FROM frontier '
+            'WHERE id > ? '
+            'ORDER BY id LIMIT 1', (self.cursor,)
+        )[0]
+        self.cursor = self.leases.id = row[0]
+        self.pending -= 1
+        return Task(*row[1:])
+
+    def defer(self, task):
+        """defer keeps the task most recently taken by the calling thread in
+        the database, as task (e.g. its next attempt), until task is put back
+        (e.g. by a RetryQueue), rather than deleting it once it's done.
+        """
+        lease = getattr(self.leases, 'id', None)
+        if lease is None:
+            return
+        self.state.execute('UPDATE frontier SET attempt = ? WHERE id = ?',
+                           (task.attempt, lease))
+        with self.mutex:
+            self.deferred[task.url] = lease
+        self.leases.id = None
+
+    def task_done(self):
+        lease = getattr(self.leases, 'id', None)
+        if lease is not None:
+            self.state.execute('DELETE FROM frontier WHERE id = ?', (lease,))
+            self.leases.id = None
+        Queue.task_done(self)
+
+
+class SpillQueue(Queue):
+    """SpillQueue is a FIFO Queue of Tasks which holds up to memory_size of
+    them in memory, spilling the rest to a temporary SQLite database (deleted
+    once the queue is closed). Spilled tasks are written, and read back, in
+    batches of batch_size. Values which are not Tasks (i.e. kill signals) are
+    held in memory, after the Tasks.
+    """
+    def __init__(self, memory_size=10000, batch_size=1000):
+        self.memory_size = memory_size
+        self.batch_size = min(batch_size, memory_size)
+        Queue.__init__(self)
+
+    def _init(self, maxsize):
+        self.memory = deque()
+        self.signals = []
+        # Tasks are spilled to the overflow list, then to disk once there's a
+        # batch of them: those on disk are older than those in overflow.
+        self.overflow = []
+        self.on_disk = 0
+        # An empty filename opens a private database on disk, deleted once
+        # closed.
+        self.db = sqlite3.connect('', check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute(
+            'CREATE TABLE spill ('
+            '  id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            '  url TEXT, depth INTEGER, referrer TEXT, lastmod REAL,'
+            '  attempt INTEGER'
+            ')'
+        )
+
+    @property
+    def spilled(self):
+        return self.on_disk + len(self.overflow)
+
+    def _qsize(self, len=len):
+        return len(self.memory) + self.spilled + len(self.signals)
+
+    def _put(self, item):
+        if not isinstance(item, Task):
+            self.signals.append(item)
+        elif self.spilled or len(self.memory) >= self.memory_size:
+            self.overflow.append(tuple(item))
+            if len(self.overflow) >= self.batch_size:
+                self.db.executemany(
+                    'INSERT INTO spill (url, depth, referrer, lastmod, attempt)'
+                    ' VALUES (?, ?, ?, ?, ?)', self.overflow
+                )
+                self.on_disk += len(self.overflow)
+                self.overflow = []
+        else:
+            self.memory.append(item)
+
+    def _get(self):
+        if not self.memory and self.spilled:
+            self.unspill()
+        if self.memory:
+            return self.memory.popleft()
+        return self.signals.pop(0)
+
+    def unspill(self):
+        """unspill moves the oldest batch of spilled tasks into memory."""
+        if self.on_disk:
+            rows = self.db.execute(
+                'SELECT id, url, depth, referrer, lastmod, attempt FROM spill '
+                'ORDER BY id LIMIT ?', (self.batch_size,)
+            ).fetchall()
+            self.db.execute('DELETE FROM spill WHERE id <= ?', (rows[-1][0],))
+            self.on_disk -= len(rows)
+            tasks = [row[1:] for row in rows]
+        else:
+            tasks = self.overflow[:self.batch_size]
+            del self.overflow[:self.batch_size]
+        self.memory.extend(Task(*task) for task in tasks)
+
+    def close(self):
+        with self.mutex:
+            self.db.close()
@@ -1,10 +1,49 @@
+import gzip
+import io
+import os
+import pickle
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
+from Queue import Empty, Queue
+from StringIO import StringIO
 
 import responses
 import requests
+from requests.structures import CaseInsensitiveDict
 
-from crul.__main__ import fetch_robots_txt, parse_crawl_delay
-from crul.traverse import DisallowedSet, trim_fragment
+from crul import JSONSerialiser, Link, Page, Task, green
+from crul.dedupe import ContentIndex, hamming, simhash
+from crul.graph import LinkGraph, write_dot, write_report
+from crul.metrics import Histogram, Metrics
+from crul.output import SitemapSink, output_sitemap, render_json
+from crul.parse import PageParser, ProcessPageParser
+from crul.recrawl import PreviousCrawl
+from crul.replay import (
+    RecordReader, RecordWriter, parallel_replay, read_pages,
+)
+from crul.retry import RetryPolicy, classify
+from crul.robots import (
+    DisallowedSet, RobotsCache, fetch_robots_txt, parse_crawl_delay,
+    parse_rules,
+)
+from crul.schedule import (
+    AdaptiveThrottle, HostScheduler, PriorityFrontier, UrlScorer,
+    parse_retry_after,
+)
+from crul.scrape import Fetcher, crawl_session, site_crawl, worker_request
+from crul.seen import (
+    BloomFilter, FingerprintSet, ScalableBloomFilter, StripedSet,
+)
+from crul.sink import BackgroundWriter, FileSink, shard_path
+from crul.sitemap import parse_lastmod, sitemap_tasks, sitemap_urls
+from crul.state import CrawlState, SpillQueue
+from crul.traverse import PageTraverser, trim_fragment
+from crul.urls import LRUMemo, UrlNormalizer
 
 
 class FetchRobotsTxtTest(unittest.TestCase):
@@ -51,6 +90,376 @@ class ParseCrawlDelayTest(unittest.TestCase):
         self.assertEqual(parse_crawl_delay(None, 'Crawl-delay: 1.5sdf'), 1.5)
         self.assertEqual(parse_crawl_delay(None, 'Crawl-delay: sdf'), 0)
 
+    def test_agent(self):
+        robots_txt = """
+            User-agent: *
+            Crawl-delay: 5
+
+            User-agent: crul
+            Crawl-delay: 1
+        """
+        self.assertEqual(parse_crawl_delay('crul/0.1 (+http://x)', robots_txt), 1)
+        self.assertEqual(parse_crawl_delay('other/1.0', robots_txt), 5)
+
+
+class ParseRulesTest(unittest.TestCase):
+    robots_txt = """
+        # Everyone else.
+        User-agent: *
+        Disallow: /
+
+        User-agent: googlebot
+        User-agent: crul
+        Disallow: /private
+        Allow: /private/public
+
+        User-agent: crul-images
+        Disallow: /images
+
+        User-agent: rul
+        Disallow: /rul
+    """
+
+    def test_group(self):
+        self.assertEqual(parse_rules('crul/0.1', self.robots_txt),
+                         [(False, '/private'), (True, '/private/public')])
+        self.assertEqual(parse_rules('Crul-Images/0.1', self.robots_txt),
+                         [(False, '/images')])
+        self.assertEqual(parse_rules('other', self.robots_txt), [(False, '/')])
+        # Product tokens are matched whole, not in part.
+        self.assertEqual(parse_rules('rul', self.robots_txt), [(False, '/rul')])
+        self.assertEqual(parse_rules('crul-img', self.robots_txt),
+                         [(False, '/')])
+
+    def test_no_agent(self):
+        self.assertEqual(parse_rules(None, 'Disallow: /a\nDisallow:'),
+                         [(False, '/a')])
+
+
+class RobotsCacheTest(unittest.TestCase):
+    @responses.activate
+    def test_per_site(self):
+        responses.add(responses.GET, 'http://slow.test/robots.txt',
+                      body='Crawl-delay: 2\nDisallow: /private')
+        responses.add(responses.GET, 'http://fast.test/robots.txt', status=404)
+
+        robots = RobotsCache(requests.Session(), 'crul-test',
+                             disallowed=['/tmp'])
+        robots.prefetch(['http://slow.test/', 'http://fast.test/a'], 2)
+        self.assertEqual(robots.crawl_delay('http://slow.test/b'), 2)
+        self.assertEqual(robots.crawl_delay('http://fast.test/'), 0)
+        self.assertTrue('/private' in robots.disallowed('http://slow.test/'))
+        self.assertFalse('/private' in robots.disallowed('http://fast.test/'))
+        self.assertTrue('/tmp' in robots.disallowed('http://fast.test/'))
+        self.assertEqual(len(responses.calls), 2)
+
+
+class HostSchedulerTest(unittest.TestCase):
+    def task(self, url):
+        return Task(url=url, depth=0, referrer=None)
+
+    def test_round_robin(self):
+        scheduler = HostScheduler()
+        for url in ['http://a.test/1', 'http://a.test/2', 'http://b.test/1']:
+            scheduler.put(self.task(url))
+        self.assertEqual(
+            [scheduler.get().url for _ in xrange(3)],
+            ['http://a.test/1', 'http://b.test/1', 'http://a.test/2']
+        )
+
+    def test_delay(self):
+        scheduler = HostScheduler(
+            lambda url: 60 if url.startswith('http://slow.test') else 0
+        )
+        for url in ['http://slow.test/1', 'http://slow.test/2',
+                    'http://fast.test/1', 'http://fast.test/2']:
+            scheduler.put(self.task(url))
+        self.assertEqual(
+            [scheduler.get().url for _ in xrange(3)],
+            ['http://slow.test/1', 'http://fast.test/1', 'http://fast.test/2']
+        )
+        with self.assertRaises(Empty):
+            scheduler.get(block=False)
+
+    def test_throttle(self):
+        throttle = AdaptiveThrottle(max_concurrency=2)
+        scheduler = HostScheduler(throttle=throttle)
+        for url in ['http://a.test/1', 'http://a.test/2', 'http://b.test/1']:
+            scheduler.put(self.task(url))
+        # a.test has its one request in flight, so b.test's task is next.
+        self.assertEqual([scheduler.get().url for _ in xrange(2)],
+                         ['http://a.test/1', 'http://b.test/1'])
+        with self.assertRaises(Empty):
+            scheduler.get(block=False)
+
+        # Once a.test's request is over, the waiting worker takes its task.
+        taken = []
+        t = threading.Thread(target=lambda: taken.append(scheduler.get()))
+        t.daemon = True
+        t.start()
+        t.join(0.05)
+        self.assertEqual(taken, [])
+        throttle.release('http://a.test/1')
+        t.join(1)
+        self.assertEqual([task.url for task in taken], ['http://a.test/2'])
+        self.assertEqual(throttle.host('http://a.test/').in_flight, 1)
+
+    def test_join(self):
+        scheduler, signal = HostScheduler(), object()
+        scheduler.put(self.task('http://a.test/'))
+        scheduler.get()
+        scheduler.task_done()
+        scheduler.join()
+        scheduler.put(signal)
+        self.assertIs(scheduler.get(), signal)
+        scheduler.task_done()
+        self.assertEqual(scheduler.unfinished_tasks, 0)
+
+
+class AdaptiveThrottleTest(unittest.TestCase):
+    url = 'http://site.test/'
+
+    def test_aimd(self):
+        throttle = AdaptiveThrottle(max_concurrency=4)
+        host = throttle.host(self.url)
+        self.assertEqual(host.limit, 1)
+
+        # Ramp up by one request in flight for each limit's worth of
+        # healthy responses.
+        for limit in [2, 2, 3, 3, 3, 4, 4]:
+            throttle.observe(self.url, 200, latency=0.1)
+            self.assertEqual(int(host.limit), limit)
+
+        # Halve on errors, but only once for requests in flight together.
+        throttle.observe(self.url, 503, latency=0.1)
+        self.assertEqual(host.limit, 2)
+        throttle.observe(self.url, 503, latency=0.1)
+        self.assertEqual(host.limit, 2)
+
+        # Then space out requests, and close the gaps again once healthy.
+        for limit, delay in [(1, 0), (1, 0.25), (1, 0.5)]:
+            host.backed_off = 0  # A later round of requests.
+            throttle.observe(self.url, 429, latency=0.1)
+            self.assertEqual((host.limit, host.delay), (limit, delay))
+        for limit, delay in [(1, 0.25), (1, 0), (2, 0)]:
+            throttle.observe(self.url, 200, latency=0.1)
+            self.assertEqual((host.limit, host.delay), (limit, delay))
+
+    def test_min_delay(self):
+        throttle = AdaptiveThrottle(min_delay=lambda url: 2.0)
+        host = throttle.host(self.url)
+        host.delay = 4.0
+        throttle.observe(self.url, 200)
+        throttle.observe(self.url, 200)
+        self.assertEqual(host.delay, 3.5)
+        host.delay = 2.0
+        throttle.observe(self.url, 200)
+        self.assertEqual((host.limit, host.delay), (2, 2.0))
+
+    def test_slowing(self):
+        throttle = AdaptiveThrottle(max_concurrency=4, initial_concurrency=4)
+        host = throttle.host(self.url)
+        throttle.observe(self.url, 200, latency=0.1)
+        throttle.observe(self.url, 200, latency=0.12)
+        self.assertEqual(host.limit, 4)
+        throttle.observe(self.url, 200, latency=2.0)
+        self.assertEqual(host.limit, 2)
+
+    def test_retry_after(self):
+        self.assertEqual(parse_retry_after('120'), 120)
+        self.assertEqual(parse_retry_after(
+            'Wed, 21 Oct 2015 07:28:00 GMT', now=1445412450), 30)
+        self.assertIsNone(parse_retry_after('soon'))
+
+        throttle = AdaptiveThrottle()
+        throttle.observe(self.url, 429, latency=0.1, retry_after='30')
+        self.assertGreater(throttle.host(self.url).ready_at, time.time() + 25)
+
+    def test_acquire(self):
+        throttle = AdaptiveThrottle(max_concurrency=2, initial_concurrency=2)
+        throttle.acquire(self.url)
+        throttle.acquire(self.url)
+        # Another site is throttled separately.
+        throttle.acquire('http://other.test/')
+
+        acquired = threading.Event()
+        t = threading.Thread(
+            target=lambda: throttle.acquire(self.url) or acquired.set()
+        )
+        t.daemon = True
+        t.start()
+        self.assertFalse(acquired.wait(0.05))
+        throttle.release(self.url)
+        self.assertTrue(acquired.wait(1))
+
+    @responses.activate
+    def test_crawl(self):
+        responses.add(responses.GET, 'http://site.test/',
+                      body='<a href="/a">A</a><a href="/b">B</a>',
+                      content_type='text/html')
+        responses.add(responses.GET, 'http://site.test/a', status=503,
+                      adding_headers={'Retry-After': '0'})
+        responses.add(responses.GET, 'http://site.test/b', body='B',
+                      content_type='text/html')
+
+        throttle = AdaptiveThrottle(max_concurrency=2)
+        pages = list(site_crawl(
+            requests.Session(), 'http://site.test/', 4, 0,
+            parser=PageParser(), traverser=PageTraverser(), throttle=throttle,
+        ))
+        self.assertEqual(len(pages), 3)
+        self.assertLessEqual(
+            throttle.rates()['http://site.test']['concurrency'], 2
+        )
+        host = throttle.host('http://site.test/')
+        self.assertEqual((host.responses, host.in_flight), (3, 0))
+
+
+class RetryTest(unittest.TestCase):
+    def test_classify(self):
+        self.assertEqual(classify(requests.exceptions.ConnectTimeout()),
+                         'timeout')
+        self.assertEqual(classify(requests.exceptions.ConnectionError()),
+                         'connection')
+        self.assertIsNone(classify(requests.exceptions.InvalidURL()))
+        self.assertEqual(classify(status=429), 'throttled')
+        self.assertEqual(classify(status=503), 'server')
+        self.assertIsNone(classify(status=404))
+
+    def test_backoff(self):
+        policy = RetryPolicy(retries=3, delay=1, max_delay=3, jitter=0,
+                             classes={'server': (1, 5)})
+        self.assertEqual(
+            [policy.backoff('timeout', n) for n in xrange(4)], [1, 2, 3, None]
+        )
+        self.assertEqual(policy.backoff('server', 0), 3)
+        self.assertIsNone(policy.backoff('server', 1))
+        self.assertEqual(policy.backoff('throttled', 0, retry_after='2'), 2)
+
+        jittered = RetryPolicy(delay=1, jitter=0.5).backoff('timeout', 1)
+        self.assertTrue(1 <= jittered <= 2)
+
+    @responses.activate
+    def test_crawl(self):
+        links = ''.join('<a href="/%s">%s</a>' % (p, p) for p in 'abc')
+        responses.add(responses.GET, 'http://site.test/', body=links,
+                      content_type='text/html')
+        # /a fails to connect the first time only, /b is always unavailable
+        # and /c always fails to connect.
+        attempts = {'a': 0}
+
+        def flaky(request):
+            attempts['a'] += 1
+            if attempts['a'] == 1:
+                raise requests.exceptions.ConnectionError('reset')
+            return (200, {'Content-Type': 'text/html'}, '<title>A</title>')
+
+        responses.add_callback(responses.GET, 'http://site.test/a', flaky)
+        responses.add(responses.GET, 'http://site.test/b', status=503,
+                      adding_headers={'Retry-After': '0'})
+        responses.add(responses.GET, 'http://site.test/c',
+                      body=requests.exceptions.ConnectionError('refused'))
+
+        metrics = Metrics()
+        pages = dict((p.url, p) for p in site_crawl(
+            requests.Session(), 'http://site.test/', 2, 0,
+            parser=PageParser(), traverser=PageTraverser(), metrics=metrics,
+            retry=RetryPolicy(retries=2, delay=0.01),
+        ))
+        self.assertEqual(len(pages), 4)
+        self.assertEqual(pages['http://site.test/a'].title, 'A')
+        self.assertEqual(pages['http://site.test/b'].status, 503)
+        failed = pages['http://site.test/c']
+        self.assertFalse(failed.fetched)
+        self.assertIn('refused', failed.error)
+
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['retries.connection'], 3)
+        self.assertEqual(counters['retries.server'], 2)
+
+    @unittest.skipIf(green.gevent is None, 'gevent is not installed')
+    @responses.activate
+    def test_green_crawl(self):
+        responses.add(responses.GET, 'http://site.test/',
+                      body='<a href="/a">A</a>', content_type='text/html')
+        responses.add(responses.GET, 'http://site.test/a', status=500)
+
+        pages = list(green.site_crawl(
+            requests.Session(), 'http://site.test/', 10, 0,
+            parser=PageParser(), traverser=PageTraverser(),
+            retry=RetryPolicy(retries=1, delay=0.01),
+        ))
+        self.assertEqual(sorted(p.status for p in pages), [200, 500])
+
+
+class PriorityFrontierTest(unittest.TestCase):
+    def task(self, path, depth=1):
+        return Task(url='http://site.test' + path, depth=depth, referrer=None)
+
+    def drain(self, frontier):
+        return [frontier.get().url[16:] for _ in xrange(frontier.qsize())]
+
+    def test_depth(self):
+        frontier = PriorityFrontier()
+        for path, depth in [('/deep', 3), ('/a', 1), ('/b', 1), ('/c', 2)]:
+            frontier.put(self.task(path, depth))
+        self.assertEqual(self.drain(frontier), ['/a', '/b', '/c', '/deep'])
+
+    def test_weights(self):
+        scorer = UrlScorer(patterns=[(r'[?&]facet=', 5), (r'^.*/docs/', -1)])
+        scorer.hint('http://site.test/important', 1.0)
+        frontier = PriorityFrontier(scorer)
+        for path in ['/list?facet=red', '/list', '/docs/a', '/important']:
+            frontier.put(self.task(path, depth=2))
+        self.assertEqual(self.drain(frontier),
+                         ['/docs/a', '/important', '/list', '/list?facet=red'])
+        self.assertEqual(len(scorer.hints), 0)
+
+        # The oldest hints are forgotten, rather than the newest ignored.
+        scorer = UrlScorer(max_hints=2)
+        for path in ['/a', '/b', '/c']:
+            scorer.hint('http://site.test' + path, 1.0)
+        self.assertEqual([scorer.base(self.task(path, depth=2))
+                          for path in ['/a', '/c']], [2.0, 1.0])
+
+    def test_inlinks(self):
+        frontier = PriorityFrontier()
+        for path in ['/a', '/b', '/c']:
+            frontier.put(self.task(path))
+        for _ in xrange(3):
+            frontier.note_link('http://site.test/c')
+        frontier.note_link('http://site.test/b')
+        frontier.note_link('http://site.test/gone')
+        self.assertEqual(frontier.qsize(), 3)
+        self.assertEqual(self.drain(frontier), ['/c', '/b', '/a'])
+
+    def test_signals(self):
+        frontier, signal = PriorityFrontier(), object()
+        frontier.put(self.task('/a'))
+        frontier.put(self.task('/a'))
+        frontier.put(signal)
+        self.assertEqual(frontier.unfinished_tasks, 2)
+        self.assertIs(frontier.get(), signal)
+        self.assertEqual(frontier.get().url, 'http://site.test/a')
+        frontier.task_done()
+        frontier.task_done()
+        frontier.join()
+
+    @responses.activate
+    def test_budget(self):
+        for n in xrange(5):
+            responses.add(
+                responses.GET, 'http://site.test/%d' % n,
+                content_type='text/html',
+                body=''.join('<a href="/%d">x</a>' % m for m in xrange(5)),
+            )
+        pages = list(site_crawl(
+            requests.Session(), 'http://site.test/0', 2, 0,
+            parser=PageParser(), traverser=PageTraverser(),
+            frontier=PriorityFrontier(), max_pages=3,
+        ))
+        self.assertEqual(len(pages), 3)
+
 
 class DisallowedSetTest(unittest.TestCase):
     def test_empty(self):
@@ -64,6 +473,239 @@ class DisallowedSetTest(unittest.TestCase):
         self.assertTrue('/private-files' in d)
         self.assertTrue('/private/calendar' in d)
         self.assertTrue('private' in d)
+        self.assertFalse('/public' in d)
+
+    def test_allow(self):
+        d = DisallowedSet(['/private', '/*.pdf'], allowed=['/private/public'])
+        self.assertTrue('/private/secret' in d)
+        self.assertFalse('/private/public/page' in d)
+        self.assertTrue('/private/file.pdf' in d)
+        self.assertTrue('/public/file.pdf' in d)
+
+    def test_tie(self):
+        d = DisallowedSet(['/page'], allowed=['/page'])
+        self.assertFalse('/page' in d)
+
+    def test_wildcard(self):
+        d = DisallowedSet(['/*/edit', '/search?*q=', '/*.php$'])
+        self.assertTrue('/wiki/edit' in d)
+        self.assertFalse('/edit' in d)
+        self.assertTrue('/search?page=2&q=x' in d)
+        self.assertTrue('/index.php' in d)
+        self.assertFalse('/index.php?x=1' in d)
+
+    def test_exact(self):
+        d = DisallowedSet(['/$'])
+        self.assertTrue('/' in d)
+        self.assertFalse('/page' in d)
+
+    def test_many(self):
+        d = DisallowedSet(['/dir%d/*.html' % i for i in xrange(250)],
+                          allowed=['/dir12/ok*.html'])
+        self.assertTrue('/dir249/a.html' in d)
+        self.assertTrue('/dir12/a.html' in d)
+        self.assertFalse('/dir12/ok.html' in d)
+        self.assertFalse('/dir250/a.html' in d)
+
+
+class LinkGraphTest(unittest.TestCase):
+    def page(self, path, links, depth=1, status=200):
+        url = 'http://site.test' + path
+        return Page(
+            url=url, canonical_url=url, fetched=True, headers={},
+            no_index=False, title=None, depth=depth, status=status, assets=[],
+            links=[Link(type='anchor', href='http://site.test' + l,
+                        no_follow=False, external=False, depth=depth + 1,
+                        referrer=url) for l in links],
+        )
+
+    def setUp(self):
+        self.graph = LinkGraph().add_pages([
+            self.page('/', ['/a', '/b', '/', '/a#top'], depth=0),
+            self.page('/a', ['/b', '/missing']),
+            self.page('/b', ['/a', '/c']),
+            self.page('/c', ['/']),
+            self.page('/missing', [], status=404),
+            self.page('/lonely', ['/a']),
+        ])
+
+    def url(self, path):
+        return self.graph.ids['http://site.test' + path]
+
+    def test_adjacency(self):
+        self.assertEqual(len(self.graph), 6)
+        self.assertEqual(self.graph.num_links(), 8)
+        in_degree = self.graph.in_degree()
+        self.assertEqual(in_degree[self.url('/a')], 3)
+        self.assertEqual(in_degree[self.url('/')], 1)
+
+    def test_pagerank(self):
+        rank = self.graph.pagerank()
+        self.assertAlmostEqual(rank.sum(), 1.0)
+        self.assertEqual(rank.argmax(), self.url('/a'))
+        self.assertLess(rank[self.url('/lonely')], rank[self.url('/c')])
+
+    def test_click_depth(self):
+        depth = self.graph.click_depth()
+        self.assertEqual(
+            [depth[self.url(p)] for p in ['/', '/a', '/c', '/lonely']],
+            [0, 1, 2, -1]
+        )
+
+    def test_reports(self):
+        self.assertEqual(self.graph.orphans(), ['http://site.test/lonely'])
+        self.assertEqual(self.graph.broken_links(), [
+            (404, 'http://site.test/a', 'http://site.test/missing'),
+        ])
+
+    def test_report_unicode(self):
+        # URLs read as unicode and as UTF-8 bytes are written alike.
+        graph = LinkGraph().add_pages([
+            self.page('/', ['/caf\xc3\xa9'], depth=0),
+            self.page(u'/na\xefve', []),
+            self.page('/caf\xc3\xa9', [], status=404),
+        ])
+        out = io.BytesIO()
+        write_report(graph, out)
+        report = out.getvalue().decode('utf-8')
+        self.assertIn(u'  http://site.test/na\xefve\n', report)
+        self.assertIn(u'404 http://site.test/ -> http://site.test/caf\xe9',
+                      report)
+
+    def test_dot(self):
+        out = StringIO()
+        write_dot(self.graph, out)
+        dot = out.getvalue()
+        self.assertTrue(dot.startswith('digraph crawl {\n'))
+        self.assertIn('label="http://site.test/missing", color=red', dot)
+        self.assertEqual(dot.count(' -> '), 8)
+
+
+class HistogramTest(unittest.TestCase):
+    def test_percentile(self):
+        h = Histogram()
+        self.assertEqual(h.percentile(0.5), 0)
+        for _ in xrange(98):
+            h.observe(0.003)
+        h.observe(1.5)
+        h.observe(1.5)
+        self.assertEqual(h.percentile(0.5), 0.004)
+        self.assertEqual(h.percentile(0.99), 1.5)
+        self.assertEqual(h.snapshot()['count'], 100)
+
+
+class PageTraverserMetricsTest(unittest.TestCase):
+    def link(self, href, **kwargs):
+        fields = dict(type='anchor', href=href, no_follow=False,
+                      external=False, depth=1, referrer='http://site.test/')
+        fields.update(kwargs)
+        return Link(**fields)
+
+    def test_counts(self):
+        metrics = Metrics()
+        traverser = PageTraverser(max_depth=1, disallowed=DisallowedSet(['/x']),
+                                  metrics=metrics)
+        traverser.follow(Queue(), Page(
+            url='http://site.test/', canonical_url='http://site.test/',
+            fetched=True, headers={}, no_index=False, title=None, depth=0,
+            assets=[], links=[
+                self.link('http://site.test/a'),
+                self.link('http://site.test/a'),
+                self.link('mailto:me@site.test'),
+                self.link('http://site.test/b', no_follow=True),
+                self.link('http://other.test/', external=True),
+                self.link('http://site.test/c', depth=2),
+                self.link('http://site.test/d.png'),
+                self.link('http://site.test/x/y'),
+            ],
+        ))
+        self.assertEqual(metrics.snapshot()['counters'], {
+            'links.discovered': 8,
+            'links.queued': 1,
+            'links.skipped.seen': 1,
+            'links.skipped.scheme': 1,
+            'links.skipped.nofollow': 1,
+            'links.skipped.external': 1,
+            'links.skipped.depth': 1,
+            'links.skipped.suffix': 1,
+            'links.skipped.disallowed': 1,
+        })
+
+    def test_max_pending(self):
+        metrics = Metrics()
+        traverser = PageTraverser(metrics=metrics, max_pending=2)
+        traverser.queue_url(Queue(), 'http://site.test/')
+        pending = Queue()
+        traverser.follow(pending, Page(
+            url='http://site.test/', canonical_url=None, fetched=True,
+            headers={}, no_index=False, title=None, depth=0, assets=[],
+            links=[self.link('http://site.test/' + p)
+                   for p in ['', 'a', 'b', 'c']],
+        ))
+        self.assertEqual(pending.qsize(), 2)
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['links.skipped.seen'], 1)
+        self.assertEqual(counters['links.skipped.pending'], 1)
+        self.assertEqual(metrics.snapshot()['peaks']['pending'], 2)
+
+        # Dropped links can be queued once there's room.
+        pending.get()
+        self.assertTrue(traverser.queue_url(pending, 'http://site.test/c'))
+
+
+class UrlNormalizerTest(unittest.TestCase):
+    def test_key(self):
+        urls = UrlNormalizer()
+        self.assertEqual(urls.key('HTTP://Site.Test:80/A/?b=1&a=2#top'),
+                         'http://site.test/A/?b=1&a=2')
+        self.assertEqual(urls.key('https://site.test:443/a/'),
+                         'https://site.test/a')
+        self.assertEqual(urls.key('https://site.test:80/'),
+                         'https://site.test:80')
+        self.assertEqual(urls.key('http://User@Site.test/'),
+                         'http://User@site.test')
+
+    def test_query(self):
+        urls = UrlNormalizer(sort_query=True, strip_params=['sid'])
+        self.assertEqual(urls.key('http://site.test/?b=1&sid=x&a=2'),
+                         'http://site.test/?a=2&b=1')
+        self.assertEqual(urls.key('http://site.test/a?sid=x'),
+                         'http://site.test/a')
+
+    def test_resolve(self):
+        urls = UrlNormalizer()
+        href, url = urls.resolve('http://site.test/a/', '../b?c#d')
+        self.assertEqual(href, 'http://site.test/b?c#d')
+        self.assertEqual((url.netloc, url.path), ('site.test', '/b'))
+        self.assertIs(urls.resolve('http://site.test/a/', '../b?c#d')[1], url)
+
+    def test_memo(self):
+        calls = []
+        memo = LRUMemo(lambda x: calls.append(x) or x * 2, maxsize=4)
+        for x in [1, 2, 1, 3, 1, 4, 5]:
+            self.assertEqual(memo(x), x * 2)
+        # 1 was used recently enough to be kept, 2 and 3 were dropped.
+        self.assertEqual(calls, [1, 2, 3, 4, 5])
+        memo(1)
+        memo(2)
+        self.assertEqual(calls, [1, 2, 3, 4, 5, 2])
+        self.assertLessEqual(len(memo), 4)
+
+    def test_pickle(self):
+        urls = UrlNormalizer(sort_query=True, strip_params=['sid'])
+        urls.key('http://site.test/')
+        copy = pickle.loads(pickle.dumps(urls))
+        self.assertEqual(len(copy.key_memo), 0)
+        self.assertEqual(copy.key('http://site.test/?sid=1&b&a'),
+                         'http://site.test/?a&b')
+
+    def test_traverser(self):
+        traverser, pending = PageTraverser(), Queue()
+        self.assertTrue(traverser.queue_url(pending, 'http://site.test/a'))
+        for url in ['HTTP://SITE.TEST/a', 'http://site.test:80/a#b',
+                    'http://site.test/a/']:
+            self.assertFalse(traverser.queue_url(pending, url))
+        self.assertEqual(pending.qsize(), 1)
 
 
 class TestTrimFragment(unittest.TestCase):
@@ -86,5 +728,813 @@ class TestTrimFragment(unittest.TestCase):
         )
 
 
+class CrawlSessionTest(unittest.TestCase):
+    def test_pool_size(self):
+        session = crawl_session('crul-test', 32)
+        adapter = session.get_adapter('https://site.test/')
+        self.assertEqual(adapter._pool_maxsize, 32)
+        self.assertEqual(session.headers['User-Agent'], 'crul-test')
+
+    def test_keep_alive(self):
+        session = crawl_session('crul-test', 4, pool_size=8, keep_alive=False)
+        self.assertEqual(session.get_adapter('http://site.test/')._pool_maxsize, 8)
+        self.assertEqual(session.headers['Connection'], 'close')
+
+
+class FetcherTest(unittest.TestCase):
+    def fetcher(self, **kwargs):
+        return Fetcher(requests.Session(), PageParser().looks_like_html,
+                       **kwargs)
+
+    @responses.activate
+    def test_skip(self):
+        responses.add(responses.GET, 'http://site.test/movie.mp4',
+                      body='x' * 100000, content_type='video/mp4',
+                      adding_headers={'Content-Length': '100000'})
+        fetcher = self.fetcher()
+        resp = fetcher.get('http://site.test/movie.mp4')
+        self.assertEqual(resp.content, b'')
+        self.assertEqual(fetcher.stats()['bodies_skipped'], 1)
+        self.assertEqual(fetcher.stats()['bytes_skipped'], 100000)
+        self.assertEqual(fetcher.stats()['bytes_read'], 0)
+
+    @responses.activate
+    def test_truncate(self):
+        responses.add(responses.GET, 'http://site.test/', body='x' * 100000,
+                      content_type='text/html')
+        fetcher = self.fetcher(max_body_bytes=1000)
+        self.assertEqual(len(fetcher.get('http://site.test/').content), 1000)
+        self.assertEqual(fetcher.stats()['bodies_truncated'], 1)
+        self.assertEqual(fetcher.stats()['bytes_read'], 1000)
+
+    @responses.activate
+    def test_head_unknown(self):
+        responses.add(responses.HEAD, 'http://site.test/data.bin',
+                      content_type='application/octet-stream')
+        fetcher = self.fetcher(head_unknown=True)
+        resp = fetcher.get('http://site.test/data.bin')
+        self.assertEqual(resp.request.method, 'HEAD')
+        self.assertEqual(fetcher.stats()['heads'], 1)
+        self.assertFalse(fetcher.unknown_extension('http://site.test/a.php'))
+        self.assertFalse(fetcher.unknown_extension('http://site.test/a/'))
+
+
+class GreenSiteCrawlTest(unittest.TestCase):
+    @unittest.skipIf(green.gevent is None, 'gevent is not installed')
+    @responses.activate
+    def test_crawl(self):
+        for path, body in [
+                ('/', '<a href="/a">A</a><a href="/b">B</a>'),
+                ('/a', '<a href="/">Home</a><a href="/b">B</a>'),
+                ('/b', '<title>B</title>')]:
+            responses.add(responses.GET, 'http://site.test' + path, body=body,
+                          content_type='text/html')
+
+        pages = list(green.site_crawl(
+            requests.Session(), 'http://site.test/', 10, 0,
+            parser=PageParser(), traverser=PageTraverser(),
+        ))
+        self.assertEqual(
+            sorted(p.url for p in pages),
+            ['http://site.test/', 'http://site.test/a', 'http://site.test/b']
+        )
+
+
+class ProcessPageParserTest(unittest.TestCase):
+    @responses.activate
+    def test_matches_parser(self):
+        responses.add(
+            responses.GET, 'http://site.test/', content_type='text/html',
+            body='<title>Hello</title><a href="/a">A</a><img src="/i.png">',
+        )
+        resp = requests.get('http://site.test/')
+
+        parser = ProcessPageParser(PageParser(), 1)
+        try:
+            self.assertEqual(parser.parse(resp, depth=2),
+                             PageParser().parse(resp, depth=2))
+        finally:
+            parser.close()
+
+
+class StreamParserTest(unittest.TestCase):
+    corpus = [
+        '',
+        '<title>Plain &amp; simple</title><a href="/a">A</a>',
+        '''<html><head>
+            <base href="http://site.test/sub/">
+            <title>Based</title>
+            <link rel="canonical" href="canon.html">
+            <link rel="stylesheet alternate" href="/style.css">
+            <meta name="robots" content="NOINDEX, nofollow">
+            <script src="app.js"></script>
+        </head><body>
+            <a href="rel.html">Relative</a>
+            <a href="http://other.test/" rel="nofollow">External</a>
+            <a name="anchorless">None</a>
+            <img src="//cdn.test/i.png"><iframe src="/frame"></iframe>
+            <object data="/movie.swf"></object>
+        </body></html>''',
+        '''<title>First</title><title>Second</title>
+            <link rel="canonical"><link rel="canonical" href="/late">
+            <a href="#top" rel="nofollow">Top</a><a href="/b">B</a>
+            <embed src="e.swf"><audio src="a.ogg"><video src="v.mp4">''',
+    ]
+
+    @responses.activate
+    def test_matches_soup(self):
+        for n, body in enumerate(self.corpus):
+            url = 'http://site.test/%d' % n
+            responses.add(responses.GET, url, body=body,
+                          content_type='text/html; charset=utf-8')
+            resp = requests.get(url)
+
+            soup = PageParser().parse(resp)
+            stream = PageParser('stream').parse(resp)
+            self.assertEqual(soup._replace(links=sorted(soup.links)),
+                             stream._replace(links=sorted(stream.links)))
+
+    @responses.activate
+    def test_extract(self):
+        responses.add(responses.GET, 'http://site.test/', body=self.corpus[2],
+                      content_type='text/html')
+        page = PageParser('stream').parse(requests.get('http://site.test/'))
+        self.assertEqual(page.title, 'Based')
+        self.assertEqual(page.canonical_url, 'http://site.test/sub/canon.html')
+        self.assertTrue(page.no_index)
+        self.assertEqual(
+            sorted((l.href, l.no_follow) for l in page.links),
+            [('http://other.test/', True), ('http://site.test/sub/rel.html', True)]
+        )
+        self.assertEqual(len(page.assets), 6)
+
+
+class CrawlStateTest(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir)
+
+    def test_resume(self):
+        state = CrawlState(self.state_dir)
+        state.seen.add('http://site.test')
+        frontier = state.frontier()
+        for n in xrange(3):
+            frontier.put(Task(url='http://site.test/%d' % n, depth=1,
+                              referrer='http://site.test'))
+        self.assertEqual(frontier.get().url, 'http://site.test/0')
+        frontier.task_done()
+        self.assertEqual(frontier.get().url, 'http://site.test/1')
+        state.close()
+
+        # The in-flight and untouched tasks are pending once more.
+        state = CrawlState(self.state_dir)
+        frontier = state.frontier()
+        self.assertEqual(frontier.qsize(), 2)
+        self.assertEqual(frontier.unfinished_tasks, 2)
+        self.assertEqual(frontier.get(), Task(url='http://site.test/1', depth=1,
+                                              referrer='http://site.test'))
+        self.assertEqual(frontier.get().url, 'http://site.test/2')
+        self.assertTrue('http://site.test' in state.seen)
+        self.assertFalse('http://site.test/3' in state.seen)
+
+    def test_migrate(self):
+        # The frontier of an earlier version had no lastmod.
+        db = sqlite3.connect(os.path.join(self.state_dir, 'crawl.db'))
+        db.execute('CREATE TABLE frontier (id INTEGER PRIMARY KEY '
+                   'AUTOINCREMENT, url TEXT, depth INTEGER, referrer TEXT)')
+        db.execute("INSERT INTO frontier (url, depth, referrer) "
+                   "VALUES ('http://site.test/', 0, NULL)")
+        db.commit()
+        db.close()
+
+        frontier = CrawlState(self.state_dir).frontier()
+        frontier.put(Task(url='http://site.test/a', depth=1, referrer=None,
+                          lastmod=86400.0))
+        self.assertEqual(frontier.get(), Task(url='http://site.test/',
+                                              depth=0, referrer=None))
+        self.assertEqual(frontier.get()[3:], (86400.0, 0))
+
+    @responses.activate
+    def test_retries(self):
+        responses.add(responses.GET, 'http://site.test/', status=503)
+        metrics = Metrics()
+        pages = list(site_crawl(
+            requests.Session(), 'http://site.test/', 1, 0,
+            parser=PageParser(), traverser=PageTraverser(),
+            frontier=CrawlState(self.state_dir).frontier(), metrics=metrics,
+            retry=RetryPolicy(retries=2, delay=0.01),
+        ))
+        # The attempts are counted across the trips through the database.
+        self.assertEqual([p.status for p in pages], [503])
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(metrics.snapshot()['counters']['retries.server'], 2)
+
+    def test_retry_resumed(self):
+        def crawl(state, retry):
+            return site_crawl(
+                requests.Session(), 'http://site.test/', 1, 0,
+                parser=PageParser(), traverser=PageTraverser(seen=state.seen),
+                frontier=state.frontier(), metrics=metrics, retry=retry,
+            )
+
+        # The crawl is stopped whilst the failed request waits to be retried.
+        metrics = Metrics()
+        with responses.RequestsMock() as mock:
+            mock.add(responses.GET, 'http://site.test/', status=503)
+            stopped = threading.Thread(target=list, args=(crawl(
+                CrawlState(self.state_dir), RetryPolicy(retries=2, delay=60),
+            ),))
+            stopped.daemon = True
+            stopped.start()
+            while not metrics.snapshot()['gauges'].get('retrying'):
+                time.sleep(0.01)
+
+        # Resumed, the request is retried, as its second attempt.
+        with responses.RequestsMock() as mock:
+            mock.add(responses.GET, 'http://site.test/', body='<p>Home</p>',
+                     content_type='text/html')
+            state = CrawlState(self.state_dir)
+            self.assertEqual(state.execute('SELECT url, attempt FROM frontier'),
+                             [('http://site.test/', 1)])
+            pages = list(crawl(state, RetryPolicy(retries=2, delay=0.01)))
+        self.assertEqual([p.status for p in pages], [200])
+        self.assertEqual(state.execute('SELECT COUNT(*) FROM frontier'),
+                         [(0,)])
+
+    @responses.activate
+    def test_unchanged_seeds(self):
+        responses.add(responses.GET, 'http://site.test/', body='<p>Home</p>',
+                      content_type='text/html')
+        previous = PreviousCrawl([Page(
+            url='http://site.test/a', canonical_url=None, fetched=1425211200,
+            headers={'Date': 'Sun, 01 Mar 2015 12:00:00 GMT', 'ETag': '"v1"'},
+            no_index=False, links=[], assets=[], title='Old', depth=1,
+        )])
+        metrics = Metrics()
+        pages = dict((p.url, p) for p in site_crawl(
+            requests.Session(), 'http://site.test/', 2, 0,
+            parser=PageParser(), traverser=PageTraverser(),
+            frontier=CrawlState(self.state_dir).frontier(), since=previous,
+            metrics=metrics, seeds=[Task(
+                url='http://site.test/a', depth=1, referrer=None,
+                lastmod=parse_lastmod('2015-02-01'),
+            )],
+        ))
+        # /a is reused, without being requested.
+        self.assertEqual(pages['http://site.test/a'].title, 'Old')
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(metrics.snapshot()['counters']['not_modified.lastmod'],
+                         1)
+
+    def test_signals(self):
+        frontier, signal = CrawlState(self.state_dir).frontier(), object()
+        frontier.put(signal)
+        frontier.put(Task(url='http://site.test/', depth=0, referrer=None))
+        self.assertEqual(frontier.get().url, 'http://site.test/')
+        self.assertIs(frontier.get(), signal)
+
+
+class SpillQueueTest(unittest.TestCase):
+    def test_fifo(self):
+        queue, signal = SpillQueue(memory_size=4, batch_size=3), object()
+        tasks = [Task(url='http://site.test/%d' % n, depth=n, referrer=None,
+                      lastmod=n * 1.5, attempt=n % 2) for n in xrange(20)]
+        for task in tasks[:10]:
+            queue.put(task)
+        self.assertEqual((len(queue.memory), queue.spilled), (4, 6))
+        self.assertEqual(queue.on_disk, 6)
+        got = [queue.get() for _ in xrange(7)]
+        for task in tasks[10:]:
+            queue.put(task)
+        queue.put(signal)
+        self.assertEqual(queue.qsize(), 14)
+        got += [queue.get() for _ in xrange(13)]
+        self.assertEqual(got, tasks)
+        self.assertIs(queue.get(), signal)
+        queue.close()
+
+    @responses.activate
+    def test_crawl(self):
+        for n in xrange(20):
+            responses.add(
+                responses.GET, 'http://site.test/%d' % n,
+                body=''.join('<a href="/%d">%d</a>' % (m, m)
+                             for m in xrange(n + 1, min(n + 5, 20))),
+                content_type='text/html')
+
+        pages = list(site_crawl(
+            requests.Session(), 'http://site.test/0', 4, 0,
+            parser=PageParser(), traverser=PageTraverser(),
+            frontier=SpillQueue(memory_size=2, batch_size=2), max_complete=1,
+        ))
+        self.assertEqual(len(pages), 20)
+
+
+class FingerprintSetTest(unittest.TestCase):
+    def test_grow(self):
+        seen = FingerprintSet(capacity=4)
+        urls = ['http://site.test/%d' % n for n in xrange(100)]
+        for url in urls:
+            seen.add(url)
+        seen.add(urls[0])
+        self.assertEqual(len(seen), 100)
+        self.assertTrue(all(url in seen for url in urls))
+        self.assertFalse('http://site.test/100' in seen)
+        self.assertLessEqual(seen.stats()['fill'], 0.5)
+
+
+class ScalableBloomFilterTest(unittest.TestCase):
+    def test_error_rate(self):
+        seen = ScalableBloomFilter(capacity=100, error_rate=0.01)
+        urls = ['http://site.test/%d' % n for n in xrange(1000)]
+        for url in urls:
+            seen.add(url)
+        self.assertTrue(all(url in seen for url in urls))
+        self.assertGreater(len(seen.filters), 1)
+
+        false_positives = sum(
+            'http://other.test/%d' % n in seen for n in xrange(1000)
+        )
+        self.assertLess(false_positives, 30)
+
+
+class BloomFilterTest(unittest.TestCase):
+    def test_positions(self):
+        bloom = BloomFilter(capacity=100, error_rate=0.01)
+        m = bloom.num_bits
+        # A second hash which is a multiple of m still spreads the positions.
+        for hashes in [(7, 0), (7, m), (7, 4 * m), (7, m - 1)]:
+            positions = bloom.positions(hashes)
+            self.assertEqual(len(set(positions)), bloom.num_hashes)
+            self.assertTrue(all(0 <= p < m for p in positions))
+
+
+class StripedSetTest(unittest.TestCase):
+    urls = ['http://site.test/%d' % n for n in xrange(500)]
+
+    def mark_concurrently(self, mark, num_threads=64):
+        """mark_concurrently marks every URL from each of many threads at
+        once, returning how many times a URL was said to be new.
+        """
+        start, new = threading.Event(), []
+
+        def run(seed):
+            urls = list(self.urls)
+            random.Random(seed).shuffle(urls)
+            start.wait()
+            new.append(sum(1 for url in urls if mark(url)))
+
+        threads = [threading.Thread(target=run, args=(n,))
+                   for n in xrange(num_threads)]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+        return sum(new)
+
+    def test_add_new(self):
+        seen = StripedSet(num_locks=5)
+        self.assertEqual(len(seen.locks), 8)
+        self.assertTrue(seen.add_new('http://site.test/'))
+        self.assertFalse(seen.add_new('http://site.test/'))
+        seen.add('http://site.test/a')
+        self.assertTrue('http://site.test/a' in seen)
+        self.assertFalse('http://site.test/b' in seen)
+        self.assertEqual(sorted(seen), ['http://site.test/',
+                                        'http://site.test/a'])
+        self.assertEqual(seen.stats()['count'], 2)
+
+    def test_concurrent(self):
+        for seen in [StripedSet(), FingerprintSet(capacity=4)]:
+            self.assertEqual(self.mark_concurrently(seen.add_new),
+                             len(self.urls))
+            self.assertEqual(len(seen), len(self.urls))
+
+        # False positives aside, no URL is new to the bloom filter twice.
+        seen = ScalableBloomFilter(capacity=100)
+        self.assertEqual(self.mark_concurrently(seen.add_new), len(seen))
+        self.assertGreater(len(seen), len(self.urls) * 0.99)
+
+        # Sets without add_new are marked under the traverser's lock.
+        traverser = PageTraverser(seen=set())
+        self.assertEqual(self.mark_concurrently(traverser.mark_seen),
+                         len(self.urls))
+
+    @responses.activate
+    def test_no_duplicate_fetches(self):
+        # The home page links to 64 pages, which each link to the same 64
+        # others, so that the workers find each of those at once.
+        def links(prefix):
+            return ''.join('<a href="/%s%d">%d</a>' % (prefix, n, n)
+                           for n in xrange(64))
+        responses.add(responses.GET, 'http://site.test/', body=links('a'),
+                      content_type='text/html')
+        for n in xrange(64):
+            responses.add(responses.GET, 'http://site.test/a%d' % n,
+                          body=links('b'), content_type='text/html')
+            responses.add(responses.GET, 'http://site.test/b%d' % n,
+                          body='<title>B</title>', content_type='text/html')
+
+        pages = list(site_crawl(
+            requests.Session(), 'http://site.test/', 64, 0,
+            parser=PageParser(), traverser=PageTraverser(),
+        ))
+        fetched = [call.request.url for call in responses.calls]
+        self.assertEqual(len(pages), 129)
+        self.assertEqual(len(fetched), 129)
+        self.assertEqual(len(set(fetched)), 129)
+
+
+class RecrawlTest(unittest.TestCase):
+    def setUp(self):
+        self.previous = PreviousCrawl([
+            PageParser().parse_html(self.response(
+                '<title>Old</title><a href="/a">A</a>', ETag='"v1"',
+            ), depth=1),
+        ])
+
+    def response(self, body, **headers):
+        with responses.RequestsMock() as mock:
+            mock.add(responses.GET, 'http://site.test/', body=body,
+                     content_type='text/html', adding_headers=headers)
+            return requests.get('http://site.test/')
+
+    def test_request_headers(self):
+        self.assertEqual(
+            self.previous.request_headers('http://site.test/'),
+            {'If-None-Match': '"v1"'}
+        )
+        self.assertEqual(self.previous.request_headers('http://site.test/a'), {})
+
+    @responses.activate
+    def test_not_modified(self):
+        def respond(req):
+            if req.headers.get('If-None-Match') == '"v1"':
+                return (304, {}, '')
+            return (200, {'Content-Type': 'text/html'}, '<title>New</title>')
+        responses.add_callback(responses.GET, 'http://site.test/', respond)
+
+        followed = []
+        page = worker_request(
+            PageParser().parse, followed.append, requests.Session(),
+            Task(url='http://site.test/', depth=2, referrer=None),
+            since=self.previous,
+        )
+        self.assertEqual(page.title, 'Old')
+        self.assertEqual(page.depth, 2)
+        self.assertEqual([l.depth for l in page.links], [3])
+        self.assertEqual(followed, [page])
+
+        page = worker_request(
+            PageParser().parse, followed.append, requests.Session(),
+            Task(url='http://site.test/', depth=2, referrer=None),
+        )
+        self.assertEqual(page.title, 'New')
+
+    @responses.activate
+    def test_not_modified_unknown(self):
+        # A 304 for a page we don't have is recorded as it is.
+        responses.add(responses.GET, 'http://site.test/a', status=304)
+        page = worker_request(
+            PageParser().parse, lambda page: None, requests.Session(),
+            Task(url='http://site.test/a', depth=1, referrer=None),
+            since=self.previous,
+        )
+        self.assertEqual(page.status, 304)
+        self.assertIsNone(page.title)
+
+    def test_unchanged(self):
+        previous = PreviousCrawl([Page(
+            url='http://site.test/', canonical_url=None, fetched=1425211200,
+            headers={'Date': 'Sun, 01 Mar 2015 12:00:00 GMT', 'ETag': '"v1"'},
+            no_index=False,
+            links=[], assets=[], title='Old', depth=0,
+        )])
+        url = 'http://site.test/'
+        self.assertTrue(previous.unchanged(url, parse_lastmod('2015-02-01')))
+        self.assertFalse(previous.unchanged(url, parse_lastmod('2015-03-02')))
+        self.assertFalse(previous.unchanged(url, None))
+        self.assertFalse(previous.unchanged('http://site.test/a', 0))
+
+
+class RecordsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'crawl.rec')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def page(self, n):
+        url = 'http://site.test/%d' % n
+        return Page(
+            url=url, canonical_url=url, fetched=True, no_index=False,
+            headers=CaseInsensitiveDict({'Content-Type': 'text/html'}),
+            title=u'Page \u2116%d' % n, depth=n,
+            links=[Link(type='anchor', href='http://site.test/%d' % (n + 1),
+                        no_follow=False, external=False, depth=n + 1,
+                        referrer=url)],
+            assets=[Link(type='stylesheet', href='http://site.test/s.css',
+                         no_follow=False, external=False, depth=n + 1,
+                         referrer=url)],
+        )
+
+    def test_round_trip(self):
+        pages = [self.page(n) for n in xrange(3)]
+        pages[2] = pages[2]._replace(duplicate_of='http://site.test/0',
+                                     error='Nope')
+        with RecordWriter(self.path) as writer:
+            for page in pages:
+                writer.write(page)
+
+        self.assertEqual(list(read_pages(self.path)), pages)
+        self.assertEqual(
+            list(read_pages(self.path))[0].headers['content-type'], 'text/html'
+        )
+        with RecordReader(self.path) as reader:
+            self.assertEqual(len(reader), 3)
+            self.assertEqual(reader.get('http://site.test/2'), pages[2])
+            self.assertIsNone(reader.get('http://site.test/3'))
+            self.assertEqual(
+                list(reader.pages(['http://site.test/1', 'http://x.test/'])),
+                [pages[1]]
+            )
+
+    def test_json(self):
+        with open(self.path, 'w') as fh:
+            fh.write(JSONSerialiser().dump_page(self.page(0)) + '\n')
+        self.assertEqual(list(read_pages(self.path))[0].title, u'Page \u21160')
+
+    def test_lazy(self):
+        page = self.page(0)
+        with open(self.path + '.json', 'w') as fh:
+            fh.write(JSONSerialiser().dump_page(page) + '\n')
+        with RecordWriter(self.path) as writer:
+            writer.write(page)
+
+        for path in [self.path, self.path + '.json']:
+            lazy, = read_pages(path, lazy=True)
+            self.assertEqual(lazy.url, page.url)
+            self.assertNotIn('links', vars(lazy))
+            self.assertEqual(lazy.links, page.links)
+            self.assertIn('links', vars(lazy))
+            self.assertEqual(lazy, page)
+            self.assertEqual(lazy._replace(depth=3).depth, 3)
+            self.assertEqual(JSONSerialiser().dump_page(lazy),
+                             JSONSerialiser().dump_page(page))
+
+    def test_parallel(self):
+        pages = [self.page(n) for n in xrange(20)]
+        expected = ''.join(render_json(page) for page in pages)
+        with open(self.path + '.json', 'w') as fh:
+            fh.write(expected)
+        with RecordWriter(self.path) as writer:
+            for page in pages:
+                writer.write(page)
+
+        for path in [self.path, self.path + '.json']:
+            chunks = list(parallel_replay(path, render_json, 2,
+                                          chunk_bytes=500))
+            self.assertGreater(len(chunks), 2)
+            self.assertEqual(''.join(chunks), expected)
+
+
+
+class ContentIndexTest(unittest.TestCase):
+    words = ['crul', 'crawls', 'sites', 'pages', 'links', 'robots', 'fetch',
+             'parse', 'queue', 'sitemap', 'index', 'shop', 'basket', 'price']
+
+    def text(self, seed, n=200):
+        rand = random.Random(seed)
+        return ' '.join(rand.choice(self.words) for _ in xrange(n))
+
+    def shingles(self, text):
+        words = text.split()
+        return set(zip(words, words[1:], words[2:]))
+
+    def test_simhash(self):
+        a = self.shingles(self.text(1))
+        similar = self.shingles(self.text(1) + ' crul crawls')
+        different = self.shingles(self.text(2))
+        self.assertLessEqual(hamming(simhash(a), simhash(similar)), 3)
+        self.assertGreater(hamming(simhash(a), simhash(different)), 3)
+        self.assertEqual(hamming(0b1011, 0b0110), 3)
+
+    def test_exact(self):
+        index = ContentIndex(near=False)
+        self.assertIsNone(index.check('http://site.test/a', 'A'))
+        self.assertEqual(index.check('http://site.test/b', 'A'),
+                         ('http://site.test/a', 'exact'))
+        self.assertIsNone(index.check('http://site.test/c', ''))
+        self.assertIsNone(index.check('http://site.test/d', 'D'))
+
+    def test_near(self):
+        index = ContentIndex()
+        page = '<html><body><p>%s</p><a href="/x?sid=%d">X</a></body></html>'
+        text = self.text(1)
+        self.assertIsNone(index.check('http://site.test/a', page % (text, 1)))
+        # Only the markup differs, or but a word.
+        self.assertEqual(index.check('http://site.test/a?sid=2',
+                                     page % (text, 2)),
+                         ('http://site.test/a', 'near'))
+        self.assertEqual(index.check('http://site.test/a?print=1',
+                                     page % (text + ' crul', 1)),
+                         ('http://site.test/a', 'near'))
+        self.assertIsNone(index.check('http://site.test/b',
+                                      page % (self.text(2), 1)))
+        # Too short to tell.
+        self.assertIsNone(index.check('http://site.test/c', page % ('C', 1)))
+        self.assertIsNone(index.check('http://site.test/c?sid=2',
+                                      page % ('C', 2)))
+
+    @responses.activate
+    def test_crawl(self):
+        text = self.text(1)
+        for path, body in [
+                ('/', '<a href="/a?sid=1">A</a><a href="/a?sid=2">A</a>'),
+                ('/a?sid=1', '<p>%s</p><a href="/x?sid=1">X</a>' % text),
+                ('/a?sid=2', '<p>%s</p><a href="/x?sid=2">X</a>' % text),
+                ('/x?sid=1', 'X'),
+                ('/x?sid=2', 'X')]:
+            responses.add(responses.GET, 'http://site.test' + path, body=body,
+                          content_type='text/html', match_querystring=True)
+
+        metrics = Metrics()
+        pages = list(site_crawl(
+            requests.Session(), 'http://site.test/', 1, 0,
+            parser=PageParser(), traverser=PageTraverser(), metrics=metrics,
+            dedupe=ContentIndex(),
+        ))
+        self.assertEqual(len(pages), 4)
+        duplicate = pages[2]
+        self.assertEqual(duplicate.url, 'http://site.test/a?sid=2')
+        self.assertEqual(duplicate.duplicate_of, 'http://site.test/a?sid=1')
+        self.assertEqual(duplicate.links, [])
+        self.assertNotIn('http://site.test/x?sid=2', [p.url for p in pages])
+        self.assertEqual(metrics.snapshot()['counters']['duplicates.near'], 1)
+
+        # The duplicate is left out of the sitemap.
+        self.assertTrue(duplicate.no_index)
+        out = StringIO()
+        output_sitemap(pages, out)
+        self.assertEqual(out.getvalue().count('<url>'), 3)
+        self.assertNotIn('sid=2', out.getvalue())
+
+
+class SinkTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def read(self, name):
+        with (gzip.open if name.endswith('.gz') else open)(
+                self.path(name), 'rb') as fh:
+            return fh.read()
+
+    def test_shard_path(self):
+        self.assertEqual(shard_path('a/pages.json.gz', 3), 'a/pages-3.json.gz')
+        self.assertEqual(shard_path('pages.json', 1), 'pages-1.json')
+        self.assertEqual(shard_path('pages', 2), 'pages-2')
+
+    def test_shards(self):
+        sink = FileSink(self.path('out.txt.gz'), max_items=2, max_bytes=11,
+                        header='[', footer=']', buffer_size=2)
+        for chunk in ['a', 'b', 'c', 'dddddddd', u'\u2116']:
+            sink.write(chunk)
+        self.assertEqual(sink.close(), [
+            self.path('out-%d.txt.gz' % n) for n in (1, 2, 3)
+        ])
+        self.assertEqual(
+            [self.read('out-%d.txt.gz' % n) for n in (1, 2, 3)],
+            ['[ab]', '[cdddddddd]', '[\xe2\x84\x96]'],
+        )
+
+    def test_background(self):
+        with BackgroundWriter(FileSink(self.path('out.txt'))) as writer:
+            for n in xrange(100):
+                writer.write('%d\n' % n)
+        self.assertEqual(self.read('out.txt').split(),
+                         map(str, xrange(100)))
+
+        class Broken(object):
+            def write(self, item):
+                raise IOError('Disk full')
+
+        writer = BackgroundWriter(Broken())
+        writer.write('x')
+        self.assertRaises(IOError, writer.close)
+
+    def test_sitemap(self):
+        sink = SitemapSink(self.path('sitemap.xml'), url='http://site.test/',
+                           max_urls=2)
+        for n in xrange(3):
+            sink.write('<url><loc>http://site.test/%d</loc></url>\n' % n)
+        sink.close()
+        index = self.read('sitemap.xml')
+        self.assertIn('<sitemapindex', index)
+        self.assertIn('<loc>http://site.test/sitemap-2.xml</loc>', index)
+        self.assertEqual(self.read('sitemap-2.xml').count('<url>'), 1)
+
+        # A sitemap which needn't be split isn't.
+        sink = SitemapSink(self.path('one.xml'))
+        sink.write('<url><loc>http://site.test/</loc></url>\n')
+        self.assertEqual(sink.close(), [self.path('one.xml')])
+        self.assertIn('<urlset', self.read('one.xml'))
+        self.assertFalse(os.path.exists(self.path('one-1.xml')))
+
+
+class SitemapTest(unittest.TestCase):
+    index = """<?xml version="1.0" encoding="UTF-8"?>
+        <sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+          <sitemap><loc>http://site.test/pages.xml</loc></sitemap>
+        </sitemapindex>"""
+    pages = """<?xml version="1.0" encoding="UTF-8"?>
+        <urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+          <url>
+            <loc>http://site.test/a</loc>
+            <lastmod>2015-03-01T12:00:00+01:00</lastmod>
+            <priority>0.8</priority>
+          </url>
+          <url><loc>http://site.test/private/b</loc></url>
+          <url><loc>http://elsewhere.test/c</loc></url>
+        </urlset>"""
+
+    def gzipped(self, body):
+        out = StringIO()
+        with gzip.GzipFile(fileobj=out, mode='wb') as f:
+            f.write(body)
+        return out.getvalue()
+
+    def test_parse_lastmod(self):
+        self.assertEqual(parse_lastmod('1970-01-02'), 86400)
+        self.assertEqual(parse_lastmod('1970-01-01T01:00Z'), 3600)
+        self.assertEqual(parse_lastmod('1970-01-01T01:00:30+01:00'), 30)
+        self.assertEqual(parse_lastmod('1970-01-01T00:00:00.5-00:30'), 1800)
+        self.assertIsNone(parse_lastmod('yesterday'))
+        self.assertIsNone(parse_lastmod(None))
+
+    @responses.activate
+    def test_urls(self):
+        responses.add(responses.GET, 'http://site.test/robots.txt',
+                      body='User-agent: *\nDisallow: /private/\n'
+                           'Sitemap: http://site.test/index.xml.gz\n')
+        responses.add(responses.GET, 'http://site.test/index.xml.gz',
+                      body=self.gzipped(self.index),
+                      content_type='application/x-gzip')
+        responses.add(responses.GET, 'http://site.test/pages.xml',
+                      body=self.pages, content_type='application/xml')
+
+        urls = list(sitemap_urls(['http://site.test/index.xml.gz'],
+                                 requests.Session(), chunk_size=16))
+        self.assertEqual([u.loc for u in urls], [
+            'http://site.test/a', 'http://site.test/private/b',
+            'http://elsewhere.test/c',
+        ])
+        self.assertEqual(urls[0].lastmod, parse_lastmod('2015-03-01T11:00Z'))
+        self.assertEqual(urls[0].priority, 0.8)
+        self.assertEqual(urls[0].sitemap, 'http://site.test/pages.xml')
+
+        hints = []
+        tasks = list(sitemap_tasks(
+            ['http://site.test/'], requests.Session(),
+            PageTraverser(disallowed=DisallowedSet(['/private/'])),
+            hint=lambda url, priority: hints.append((url, priority)),
+        ))
+        self.assertEqual(tasks, [Task(
+            url='http://site.test/a', depth=1,
+            referrer='http://site.test/pages.xml', lastmod=urls[0].lastmod,
+        )])
+        self.assertEqual(hints, [('http://site.test/a', 0.8)])
+
+    @responses.activate
+    def test_missing(self):
+        responses.add(responses.GET, 'http://site.test/robots.txt', status=404)
+        responses.add(responses.GET, 'http://site.test/sitemap.xml', status=404)
+        self.assertEqual(list(sitemap_tasks(
+            ['http://site.test/'], requests.Session(), PageTraverser(),
+        )), [])
+
+    @responses.activate
+    def test_crawl(self):
+        responses.add(responses.GET, 'http://site.test/',
+                      body='<title>Home</title>', content_type='text/html')
+        responses.add(responses.GET, 'http://site.test/a',
+                      body='<title>A</title>', content_type='text/html')
+        pages = site_crawl(
+            requests.Session(), 'http://site.test/', 2, 0,
+            parser=PageParser(), traverser=PageTraverser(),
+            seeds=[Task(url='http://site.test/a', depth=1, referrer=None)],
+        )
+        self.assertEqual(sorted(p.title for p in pages), ['A', 'Home'])
+
+
 if __name__ == '__main__':
     unittest.main()
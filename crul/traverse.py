@@ -1,8 +1,12 @@
 import logging
-from fnmatch import fnmatch
-from urlparse import urlparse
+import threading
+import time
+from collections import defaultdict
 
 from crul import Task
+from crul.metrics import Metrics
+from crul.seen import StripedSet
+from crul.urls import UrlNormalizer
 
 
 def trim_fragment(url):
@@ -12,80 +16,139 @@ def trim_fragment(url):
         return url
 
 
-class DisallowedSet(object):
-    def __init__(self, patterns=()):
-        self.patterns = ['%s*' % p.lstrip('/') for p in patterns]
-
-    def __contains__(self, path):
-        path = path.lstrip('/')
-        for pattern in self.patterns:
-            if fnmatch(path, pattern):
-                return True  # One of the patterns disallows this url.
-        return False
-
-
 class PageTraverser(object):
-    def __init__(self, max_depth=100, disallowed=()):
+    def __init__(self, max_depth=100, disallowed=(), seen=None, robots=None,
+                 metrics=None, on_seen=None, urls=None, max_pending=None):
         self.max_depth = max_depth
+        self.metrics = metrics or Metrics()
         self.disallowed = disallowed
-        self.seen = set()  # TODO: Is set.{add,__contains__} thread-safe?
+        # When crawling many sites, look up each site's disallowed paths.
+        self.robots = robots
+        # Told of each link we'd have followed to a URL already seen, e.g. to
+        # count its in-links (PriorityFrontier.note_link).
+        self.on_seen = on_seen
+        # Computes the keys by which URLs are deduplicated.
+        self.urls = urls or UrlNormalizer()
+        # Workers queue links concurrently, so URLs are marked seen with an
+        # atomic add_new where the seen-set has one, else under seen_lock.
+        self.seen = StripedSet() if seen is None else seen
+        self.seen_lock = threading.Lock()
+        # Beyond max_pending tasks, links aren't queued (until they're found
+        # again with room to spare) and seeds wait to be.
+        self.max_pending = max_pending
         self.allow_external = False
         self.ignore_suffixes = (
             '.png', '.svg', '.pdf', '.jpg', '.gif', '.jpeg', '.mp4', '.wav',
         )
 
+    def is_full(self, pending):
+        return bool(self.max_pending) and pending.qsize() >= self.max_pending
+
     def sanitize(self, url):
-        # Trimming the trailing slash is dubious. Technically they are
-        # different URLs...
-        return trim_fragment(url).rstrip('/')
+        return self.urls.key(url)
+
+    def mark_seen(self, url):
+        """mark_seen adds url to the seen-set, returning whether it wasn't
+        there already. Only one of many workers marking the same URL at once
+        will be told that it's new.
+        """
+        add_new = getattr(self.seen, 'add_new', None)
+        if add_new is not None:
+            return add_new(url)
+        with self.seen_lock:
+            if url in self.seen:
+                return False
+            self.seen.add(url)
+            return True
 
-    def queue_url(self, pending, url, depth=0, referrer=None):
+    def queue_url(self, pending, url, depth=0, referrer=None, lastmod=None):
         sanurl = self.sanitize(url)
-        if sanurl in self.seen:
+        # Check before marking, which may need a lock, as most links are to
+        # URLs we've seen.
+        if sanurl in self.seen or not self.mark_seen(sanurl):
             logging.debug('Skipping %s from %s: link already queued.',
                           url, referrer or 'None')
-            return
+            return False
 
         logging.debug('Queueing %s from %s', url, referrer or None)
-        self.seen.add(sanurl)
         pending.put(Task(
             url=url,
             depth=depth,
             referrer=referrer,
+            lastmod=lastmod,
         ))
+        self.metrics.peak('pending', pending.qsize())
+        return True
+
+    def queue_tasks(self, pending, tasks):
+        """queue_tasks queues each of an iterable of Tasks (e.g. from a
+        sitemap), if not already seen, waiting whilst pending is full.
+        """
+        for task in tasks:
+            while self.is_full(pending):
+                time.sleep(0.1)
+            self.queue_url(pending, task.url, depth=task.depth,
+                           referrer=task.referrer, lastmod=task.lastmod)
+
+    def is_disallowed(self, href, url=None):
+        url = url or self.urls.split(href)
+        disallowed = (self.robots.disallowed(href) if self.robots
+                      else self.disallowed)
+        return url.path + ('?' + url.query if url.query else '') in disallowed
 
     def follow(self, pending, page):
         if page.canonical_url:
             self.seen.add(self.sanitize(page.canonical_url))
 
+        counts = defaultdict(int)
         for link in page.links:
-            url = urlparse(link.href)
+            counts['links.discovered'] += 1
+            url = self.urls.split(link.href)
             if url.scheme.lower() not in ('http', 'https'):
                 logging.debug(
                     'Skipping %s from %s: only following http[s] links.',
                     link.href, link.referrer)
+                counts['links.skipped.scheme'] += 1
                 continue
             if link.no_follow:
                 logging.debug('Skipping %s from %s: link marked nofollow.',
                               link.href, link.referrer)
+                counts['links.skipped.nofollow'] += 1
                 continue
             if not self.allow_external and link.external:
                 logging.debug(
                     'Skipping %s from %s: not following external link.',
                     link.href, link.referrer)
+                counts['links.skipped.external'] += 1
                 continue
             if link.depth > self.max_depth:
                 logging.debug('Skipping %s from %s: beyond maximum depth.',
                               link.href, link.referrer)
+                counts['links.skipped.depth'] += 1
                 continue
             if any(url.path.lower().endswith(s) for s in self.ignore_suffixes):
                 logging.debug('Skipping %s from %s: ignored suffix.',
                               link.href, link.referrer)
+                counts['links.skipped.suffix'] += 1
                 continue
-            if url.path in self.disallowed:
+            if self.is_disallowed(link.href, url):
                 logging.debug('Skipping %s from %s: disallowed.',
                               link.href, link.referrer)
+                counts['links.skipped.disallowed'] += 1
+                continue
+
+            if self.is_full(pending) and (
+                    self.sanitize(link.href) not in self.seen):
+                logging.debug('Skipping %s from %s: too many pending.',
+                              link.href, link.referrer)
+                counts['links.skipped.pending'] += 1
                 continue
 
-            self.queue_url(pending, url=url.geturl(), depth=link.depth,
-                           referrer=link.referrer)
+            if self.queue_url(pending, url=link.href, depth=link.depth,
+                              referrer=link.referrer):
+                counts['links.queued'] += 1
+            else:
+                counts['links.skipped.seen'] += 1
+                if self.on_seen:
+                    self.on_seen(link.href)
+        self.metrics.add(counts)
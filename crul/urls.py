@@ -0,0 +1,128 @@
+"""
+Resolving and normalising the URLs of links.
+
+The same links, in the navigation and footer of every page of a site, are
+resolved and normalised over and over, so UrlNormalizer memoises both in
+bounded caches.
+"""
+from urlparse import urljoin, urlsplit, urlunsplit
+
+DEFAULT_PORTS = {'http': ':80', 'https': ':443'}
+
+
+class LRUMemo(object):
+    """LRUMemo memoises a function of one (hashable) argument, keeping about
+    the maxsize most recently used results.
+
+    Rather than order every entry by use, which costs more than most of the
+    calls it saves, results are kept in two generations: hits in the old
+    generation are moved to the new one, and when the new one fills it
+    becomes the old one, dropping whatever wasn't used in the meantime.
+    Lookups and updates are single dict operations, so the memo can be shared
+    between threads: at worst, a result is computed twice.
+    """
+    def __init__(self, fn, maxsize=10000):
+        self.fn = fn
+        self.maxsize = maxsize
+        self.new, self.old = {}, {}
+
+    def __call__(self, arg):
+        try:
+            return self.new[arg]
+        except KeyError:
+            pass
+        try:
+            value = self.old[arg]
+        except KeyError:
+            value = self.fn(arg)
+        self.put(arg, value)
+        return value
+
+    def put(self, arg, value):
+        """put keeps value as the result for arg, as if fn had returned it."""
+        if len(self.new) >= self.maxsize // 2:
+            self.new, self.old = {}, self.new
+        self.new[arg] = value
+
+    def pop(self, arg, default=None):
+        """pop forgets the result kept for arg, returning it, or default if
+        none is kept.
+        """
+        value = self.old.pop(arg, default)
+        return self.new.pop(arg, value)
+
+    def __len__(self):
+        return len(self.new) + len(self.old)
+
+
+class UrlNormalizer(object):
+    """UrlNormalizer resolves links against the URL of their page, and
+    computes the key by which URLs are deduplicated.
+
+    Args:
+        sort_query: Whether to sort the parameters of the query string in the
+            key, so that their order doesn't distinguish URLs.
+        strip_params: Names of query string parameters (e.g. session IDs or
+            tracking parameters) to leave out of the key.
+        cache_size: The number of URLs to memoise the results for.
+    """
+    def __init__(self, sort_query=False, strip_params=(), cache_size=10000):
+        self.sort_query = sort_query
+        self.strip_params = frozenset(strip_params)
+        self.cache_size = cache_size
+        self.init_caches()
+
+    def init_caches(self):
+        self.resolve_memo = LRUMemo(self.resolve_uncached, self.cache_size)
+        self.key_memo = LRUMemo(self.key_uncached, self.cache_size)
+        self.split_memo = LRUMemo(urlsplit, self.cache_size)
+
+    def __getstate__(self):
+        # Don't send the caches along to the processes of a ProcessPageParser.
+        return (self.sort_query, self.strip_params, self.cache_size)
+
+    def __setstate__(self, state):
+        self.sort_query, self.strip_params, self.cache_size = state
+        self.init_caches()
+
+    def resolve(self, base, href):
+        """resolve returns the absolute URL of href on the page at base, and
+        the parts of it (a urlparse.SplitResult).
+        """
+        return self.resolve_memo((base, href))
+
+    def resolve_uncached(self, base_href):
+        url = urlsplit(urljoin(*base_href))
+        return url.geturl(), url
+
+    def split(self, url):
+        """split returns the parts of url (a urlparse.SplitResult)."""
+        return self.split_memo(url)
+
+    def key(self, url):
+        """key returns the canonical form of url by which it's deduplicated:
+        the scheme and host lowercased, any default port, fragment and
+        trailing slash removed, and the query string sorted and stripped of
+        strip_params, if asked.
+        """
+        return self.key_memo(url)
+
+    def key_uncached(self, url):
+        scheme, netloc, path, query, _ = urlsplit(url)
+        scheme = scheme.lower()
+        userinfo, at, host = netloc.rpartition('@')
+        host = host.lower()
+        if host.endswith(DEFAULT_PORTS.get(scheme, '\0')):
+            host = host[:-len(DEFAULT_PORTS[scheme])]
+        if query and (self.sort_query or self.strip_params):
+            params = query.split('&')
+            if self.strip_params:
+                params = [p for p in params
+                          if p.split('=', 1)[0] not in self.strip_params]
+            if self.sort_query:
+                params.sort()
+            query = '&'.join(params)
+        # Trimming the trailing slash is dubious. Technically they are
+        # different URLs...
+        return urlunsplit((scheme, userinfo + at + host, path, query, '')
+                          ).rstrip('/')
@@ -22,6 +22,12 @@ setup(
         'sloq==0.2',
         'lxml==3.5.0',
     ],
+    extras_require={
+        'async': ['gevent==1.1.0'],
+        'graph': ['numpy==1.16.6'],
+        'records': ['msgpack==0.6.2'],
+        'zstd': ['zstandard==0.13.0'],
+    },
     tests_require=[
         'setuptools==20.0',
         'responses==0.5.1',